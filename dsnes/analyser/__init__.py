@@ -1,9 +1,19 @@
 # Copyright 2017 Adrian Chan
 # Licensed under GPLv3
 
+from bisect import bisect_left
 import collections
+import sys
+import time
 
 import dsnes
+from dsnes.analyser import (
+    batch, cache, cdl, changes, codemap, control, jumptable, listing,
+    rwlock, shardeddb, sqlitedb, stats, symbols, trace, xref)
+
+
+# How far past a label a target can be and still be shown as label+offset.
+MAX_LABEL_OFFSET = 0x100
 
 
 class AnalyserError:
@@ -39,8 +49,11 @@ class Disassembly:
 
 
 class Analyser:
-    def __init__(self, project):
+    def __init__(self, project, database=None):
         self.project = project
+        # Where annotations are read from; a view of the project's database
+        # when analysing on another thread.
+        self.database = project.database if database is None else database
         self.start_address = None
         self.start_state = None
         self.state = None
@@ -48,7 +61,17 @@ class Analyser:
         self.disassembly = None
         # Dict of from_address:[(to, state)].
         self.calls_from = None
+        # Dict of from_address:(table_address, [target of each entry]).
+        self.jump_tables = None
+        # List of control flow (from_address, to_address, xref kind).
+        self.references = None
         self.visited = None
+        # Sorted list of the addresses that operations target.
+        self.targets = None
+        # Why the last analysis stopped early, or None if it completed.
+        self.stop_reason = None
+        # Where the last analysis spent its time.
+        self.stats = None
         self.reset()
 
     def reset(self):
@@ -58,20 +81,40 @@ class Analyser:
         self.operations = []
         self.disassembly = []
         self.calls_from = collections.defaultdict(list)
+        self.jump_tables = {}
+        self.references = []
         self.visited = set()
-
-    def analyse_function(self, address, state=None, stop_before=None):
+        self.targets = []
+        self.stop_reason = None
+        self.stats = stats.AnalysisStats()
+
+    @property
+    def is_complete(self):
+        return self.stop_reason is None
+
+    def analyse_function(self, address, state=None, stop_before=None,
+                         control=None):
+        """Analyse the function that starts at address.
+
+        control is an optional AnalysisControl, which can report progress
+        and stop the analysis early. If it does stop then stop_reason says
+        why, and the disassembly covers what was analysed up to that point.
+        stop_before is shorthand for a breakpoint at that address.
+        """
+        start = time.perf_counter()
         self.reset()
         self.start_address = address
         self.start_state = state
-        self._analyse_operations(address, state, stop_before)
-        self._collate_disassembly()
-
-    def _analyse_operations(self, address, state, stop_before):
-        bus = self.project.bus
-        db = self.project.database
-        queue = collections.deque()
-        queue.append(address)
+        if control is None:
+            control = dsnes.analyser.control.AnalysisControl()
+        if stop_before is not None:
+            control.add_breakpoint(stop_before)
+        self._analyse_operations(address, state, control)
+        with self.stats.timer(stats.COLLATE):
+            self._collate_disassembly()
+        self.stats.total = time.perf_counter() - start
+
+    def _analyse_operations(self, address, state, control):
         # By default we don't know what state the CPU is in, though the caller
         # can provide a starting state.
         if isinstance(state, dsnes.State):
@@ -80,17 +123,66 @@ class Analyser:
             calculated_state = dsnes.State.parse(state)
         else:
             calculated_state = dsnes.State()
+        # Queue of (address, calculated_state) still to be walked.
+        queue = collections.deque()
+        queue.append((address, calculated_state))
+        control.start()
+        try:
+            with self.stats.timer(stats.WALK):
+                self.stop_reason = self._walk(queue, control)
+        finally:
+            control.finish(len(queue))
+
+    def _walk(self, queue, control):
+        """Walk blocks from the queue until it's empty.
+
+        Returns the reason that control stopped the walk, or None.
+        """
+        bus = self.project.bus
+        db = self.database
+        perf_counter = time.perf_counter
+        # Whether to time the phases of each instruction.
+        timing = control.time_phases
+        times = self.stats.times
+        counts = self.stats.counts
 
         while queue:
-            address = queue.pop()
+            stop = control.block(len(queue))
+            if stop:
+                return stop
+            address, calculated_state = queue.pop()
+            counts["blocks"] += 1
 
             while True:
                 if address in self.visited:
                     break
 
+                if timing:
+                    lookup_start = perf_counter()
+                try:
+                    declared_state = db.get_state(address)
+                    delta = None
+                    if declared_state is None:
+                        delta = db.get_state_delta(address)
+                        counts["database_lookups"] += 2
+                    else:
+                        counts["database_lookups"] += 1
+                except ValueError as ex:
+                    # States are parsed when first looked up, so a bad one
+                    # in the database only turns up here.
+                    if timing:
+                        times[stats.DATABASE] += perf_counter() - lookup_start
+                    counts["errors"] += 1
+                    self.visited.add(address)
+                    error = AnalyserError(address, calculated_state, str(ex))
+                    self.operations.append(error)
+                    break
+                if timing:
+                    state_start = perf_counter()
+                    times[stats.DATABASE] += state_start - lookup_start
+
                 # If the user claims to know the exact state for this
                 # instruction, use it.
-                declared_state = db.get_state(address)
                 if declared_state is not None:
                     self.state = declared_state
                 # Otherwise use the state that was calculated by executing the
@@ -99,14 +191,19 @@ class Analyser:
                     self.state = calculated_state
                     # We can also modify this calculated state based on some
                     # partial state information provided by the user.
-                    delta = db.get_state_delta(address)
                     if delta:
                         self.state = delta.apply(self.state)
 
+                if timing:
+                    decode_start = perf_counter()
+                    times[stats.STATE] += decode_start - state_start
                 try:
                     self.visited.add(address)
                     disassembly = dsnes.disassemble(address, bus, self.state)
                 except dsnes.AmbiguousDisassembly as ex:
+                    if timing:
+                        times[stats.DECODE] += perf_counter() - decode_start
+                    counts["errors"] += 1
                     error = AnalyserError(
                         address, self.state,
                         "Ambiguous {mnemonic} depends on {thing}".format(
@@ -115,55 +212,202 @@ class Analyser:
                     break
                 except (dsnes.InvalidDisassembly,
                         dsnes.BusReadImpossible) as ex:
+                    if timing:
+                        times[stats.DECODE] += perf_counter() - decode_start
+                    counts["errors"] += 1
                     error = AnalyserError(
                         address, self.state, str(ex))
                     self.operations.append(error)
                     break
                 else:
+                    if timing:
+                        times[stats.DECODE] += perf_counter() - decode_start
+                    counts["instructions"] += 1
                     self.operations.append(disassembly)
                     calculated_state = disassembly.new_state
+                    stop = control.step(len(queue))
+                    if stop:
+                        return stop
 
                     do_next = disassembly.next_addr
                     action, data = do_next[0], do_next[1:]
 
+                    if jumptable.is_jump_table_operation(disassembly):
+                        targets = self._resolve_jump_table(disassembly)
+                    else:
+                        targets = None
+
                     if action in (dsnes.NextAction.step, dsnes.NextAction.jump):
                         # Temporarily treat jump like a step.
                         next_addr = data[0]
+                        if targets:
+                            # Every entry in the table is part of this
+                            # function, so walk them all.
+                            call_list = self.calls_from[address]
+                            for target in targets:
+                                call_list.append((target, self.state))
+                                queue.append((target, calculated_state))
+                                self.references.append(
+                                    (address, target, xref.JUMP))
+                        elif (action is dsnes.NextAction.jump
+                                and next_addr is not None):
+                            self.references.append(
+                                (address, next_addr, xref.JUMP))
+                        if next_addr is None:
+                            # Can't tell where the jump goes.
+                            break
                     elif action is dsnes.NextAction.call:
                         target, after_return = data
                         call_list = self.calls_from[address]
-                        call_list.append((target, self.state))
+                        if not targets:
+                            targets = [] if target is None else [target]
+                        for target in targets:
+                            call_list.append((target, self.state))
+                            self.references.append(
+                                (address, target, xref.CALL))
                         next_addr = after_return
                     elif action is dsnes.NextAction.branch:
                         taken_addr, not_taken_addr = data
                         next_addr = not_taken_addr
-                        if taken_addr == stop_before:
-                            print_address(address)
-                            import pdb
-                            pdb.set_trace()
+                        stop = control.transfer(self, address, taken_addr)
+                        if stop:
+                            return stop
                         call_list = self.calls_from[address]
                         call_list.append((taken_addr, self.state))
+                        self.references.append(
+                            (address, taken_addr, xref.BRANCH))
                     elif action is dsnes.NextAction.ret:
                         break
                     else:
                         raise NotImplementedError(
                             "Analyser can't handle {}".format(action))
 
-                    if next_addr == stop_before:
-                        print_address(address)
-                        import pdb
-                        pdb.set_trace()
+                    stop = control.transfer(self, address, next_addr)
+                    if stop:
+                        return stop
                     address = next_addr
 
+    def _resolve_jump_table(self, operation):
+        """Find the targets of a jmp/jsr through an indexed table."""
+        table_addr = operation.target_info.addr
+        targets = jumptable.resolve(
+            self.project.bus, self.database, table_addr,
+            known_code=self.visited)
+        self.jump_tables[operation.addr] = (table_addr, targets)
+        self.stats.counts["jump_tables"] += 1
+        # Don't repeat targets that appear in several table entries.
+        return list(collections.OrderedDict.fromkeys(targets))
+
+    def recollate(self):
+        """Rebuild the disassembly lines from the existing operations.
+
+        Picks up label and comment changes without re-analysing.
+        """
+        self.disassembly = []
+        with self.stats.timer(stats.COLLATE):
+            self._collate_disassembly()
+
+    def affected_by(self, events):
+        """Work out what a list of database Changes means for this analysis.
+
+        Returns None if it isn't affected, changes.RECOLLATE if only the
+        labels or comments it shows have changed, or changes.REANALYSE.
+        """
+        action = None
+        visited = self.visited
+        for kind, addr in events:
+            if kind == changes.ALL:
+                return changes.REANALYSE
+            elif kind in (changes.STATE, changes.STATE_DELTA):
+                if addr in visited:
+                    return changes.REANALYSE
+            elif kind == changes.LABEL:
+                if self._in_jump_table(addr):
+                    return changes.REANALYSE
+                if addr in visited or self._near_target(addr):
+                    action = changes.RECOLLATE
+            elif addr in visited:
+                action = changes.RECOLLATE
+        return action
+
+    def _in_jump_table(self, addr):
+        """Check if a label at addr could change where a jump table ends."""
+        for table_addr, targets in self.jump_tables.values():
+            if (table_addr & 0xFF0000) != (addr & 0xFF0000):
+                continue
+            offset = (addr - table_addr) & 0xFFFF
+            if 0 < offset <= len(targets) * 2:
+                return True
+        return False
+
+    def _near_target(self, addr):
+        """Check if a label at addr could be shown for a target."""
+        targets = self.targets
+        idx = bisect_left(targets, addr)
+        if idx == len(targets):
+            return False
+        target = targets[idx]
+        return ((target & 0xFF0000) == (addr & 0xFF0000)
+                and target - addr <= MAX_LABEL_OFFSET)
+
     def _collate_disassembly(self):
         disassembly = self.disassembly
-
-        for operation in self.operations:
-            for text in self.get_labels_for(operation.addr):
+        operations = self.operations
+        database = self.database
+
+        # Gather every address that needs a label or comment, and resolve
+        # them all in one go.
+        addresses = [operation.addr for operation in operations]
+        targets = set()
+        for operation in operations:
+            if not isinstance(operation, AnalyserError):
+                target_addr = operation.target_info.addr
+                if target_addr:
+                    targets.add(target_addr)
+        self.targets = sorted(targets)
+        labels_start = time.perf_counter()
+        labels = self.get_labels_for_addresses(targets.union(addresses))
+        comments_start = time.perf_counter()
+        pre_comments = database.get_pre_comments(addresses)
+        inline_comments = database.get_inline_comments(addresses)
+        labels_end = time.perf_counter()
+        self.stats.add_time(stats.DATABASE, labels_end - comments_start)
+
+        # Try to replace an operation's target address with a label.
+        bus = self.project.bus
+        target_labels = {}
+        for target_addr in targets:
+            target_label = None
+            target_label_list = labels[target_addr]
+            if (not bus.is_register(target_addr)
+                    and database.get_label(target_addr) is None):
+                # No user label or I/O register, but inside something that
+                # the user has labelled, such as a table or struct? That
+                # says more than a generic wram_ or sram_ label.
+                nearest = database.nearest_label(
+                    target_addr, MAX_LABEL_OFFSET)
+                if nearest is not None:
+                    label_addr, label = nearest
+                    target_label_list = ["{}+${:x}".format(
+                        label, target_addr - label_addr)]
+            if len(target_label_list) == 1:
+                target_label = target_label_list[0]
+            elif len(target_label_list) > 1:
+                target_label = target_label_list[0] + "..."
+            target_labels[target_addr] = target_label
+        self.stats.add_time(
+            stats.LABELS,
+            (comments_start - labels_start)
+            + (time.perf_counter() - labels_end))
+        self.stats.count("labels", len(labels))
+
+        for operation in operations:
+            addr = operation.addr
+            for text in labels[addr]:
                 item = Label(operation, text)
                 disassembly.append(item)
 
-            text = self.get_pre_comment_for(operation.addr)
+            text = pre_comments.get(addr, None)
             if text:
                 item = PreComment(operation, text)
                 disassembly.append(item)
@@ -172,23 +416,14 @@ class Analyser:
                 disassembly.append(operation)
             else:
                 # Special manipulations for a line of disassembly.
-                # Try to replace an operation's target address with a label.
-                target_info = operation.target_info
-                target_addr, str_fn = target_info
-                label = None
-                if target_addr:
-                    labels = self.get_labels_for(target_addr)
-                    if len(labels) == 0:
-                        pass
-                    elif len(labels) == 1:
-                        label = labels[0]
-                    else:
-                        label = labels[0] + "..."
-                target_str = str_fn(label)
+                target_addr, str_fn = operation.target_info
+                target_str = str_fn(target_labels.get(target_addr, None))
 
-                comment = self.get_inline_comment_for(operation)
+                comment = (inline_comments.get(addr, None)
+                           or operation.default_comment or None)
 
                 disassembly.append(Disassembly(operation, target_str, comment))
+        self.stats.count("lines", len(disassembly))
 
     def get_disassembly_line(self, line_number):
         return self.disassembly[line_number]
@@ -208,59 +443,14 @@ class Analyser:
         # Use get() so the defaultdict doesn't add the empty list to itself.
         return self.calls_from.get(address, [])
 
-    def display(self):
-        """Print the disassembly."""
-        for item in self.disassembly:
-            if isinstance(item, Label):
-                print(item.text)
+    def display(self, outfile=None, compress=None):
+        """Write the disassembly listing, to stdout by default.
 
-            elif isinstance(item, PreComment):
-                lines = item.text.splitlines()
-                for line in lines:
-                    print(" {}".format(line))
-
-            elif isinstance(item, AnalyserError):
-                self._display_error(item)
-
-            else:
-                self._display_operation(item)
-
-    def _display_operation(self, operation):
-        # Try to replace an address with a label.
-        target_info = operation.target_info
-        target_addr, str_fn = target_info
-        label = None
-        if target_addr:
-            labels = self.get_labels_for(target_addr)
-            if len(labels) == 0:
-                pass
-            elif len(labels) == 1:
-                label = labels[0]
-            else:
-                label = labels[0] + "..."
-        tgt_str = str_fn(label)
-
-        comment = self.get_inline_comment_for(operation)
-
-        s = " {pbr:02x}:{pc:04x}:{raw:<11}  {asm:<15s}   {target:<18s}  {comment:<35s}   {state}".format(
-            pbr=(operation.addr & 0xFF0000) >> 16,
-            pc=operation.addr & 0xFFFF,
-            raw=" ".join([format(n, "02x") for n in operation.raw]),
-            asm=operation.asm_str,
-            target=tgt_str,
-            comment=comment or "",
-            state=operation.state.encode())
-        print(s)
-
-    def _display_error(self, error):
-        error_msg = "!!!{}!!!".format(error.msg)
-        s = " {pbr:02x}:{pc:04x}{pad:<12}  {msg:^73}   {state}".format(
-            pbr=(error.addr & 0xFF0000) >> 16,
-            pc=error.addr & 0xFFFF,
-            pad="",
-            msg=error_msg,
-            state=error.state.encode())
-        print(s)
+        See listing.write_listing() for the meaning of compress.
+        """
+        if outfile is None:
+            outfile = sys.stdout
+        listing.write_listing(self.disassembly, outfile, compress)
 
     def get_label_for(self, addr):
         try:
@@ -269,7 +459,7 @@ class Analyser:
             hw_label = "UNMAPPED_{:06x}".format(addr)
 
         # User labels can override the default hardware label.
-        user_label = self.project.database.get_label(addr)
+        user_label = self.database.get_label(addr)
         if user_label:
             return user_label
         else:
@@ -282,20 +472,38 @@ class Analyser:
             hw_label = "UNMAPPED_{:06x}".format(addr)
 
         # Is always at least an empty list.
-        user_labels = self.project.database.get_labels(addr)
+        user_labels = self.database.get_labels(addr)
         if hw_label:
             user_labels.append(hw_label)
         return user_labels
 
+    def get_labels_for_addresses(self, addresses):
+        """Get all labels for many addresses at once.
+
+        Like get_labels_for(), but returns a dict of {address: [labels]}
+        that has an entry for every address.
+        """
+        addresses = set(addresses)
+        hw_labels = self.project.bus.get_labels(addresses)
+        user_labels = self.database.get_labels_for_addresses(
+            addresses)
+        labels = {}
+        for addr in addresses:
+            try:
+                hw_label = hw_labels[addr]
+            except LookupError:
+                hw_label = "UNMAPPED_{:06x}".format(addr)
+            # User labels come first.
+            addr_labels = user_labels.get(addr, [])
+            if hw_label:
+                addr_labels.append(hw_label)
+            labels[addr] = addr_labels
+        return labels
+
     def get_pre_comment_for(self, addr):
-        return self.project.database.get_pre_comment(addr)
+        return self.database.get_pre_comment(addr)
 
     def get_inline_comment_for(self, operation):
-        user = self.project.database.get_inline_comment(operation.addr)
+        user = self.database.get_inline_comment(operation.addr)
         default = operation.default_comment
         return user or default or None
-
-
-def print_address(addr):
-    print("At {:02x}:{:04x}".format(
-        (address & 0xff0000) >> 16, address & 0xFFFF))
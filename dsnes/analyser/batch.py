@@ -0,0 +1,173 @@
+"""Many database edits, made all at once.
+
+Importing symbols or running a script can make thousands of edits. Rather
+than making them one at a time, they're collected in a Batch, checked in a
+single pass against the database, and only then applied. Either every edit
+is made or none of them are.
+
+Edits are held as the same records that the journal uses:
+{"op": ..., "addr": ..., "value": ...}, where a value of None removes.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+
+
+def apply_record(database, record):
+    """Make the edit in a record, using the database's own methods."""
+    op = record["op"]
+    addr = record["addr"]
+    value = record["value"]
+    if op == "state":
+        if value is None:
+            database.remove_state(addr)
+        else:
+            database.set_state(addr, dsnes.State.parse(value))
+    elif op == "state_delta":
+        if value is None:
+            database.remove_state_delta(addr)
+        else:
+            database.set_state_delta(addr, dsnes.StateDelta.parse(value))
+    elif op == "add_label":
+        database.add_label(addr, value)
+    elif op == "remove_label":
+        database.remove_label(addr, value)
+    elif op == "pre_comment":
+        if value is None:
+            database.delete_pre_comment(addr)
+        else:
+            database.set_pre_comment(addr, value)
+    elif op == "inline_comment":
+        if value is None:
+            database.delete_inline_comment(addr)
+        else:
+            database.set_inline_comment(addr, value)
+    else:
+        raise ValueError("Unknown edit {!r}".format(record))
+
+
+class Batch:
+    """A list of edits to make to a database.
+
+    Has the same editing methods as the database, but they only record the
+    edit. Nothing is checked until the batch is validated.
+    """
+
+    def __init__(self, records=None):
+        self.records = [] if records is None else records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def _add(self, op, addr, value):
+        self.records.append({"op": op, "addr": addr, "value": value})
+
+    def set_state(self, addr, state):
+        self._add("state", addr, state.encode())
+
+    def remove_state(self, addr):
+        self._add("state", addr, None)
+
+    def set_state_delta(self, addr, delta):
+        self._add("state_delta", addr, delta.encode())
+
+    def remove_state_delta(self, addr):
+        self._add("state_delta", addr, None)
+
+    def add_label(self, addr, label):
+        self._add("add_label", addr, label)
+
+    def remove_label(self, addr, label):
+        self._add("remove_label", addr, label)
+
+    def set_pre_comment(self, addr, comment):
+        assert comment is not None
+        self._add("pre_comment", addr, comment)
+
+    def delete_pre_comment(self, addr):
+        self._add("pre_comment", addr, None)
+
+    def set_inline_comment(self, addr, comment):
+        assert comment is not None
+        self._add("inline_comment", addr, comment)
+
+    def delete_inline_comment(self, addr):
+        self._add("inline_comment", addr, None)
+
+    def validate(self, database):
+        """Check that every edit can be made to the database, in order.
+
+        Raises ValueError for the first edit that can't be made. The
+        database isn't changed.
+        """
+        getters = {
+            "state": database.get_state,
+            "state_delta": database.get_state_delta,
+            "pre_comment": database.get_pre_comment,
+            "inline_comment": database.get_inline_comment,
+        }
+        # What the earlier edits in the batch have set, over the database.
+        overlays = {op: {} for op in getters}
+        label_owners = {}
+
+        def current(op, addr):
+            overlay = overlays[op]
+            if addr in overlay:
+                return overlay[addr]
+            return getters[op](addr)
+
+        def owner_of(label):
+            if label in label_owners:
+                return label_owners[label]
+            return database.get_address_with_label(label)
+
+        for n, record in enumerate(self.records):
+            op = record["op"]
+            addr = record["addr"]
+            value = record["value"]
+            where = "Edit {} at 0x{:06x}".format(n, addr)
+            if not 0 < addr <= 0xFFFFFF:
+                raise ValueError("{}: address is out of range".format(where))
+
+            if op in ("state", "state_delta"):
+                if value is not None:
+                    if op == "state":
+                        parsed = dsnes.State.parse(value)
+                        other = "state_delta"
+                    else:
+                        parsed = dsnes.StateDelta.parse(value)
+                        other = "state"
+                    if parsed is None:
+                        raise ValueError(
+                            "{}: {!r} is not valid".format(where, value))
+                    if current(other, addr) is not None:
+                        raise ValueError("{}: cannot set both an absolute "
+                            "and a delta state".format(where))
+                elif current(op, addr) is None:
+                    raise ValueError(
+                        "{}: there is no {} to remove".format(where, op))
+                overlays[op][addr] = value
+            elif op in ("pre_comment", "inline_comment"):
+                if value is None and current(op, addr) is None:
+                    raise ValueError(
+                        "{}: there is no {} to remove".format(where, op))
+                overlays[op][addr] = value
+            elif op == "add_label":
+                if not value:
+                    raise ValueError("{}: label is empty".format(where))
+                if owner_of(value) is not None:
+                    raise ValueError("{}: label {!r} is already in use".format(
+                        where, value))
+                label_owners[value] = addr
+            elif op == "remove_label":
+                if owner_of(value) != addr:
+                    raise ValueError(
+                        "{}: label {!r} is not applied here".format(
+                            where, value))
+                label_owners[value] = None
+            else:
+                raise ValueError("{}: unknown edit {!r}".format(where, op))
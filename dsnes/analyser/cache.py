@@ -0,0 +1,262 @@
+"""Persistent cache of analysis results.
+
+Analyses are stored in a compact binary file in the project directory, so
+reopening a project doesn't have to walk the code all over again.
+
+The whole cache is only valid for the ROM and config that it was made
+with. Each entry also records a digest of the database annotations that
+the analysis depended on, so an entry is only recomputed once one of those
+annotations changes.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+from array import array
+import collections
+import hashlib
+import os
+import pickle
+import zlib
+
+import dsnes
+
+
+FILENAME = "analysis.cache"
+# Bump this whenever the layout of an entry changes.
+VERSION = 1
+
+Entry = collections.namedtuple(
+    "Entry",
+    ["digest", "addrs", "states", "errors", "calls", "references",
+     "jump_tables"])
+
+
+def load(project):
+    """Load the analysis cache for a project.
+
+    Returns an empty cache if there isn't one, or if it was made for a
+    different ROM or config.
+    """
+    cache = AnalysisCache(
+        os.path.join(project.path, FILENAME),
+        project.rom_hash, project.config_hash)
+    cache.load()
+    return cache
+
+def make_key(address, state):
+    """Make the cache key for an analysis of a function."""
+    if state is None:
+        state = dsnes.State()
+    elif not isinstance(state, dsnes.State):
+        state = dsnes.State.parse(state)
+    return (address, state.pack())
+
+def dependency_digest(database, visited, jump_tables):
+    """Digest the database annotations that an analysis depends on.
+
+    These are the states and state deltas of every visited address, and the
+    labels that could have cut a jump table short.
+    """
+    h = hashlib.sha1()
+    states = database.get_state_strings(visited)
+    deltas = database.get_state_delta_strings(visited)
+    for addr in sorted(states.keys() | deltas.keys()):
+        h.update("{:06x}={}/{};".format(
+            addr, states.get(addr, ""), deltas.get(addr, "")).encode())
+
+    table_entries = []
+    for table_addr, targets in jump_tables.values():
+        pbr = table_addr & 0xFF0000
+        for n in range(1, len(targets) + 1):
+            table_entries.append(pbr | ((table_addr + n * 2) & 0xFFFF))
+    labels = database.get_labels_for_addresses(table_entries)
+    for addr in sorted(labels):
+        h.update("{:06x}:{};".format(addr, ",".join(labels[addr])).encode())
+    return h.digest()
+
+
+class AnalysisCache:
+    def __init__(self, path, rom_hash, config_hash):
+        self.path = path
+        self.rom_hash = rom_hash
+        self.config_hash = config_hash
+        self.is_dirty = False
+        # Dict of (address, packed state):Entry.
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        self.entries = {}
+        self.is_dirty = False
+        try:
+            with open(self.path, "rb") as infile:
+                contents = pickle.loads(zlib.decompress(infile.read()))
+        except FileNotFoundError:
+            return
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError,
+                ValueError, TypeError, AttributeError):
+            # A broken cache is no worse than no cache.
+            return
+        if (contents.get("version") == VERSION
+                and contents.get("rom_hash") == self.rom_hash
+                and contents.get("config_hash") == self.config_hash):
+            self.entries = contents["entries"]
+
+    def save(self):
+        """Write the cache to disk, if anything has changed."""
+        job = self.prepare_save()
+        if job is not None:
+            job.run()
+
+    def prepare_save(self):
+        """Take the entries, and return a CacheSaveJob that writes them.
+
+        Returns None if nothing has changed. The entries aren't changed
+        once stored, so only the dict is copied, and the job can pickle them
+        on another thread. If the job fails, pass it to restore_unsaved().
+        """
+        if not self.is_dirty:
+            return None
+        contents = {
+            "version": VERSION,
+            "rom_hash": self.rom_hash,
+            "config_hash": self.config_hash,
+            "entries": dict(self.entries),
+        }
+        self.is_dirty = False
+        return CacheSaveJob(self.path, contents)
+
+    def restore_unsaved(self, job):
+        """Mark the cache as needing saving again after a job failed."""
+        if not job.finished:
+            self.is_dirty = True
+
+    def store(self, analyser):
+        """Add a completed analysis to the cache."""
+        key = make_key(analyser.start_address, analyser.start_state)
+        addrs = array("L")
+        states = array("L")
+        errors = {}
+        for idx, operation in enumerate(analyser.operations):
+            addrs.append(operation.addr)
+            states.append(operation.state.pack())
+            if isinstance(operation, dsnes.analyser.AnalyserError):
+                errors[idx] = operation.msg
+        calls = array("Q")
+        for from_addr, call_list in analyser.calls_from.items():
+            for to_addr, _ in call_list:
+                calls.append((from_addr << 24) | to_addr)
+        references = array("Q", [(target << 26) | (source << 2) | kind
+                                 for source, target, kind
+                                 in analyser.references])
+        digest = dependency_digest(
+            analyser.database, analyser.visited,
+            analyser.jump_tables)
+        self.entries[key] = Entry(
+            digest=digest, addrs=addrs, states=states, errors=errors,
+            calls=calls, references=references,
+            jump_tables=dict(analyser.jump_tables))
+        self.is_dirty = True
+
+    def validate(self, database):
+        """Drop every entry that the database has changed under."""
+        for key, entry in list(self.entries.items()):
+            digest = dependency_digest(
+                database, set(entry.addrs), entry.jump_tables)
+            if digest != entry.digest:
+                del self.entries[key]
+                self.is_dirty = True
+
+    def iter_references(self):
+        """Generate (visited, references) for each entry.
+
+        references are (source, target, kind) as for the XrefIndex.
+        """
+        for entry in self.entries.values():
+            references = [((k >> 2) & 0xFFFFFF, k >> 26, k & 0x3)
+                          for k in entry.references]
+            yield set(entry.addrs), references
+
+    def restore(self, project, address, state, database=None):
+        """Rebuild an analysis from the cache.
+
+        database is a view to check the entry against, instead of the
+        project's database.
+        Returns an Analyser, or None if there's no valid entry for it.
+        """
+        if database is None:
+            database = project.database
+        entry = self.lookup(address, state, database)
+        if entry is None:
+            return None
+        return rebuild(project, address, state, entry, database)
+
+    def lookup(self, address, state, database):
+        """Get the entry for an analysis, if the database still matches it.
+
+        A stale entry is dropped. Pass the entry to rebuild(), which doesn't
+        need the cache, to get the Analyser.
+        Returns the Entry, or None.
+        """
+        key = make_key(address, state)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        digest = dependency_digest(
+            database, set(entry.addrs), entry.jump_tables)
+        if digest != entry.digest:
+            # The database has changed under this analysis.
+            del self.entries[key]
+            self.is_dirty = True
+            return None
+        return entry
+
+
+def rebuild(project, address, state, entry, database):
+    """Rebuild an analysis from a cache entry, against a database."""
+    analyser = dsnes.Analyser(project, database)
+    analyser.start_address = address
+    analyser.start_state = state
+    analyser.visited = set(entry.addrs)
+    bus = project.bus
+    unpack = dsnes.State.unpack
+    errors = entry.errors
+    state_of = {}
+    for idx, (addr, code) in enumerate(zip(entry.addrs, entry.states)):
+        op_state = unpack(code)
+        state_of[addr] = op_state
+        if idx in errors:
+            operation = dsnes.analyser.AnalyserError(
+                addr, op_state, errors[idx])
+        else:
+            operation = dsnes.disassemble(addr, bus, op_state)
+        analyser.operations.append(operation)
+    for call in entry.calls:
+        from_addr = call >> 24
+        analyser.calls_from[from_addr].append(
+            (call & 0xFFFFFF, state_of[from_addr]))
+    analyser.references = [((k >> 2) & 0xFFFFFF, k >> 26, k & 0x3)
+                           for k in entry.references]
+    analyser.jump_tables = dict(entry.jump_tables)
+    analyser.recollate()
+    return analyser
+
+
+class CacheSaveJob:
+    """Writes out the entries that a cache had when the job was made."""
+
+    def __init__(self, path, contents):
+        self.path = path
+        self.contents = contents
+        self.finished = False
+
+    def run(self):
+        data = zlib.compress(
+            pickle.dumps(self.contents, protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, self.path)
+        self.finished = True
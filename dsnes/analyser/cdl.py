@@ -0,0 +1,162 @@
+"""Import code/data logger (CDL) files from emulators.
+
+A CDL file has a byte of flags for every byte of the ROM, recording how the
+emulator saw it being used. The Mesen-S layout is understood: an optional
+"CDLv2" header and CRC32, then the flags.
+
+The file is memory mapped rather than read, and searched with byte pattern
+matches, so even a large ROM's log is scanned without copying it or
+looping over every byte in Python.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import mmap
+import re
+
+import dsnes
+from dsnes.analyser import codemap
+
+
+HEADER = b"CDLv2"
+# The header is followed by a CRC32 of the ROM.
+HEADER_SIZE = len(HEADER) + 4
+
+CODE = 0x01
+DATA = 0x02
+JUMP_TARGET = 0x04
+SUB_ENTRY_POINT = 0x08
+INDEX_MODE_8 = 0x10
+MEMORY_MODE_8 = 0x20
+
+
+def open_cdl(path, rom_size):
+    """Open a CDL file for a ROM of rom_size bytes.
+
+    Returns a CdlFile, which should be closed when done with.
+    """
+    cdl = CdlFile(path, rom_size)
+    cdl.open()
+    return cdl
+
+def flag_pattern(all_of, none_of=0):
+    """Make a regex that matches runs of bytes with the given flags.
+
+    Bytes must have all of the flags in all_of set, and none of the flags in
+    none_of.
+    """
+    matching = bytes(n for n in range(256)
+                     if n & all_of == all_of and not n & none_of)
+    return re.compile(b"[" + re.escape(matching) + b"]+")
+
+def state_of(flags):
+    """Get the m/x state that a byte of code flags was logged with."""
+    m = bool(flags & MEMORY_MODE_8)
+    x = bool(flags & INDEX_MODE_8)
+    # 16-bit registers are only possible in native mode.
+    e = False if not (m and x) else None
+    return dsnes.State(e=e, m=m, x=x)
+
+
+class CdlFile:
+    def __init__(self, path, rom_size):
+        self.path = path
+        self.rom_size = rom_size
+        self._file = None
+        self.data = None
+        # Where the flags start within the file.
+        self.start = 0
+
+    def open(self):
+        self._file = open(self.path, "rb")
+        try:
+            self.data = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Can't map an empty file.
+            self.close()
+            raise ValueError("{} is empty".format(self.path)) from None
+        if self.data[:len(HEADER)] == HEADER:
+            self.start = HEADER_SIZE
+        size = len(self.data) - self.start
+        if size != self.rom_size:
+            self.close()
+            raise ValueError(
+                "{} has flags for {} bytes, but the ROM is {} bytes".format(
+                    self.path, size, self.rom_size))
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def flags_at(self, offset):
+        """Get the flags for a ROM offset."""
+        return self.data[self.start + offset]
+
+    def iter_runs(self, all_of, none_of=0):
+        """Generate (start, end) ROM offsets of runs of flagged bytes.
+
+        Each run is bytes that have all of the flags in all_of and none of
+        the flags in none_of set.
+        """
+        start = self.start
+        for match in flag_pattern(all_of, none_of).finditer(
+                self.data, start):
+            yield match.start() - start, match.end() - start
+
+    def iter_offsets(self, all_of, none_of=0):
+        """Generate the ROM offsets of every flagged byte."""
+        for run_start, run_end in self.iter_runs(all_of, none_of):
+            yield from range(run_start, run_end)
+
+    def get_entry_points(self, bus, rom_device):
+        """Get the subroutine entry points that were logged.
+
+        Returns a list of (CPU address, State) with the m/x state that each
+        was entered with. Entry points that can't be seen by the CPU are
+        left out.
+        """
+        cpu_addresses = bus.get_cpu_addresses(rom_device)
+        data = self.data
+        start = self.start
+        entry_points = []
+        for offset in self.iter_offsets(CODE | SUB_ENTRY_POINT):
+            cpu_addr = cpu_addresses.get(offset, None)
+            if cpu_addr is not None:
+                entry_points.append(
+                    (cpu_addr, state_of(data[start + offset])))
+        return entry_points
+
+    def mark_codemap(self, cmap):
+        """Mark the data that was logged in a code map.
+
+        Only bytes that the code map doesn't know anything about are marked.
+        The log doesn't say where each instruction starts, so code is left
+        for analysis to mark.
+        Returns the number of bytes marked.
+        """
+        kinds = cmap.kinds
+        count = 0
+        for run_start, run_end in self.iter_runs(DATA, none_of=CODE):
+            length = run_end - run_start
+            if kinds.count(codemap.UNKNOWN, run_start, run_end) == length:
+                kinds[run_start:run_end] = bytes((codemap.DATA,)) * length
+                count += length
+            else:
+                for offset in range(run_start, run_end):
+                    if kinds[offset] == codemap.UNKNOWN:
+                        kinds[offset] = codemap.DATA
+                        count += 1
+        if count:
+            cmap.is_dirty = True
+        return count
@@ -0,0 +1,107 @@
+"""Tell the things that depend on a database what has changed in it.
+
+Every edit bumps a generation counter, and records the generation for the
+bank that it was in, so a cache can tell whether a range of addresses has
+changed since it was built by comparing a single number. Subscribers are
+also called with a list of Change events, so they can refresh only what
+was affected.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import collections
+import contextlib
+
+
+# The kinds of change.
+STATE = "state"
+STATE_DELTA = "state_delta"
+LABEL = "label"
+PRE_COMMENT = "pre_comment"
+INLINE_COMMENT = "inline_comment"
+# Anything might have changed, e.g. after changes were thrown away. The
+# address is None.
+ALL = "all"
+
+# The kind of change made by each journal record op.
+OP_KINDS = {
+    "state": STATE,
+    "state_delta": STATE_DELTA,
+    "add_label": LABEL,
+    "remove_label": LABEL,
+    "pre_comment": PRE_COMMENT,
+    "inline_comment": INLINE_COMMENT,
+}
+
+# What a change means for an analysis: its listing needs rebuilding, or it
+# needs analysing again.
+RECOLLATE = "recollate"
+REANALYSE = "reanalyse"
+
+NUM_BANKS = 0x100
+
+Change = collections.namedtuple("Change", ["kind", "addr"])
+
+
+class ChangeTracker:
+    def __init__(self):
+        # Bumped by every change.
+        self.generation = 0
+        # The generation of the last change in each bank.
+        self.bank_generations = [0] * NUM_BANKS
+        self.subscribers = []
+        # Changes waiting to be sent while held.
+        self._held = 0
+        self._queued = []
+
+    def subscribe(self, fn):
+        """Call fn with a list of Changes after every change.
+
+        Changes made while held are sent together, in one call.
+        """
+        self.subscribers.append(fn)
+
+    def unsubscribe(self, fn):
+        self.subscribers.remove(fn)
+
+    def changed(self, kind, addr):
+        """Record a change to an address, or to everything if it's None."""
+        self.generation += 1
+        if addr is None:
+            self.bank_generations = [self.generation] * NUM_BANKS
+        else:
+            self.bank_generations[addr >> 16] = self.generation
+        if self.subscribers:
+            self._queued.append(Change(kind, addr))
+            if not self._held:
+                self._send()
+
+    def copy(self):
+        """Get a tracker at the same generations, without the subscribers."""
+        tracker = ChangeTracker()
+        tracker.generation = self.generation
+        tracker.bank_generations = list(self.bank_generations)
+        return tracker
+
+    def generation_of(self, lo, hi=None):
+        """Get the generation of the last change to addresses [lo, hi]."""
+        if hi is None:
+            hi = lo
+        return max(self.bank_generations[lo >> 16:(hi >> 16) + 1])
+
+    @contextlib.contextmanager
+    def hold(self):
+        """Send the changes made in the block together, at the end of it."""
+        self._held += 1
+        try:
+            yield
+        finally:
+            self._held -= 1
+            if not self._held and self._queued:
+                self._send()
+
+    def _send(self):
+        queued = self._queued
+        self._queued = []
+        for fn in list(self.subscribers):
+            fn(queued)
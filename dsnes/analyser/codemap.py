@@ -0,0 +1,277 @@
+"""Per-byte map of what each byte of the ROM is used for.
+
+Every analysis marks the ROM bytes that it decoded as code, the jump tables
+that it read as pointers, and the ROM that it saw being read as data. This
+makes it cheap to ask whether a byte is already known code, to measure how
+much of each bank has been covered, and to spot two analyses that disagree
+about where an instruction starts.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import os
+
+import dsnes
+from dsnes.analyser import xref
+
+
+FILENAME = "codemap.bin"
+MAGIC = b"DSCM"
+# Bump this whenever the layout of the file changes.
+VERSION = 1
+
+UNKNOWN = 0
+OPCODE = 1
+OPERAND = 2
+DATA = 3
+POINTER = 4
+
+KIND_NAMES = {
+    UNKNOWN: "unknown",
+    OPCODE: "opcode",
+    OPERAND: "operand",
+    DATA: "data",
+    POINTER: "pointer",
+}
+
+# The State.pack() bits for e, m and x, which decide instruction lengths.
+LENGTH_STATE_MASK = 0x3F
+
+
+def load(project):
+    """Load the code map for a project.
+
+    Returns an empty map if there isn't one, or if it was made for a
+    different ROM.
+    """
+    codemap = CodeMap(project.bus, project.cartridge.rom, project.rom_hash)
+    codemap.load(os.path.join(project.path, FILENAME))
+    return codemap
+
+
+class CodeMap:
+    def __init__(self, bus, rom, rom_hash=None):
+        self.bus = bus
+        self.rom = rom
+        self.rom_hash = rom_hash
+        size = rom.size if rom is not None else 0
+        self.size = size
+        # The kind of each ROM byte.
+        self.kinds = bytearray(size)
+        # The packed e/m/x/c state that each opcode was decoded with.
+        self.states = bytearray(size)
+        # ROM offsets where two analyses disagree about an instruction.
+        self.conflicts = set()
+        self.is_dirty = False
+        # The file that the map was loaded from.
+        self.path = None
+        if rom is None:
+            self.rom_device = None
+        else:
+            self.rom_device = bus.device_for(rom.read)
+
+    def rom_offset(self, addr):
+        """Get the ROM offset that a CPU address maps to, or None."""
+        try:
+            device, offset = self.bus.resolve(addr)
+        except dsnes.UnmappedMemoryAccess:
+            return None
+        if device != self.rom_device:
+            return None
+        return offset
+
+    def kind_at(self, addr):
+        """Get the kind of the ROM byte at a CPU address.
+
+        Returns UNKNOWN for addresses that aren't in ROM.
+        """
+        offset = self.rom_offset(addr)
+        if offset is None:
+            return UNKNOWN
+        return self.kinds[offset]
+
+    def is_code(self, addr):
+        """Check if the byte at a CPU address is known to be code."""
+        return self.kind_at(addr) in (OPCODE, OPERAND)
+
+    def is_opcode(self, addr):
+        """Check if an instruction is known to start at a CPU address."""
+        return self.kind_at(addr) == OPCODE
+
+    def state_at(self, addr):
+        """Get the State that the opcode at a CPU address was decoded with.
+
+        Returns None if no opcode is known to start there.
+        """
+        offset = self.rom_offset(addr)
+        if offset is None or self.kinds[offset] != OPCODE:
+            return None
+        return dsnes.State.unpack(self.states[offset])
+
+    def add_analysis(self, analyser):
+        """Mark everything that an analysis found."""
+        self.add_operations(analyser.operations)
+        for table_addr, targets in analyser.jump_tables.values():
+            self.mark_pointers(table_addr, 2, len(targets))
+
+    def add_operations(self, operations):
+        """Mark disassembled operations, and the ROM that they read."""
+        AnalyserError = dsnes.analyser.AnalyserError
+        for operation in operations:
+            if isinstance(operation, AnalyserError):
+                continue
+            self.mark_instruction(
+                operation.addr, len(operation.raw), operation.state)
+            self._mark_access(operation)
+
+    def mark_instruction(self, addr, length, state):
+        """Mark the bytes of an instruction as code.
+
+        An instruction that overlaps a different instruction, or that was
+        decoded with a different e/m/x state, is recorded as a conflict. The
+        newest marking wins.
+        """
+        kinds = self.kinds
+        pbr = addr & 0xFF0000
+        packed = state.pack() & 0xFF
+        for n in range(length):
+            offset = self.rom_offset(pbr | ((addr + n) & 0xFFFF))
+            if offset is None:
+                continue
+            old_kind = kinds[offset]
+            if n == 0:
+                if old_kind == OPCODE:
+                    old_bits = self.states[offset] & LENGTH_STATE_MASK
+                    if old_bits != packed & LENGTH_STATE_MASK:
+                        self.conflicts.add(offset)
+                elif old_kind == OPERAND:
+                    self.conflicts.add(offset)
+                kinds[offset] = OPCODE
+                self.states[offset] = packed
+            else:
+                if old_kind == OPCODE:
+                    self.conflicts.add(offset)
+                kinds[offset] = OPERAND
+        self.is_dirty = True
+
+    def mark_pointers(self, addr, width, count):
+        """Mark count pointers of width bytes, starting at addr.
+
+        Bytes that are already known to be code are left alone.
+        """
+        pbr = addr & 0xFF0000
+        self._mark_unless_code(
+            (pbr | ((addr + n) & 0xFFFF) for n in range(width * count)),
+            POINTER)
+
+    def mark_data(self, addr, length=1):
+        """Mark bytes as data, unless they're already known to be more."""
+        kinds = self.kinds
+        for n in range(length):
+            offset = self.rom_offset(addr + n)
+            if offset is not None and kinds[offset] == UNKNOWN:
+                kinds[offset] = DATA
+                self.is_dirty = True
+
+    def _mark_unless_code(self, addresses, kind):
+        kinds = self.kinds
+        for a in addresses:
+            offset = self.rom_offset(a)
+            if offset is not None and kinds[offset] not in (OPCODE, OPERAND):
+                kinds[offset] = kind
+                self.is_dirty = True
+
+    def _mark_access(self, operation):
+        target = operation.target_info.addr
+        if target is None:
+            return
+        info = dsnes.disassembler.codes[operation.raw[0]]
+        if isinstance(info, dsnes.disassembler.AbsXInd):
+            # Jump tables are marked separately.
+            return
+        if isinstance(info, dsnes.disassembler.JumpAbsInd):
+            self.mark_pointers(target, 2, 1)
+        elif isinstance(info, dsnes.disassembler.JumpAbsIndLong):
+            self.mark_pointers(target, 3, 1)
+        elif xref.access_kind(operation) == xref.READ:
+            self.mark_data(target)
+
+    def coverage(self, bank_size=0x8000):
+        """Get the fraction of each bank of ROM that isn't unknown.
+
+        Returns a list with an entry for each bank_size chunk of the ROM.
+        """
+        kinds = self.kinds
+        result = []
+        for start in range(0, self.size, bank_size):
+            end = min(start + bank_size, self.size)
+            unknown = kinds.count(UNKNOWN, start, end)
+            result.append(1 - unknown / (end - start))
+        return result
+
+    def load(self, path):
+        """Load the map from a file, if it matches this ROM."""
+        self.path = path
+        self.is_dirty = False
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            return
+        header = self._header()
+        expected_size = len(header) + self.size * 2
+        if data[:len(header)] != header or len(data) != expected_size:
+            # Made for something else; start again.
+            return
+        body = data[len(header):]
+        self.kinds[:] = body[:self.size]
+        self.states[:] = body[self.size:]
+        self.conflicts = set()
+
+    def save(self, path=None):
+        """Write the map to a file, if anything has changed.
+
+        By default it's written to the file it was loaded from.
+        """
+        job = self.prepare_save(path)
+        if job is not None:
+            job.run()
+
+    def prepare_save(self, path=None):
+        """Copy the map, and return a CodeMapSaveJob that writes it.
+
+        Returns None if nothing has changed. The job can be run on another
+        thread. If it fails, pass it to restore_unsaved().
+        """
+        if not self.is_dirty:
+            return None
+        self.is_dirty = False
+        return CodeMapSaveJob(
+            path or self.path,
+            self._header() + bytes(self.kinds) + bytes(self.states))
+
+    def restore_unsaved(self, job):
+        """Mark the map as needing saving again after a job failed."""
+        if not job.finished:
+            self.is_dirty = True
+
+    def _header(self):
+        rom_hash = (self.rom_hash or "").encode("ascii")
+        return b"".join((MAGIC, bytes((VERSION, len(rom_hash))), rom_hash,
+                         self.size.to_bytes(4, "little")))
+
+
+class CodeMapSaveJob:
+    """Writes out a copy of a code map."""
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.finished = False
+
+    def run(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(self.data)
+        os.replace(tmp_path, self.path)
+        self.finished = True
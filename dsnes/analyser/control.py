@@ -0,0 +1,126 @@
+"""Observe, bound and interrupt a running analysis.
+
+An AnalysisControl is handed to Analyser.analyse_function(). The analyser
+reports progress to it and asks it whether to carry on, so a caller can put
+a limit on how long an analysis of a pathological ROM is allowed to take.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import time
+
+
+# Reasons that an analysis stopped early.
+CANCELLED = "cancelled"
+INSTRUCTION_BUDGET = "instruction budget"
+TIME_BUDGET = "time budget"
+BREAKPOINT = "breakpoint"
+
+# How many instructions to decode between progress reports and clock checks.
+CHECK_INTERVAL = 1024
+
+
+class AnalysisControl:
+    """Progress reporting, budgets and cancellation for an analysis.
+
+    progress_fn is called as progress_fn(instructions, queue_depth) every
+    check_interval instructions, and once more when the analysis finishes.
+    max_instructions and max_seconds bound the work that the analysis does.
+    With time_phases, the analysis times each instruction's database
+    lookups, state and decoding for its AnalysisStats.
+    Cancellation is cooperative: cancel() can be called from a progress
+    function, a breakpoint hook or another thread, and the analysis stops
+    at the next block or the next check, whichever comes first.
+    """
+
+    def __init__(self, progress_fn=None, max_instructions=None,
+                 max_seconds=None, check_interval=CHECK_INTERVAL,
+                 time_phases=False):
+        self.progress_fn = progress_fn
+        self.max_instructions = max_instructions
+        self.max_seconds = max_seconds
+        self.check_interval = check_interval
+        self.time_phases = time_phases
+        # Dict of address:hook function.
+        self.breakpoints = {}
+        self.cancelled = False
+        self.instructions = 0
+        self.deadline = None
+        self._next_check = check_interval
+
+    def add_breakpoint(self, address, hook=None):
+        """Break when the analysis is about to reach an address.
+
+        hook is called as hook(analyser, from_address, to_address), before
+        the instruction at to_address is decoded. The analysis stops if the
+        hook returns a true value. Without a hook the analysis always stops.
+        """
+        self.breakpoints[address] = hook
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.pop(address, None)
+
+    def cancel(self):
+        """Ask the analysis to stop at the next block or check."""
+        self.cancelled = True
+
+    def start(self):
+        """Called by the analyser when an analysis starts."""
+        self.cancelled = False
+        self.instructions = 0
+        self._next_check = self.check_interval
+        if self.max_seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + self.max_seconds
+
+    def step(self, queue_depth):
+        """Called by the analyser after each instruction is decoded.
+
+        Returns the reason to stop, or None to carry on.
+        """
+        self.instructions += 1
+        count = self.instructions
+        if (self.max_instructions is not None
+                and count >= self.max_instructions):
+            return INSTRUCTION_BUDGET
+        if count >= self._next_check:
+            self._next_check = count + self.check_interval
+            if self.progress_fn is not None:
+                self.progress_fn(count, queue_depth)
+            if self.cancelled:
+                return CANCELLED
+            return self._check_time()
+        return None
+
+    def block(self, queue_depth):
+        """Called by the analyser before it starts walking each block.
+
+        Returns the reason to stop, or None to carry on.
+        """
+        if self.cancelled:
+            return CANCELLED
+        return self._check_time()
+
+    def transfer(self, analyser, from_address, to_address):
+        """Called by the analyser when control can pass to another address.
+
+        Returns the reason to stop, or None to carry on.
+        """
+        try:
+            hook = self.breakpoints[to_address]
+        except LookupError:
+            return None
+        if hook is None or hook(analyser, from_address, to_address):
+            return BREAKPOINT
+        return None
+
+    def finish(self, queue_depth):
+        """Called by the analyser when an analysis ends, for any reason."""
+        if self.progress_fn is not None:
+            self.progress_fn(self.instructions, queue_depth)
+
+    def _check_time(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return TIME_BUDGET
+        return None
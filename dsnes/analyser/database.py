@@ -1,19 +1,36 @@
 # Copyright 2017 Adrian Chan
 # Licensed under GPLv3
 
+from bisect import bisect_right, insort
+import collections
+import contextlib
+import copy
+import hashlib
+import os
+import pickle
+
 import toml
 
 import dsnes
+from dsnes.analyser import batch, changes, journal, labelindex, rwlock
+
 
+# The sidecar holds the parsed contents of the TOML file.
+SIDECAR_SUFFIX = ".cache"
+# Bump this whenever the layout of the sidecar changes.
+SIDECAR_VERSION = 1
 
 def load(path):
     db = Database()
     db.load(path)
     return db
 
-def encode_address_key(addr):
+def check_address(addr):
     assert addr > 0
     assert addr <= 0xFFFFFF
+
+def encode_address_key(addr):
+    check_address(addr)
     pbr = (addr & 0xFF0000) >> 16
     pc = addr & 0x00FFFF
     return "{:02x}:{:04x}".format(pbr, pc)
@@ -28,63 +45,153 @@ def parse_address_key(key):
     assert pc <= 0xFFFF
     return (pbr << 16) + pc
 
+def find_duplicate_keys(keys):
+    """Get the addresses that more than one of some "bb:pppp" keys are for.
+
+    Returns a sorted list, which is empty if there are none.
+    """
+    addresses = [parse_address_key(key) for key in keys]
+    if len(set(addresses)) == len(addresses):
+        return []
+    counts = collections.Counter(addresses)
+    return sorted(addr for addr, count in counts.items() if count > 1)
+
 
 class Database:
+    """Annotations for a project, keyed by CPU address.
+
+    Everything is held in int-keyed dicts while the project is open. The
+    TOML file's "bb:pppp" string keys are only dealt with by load() and
+    compact(). States and state deltas are kept as the strings they were
+    loaded as until they're first looked up, as most are never needed;
+    check() parses them all up front.
+    Edits are made under the write lock. Another thread that wants to read
+    while this one edits should take a view().
+    Saving appends the changes made since the last save to a journal next
+    to the TOML file, which is compacted into the TOML file once it gets
+    long.
+    """
+
+    # The tables in the database file.
+    TABLES = ("states", "state_deltas", "labels", "pre_comments",
+              "inline_comments")
+    # Compact the journal once it has this many records.
+    COMPACT_AFTER = 1000
+
     def __init__(self):
         self.path = None
         self.is_dirty = False
-        self.data = {}
+        # Anything in the file that isn't one of the TABLES, to be written
+        # back out untouched.
+        self.extra_data = {}
         self.state_cache = {}
         self.state_delta_cache = {}
         self.labels_of_address = {}
         self.address_of_label = {}
+        # Sorted list of the addresses that have labels.
+        self.label_addresses = []
+        self.label_index = labelindex.LabelIndex()
+        self.pre_comments = {}
+        self.inline_comments = {}
+        self.journal = None
+        # Journal records for the changes that haven't been saved.
+        self.pending = []
+        self._replaying = False
+        self.changes = changes.ChangeTracker()
+        self.lock = rwlock.RWLock()
+        # Whether this is a read-only copy made by view().
+        self.is_view = False
 
     def get_state(self, addr):
         state = self.state_cache.get(addr, None)
-        if state is not None:
-            return state.clone()
-        else:
+        if state is None:
             return None
+        if isinstance(state, str):
+            state = self._parse_state(addr, state)
+        return state.clone()
 
+    def _parse_state(self, addr, text):
+        """Parse a state that was loaded as a string, and keep the result."""
+        try:
+            state = dsnes.State.parse(text)
+        except ValueError:
+            state = None
+        if state is None:
+            raise ValueError("State {!r} for {} is not valid".format(
+                text, encode_address_key(addr)))
+        self.state_cache[addr] = state
+        return state
+
+    def get_state_strings(self, addresses):
+        """Get the encoded states for many addresses at once.
+
+        Returns a dict of {address: encoded_state}. Addresses without a
+        state are left out of the dict. A state that isn't valid is given
+        as it was stored.
+        """
+        return {addr: _encoded(self.get_state, addr, value)
+                for addr, value in _get_many(self.state_cache, addresses)}
+
+    @rwlock.writes
     def set_state(self, addr, state):
-        key = encode_address_key(addr)
         if addr in self.state_delta_cache:
             raise ValueError("Cannot set both an absolute and a delta state "
-                "for {}".format(key))
+                "for {}".format(encode_address_key(addr)))
+        check_address(addr)
         s = state.encode()
         assert s is not None
         self.state_cache[addr] = state.clone()
-        self.data["states"][key] = s
-        self.is_dirty = True
+        self._log("state", addr, s)
 
+    @rwlock.writes
     def remove_state(self, addr):
-        key = encode_address_key(addr)
         del self.state_cache[addr]
-        del self.data["states"][key]
-        self.is_dirty = True
+        self._log("state", addr, None)
 
     def get_state_delta(self, addr):
         delta = self.state_delta_cache.get(addr, None)
-        if delta:
-            return delta.clone()
-        else:
+        if not delta:
             return None
+        if isinstance(delta, str):
+            delta = self._parse_state_delta(addr, delta)
+        return delta.clone()
 
+    def _parse_state_delta(self, addr, text):
+        """Parse a delta that was loaded as a string, and keep the result."""
+        try:
+            delta = dsnes.StateDelta.parse(text)
+        except ValueError:
+            delta = None
+        if delta is None:
+            raise ValueError("State delta {!r} for {} is not valid".format(
+                text, encode_address_key(addr)))
+        self.state_delta_cache[addr] = delta
+        return delta
+
+    def get_state_delta_strings(self, addresses):
+        """Get the encoded state deltas for many addresses at once.
+
+        Returns a dict of {address: encoded_delta}. Addresses without a
+        delta are left out of the dict. A delta that isn't valid is given
+        as it was stored.
+        """
+        return {addr: _encoded(self.get_state_delta, addr, value)
+                for addr, value in _get_many(self.state_delta_cache,
+                                             addresses)}
+
+    @rwlock.writes
     def set_state_delta(self, addr, delta):
-        key = encode_address_key(addr)
         if addr in self.state_cache:
             raise ValueError("Cannot set both an absolute and a delta state "
-                "for {}".format(key))
-        s = delta.encode()
+                "for {}".format(encode_address_key(addr)))
+        check_address(addr)
         self.state_delta_cache[addr] = delta
-        self.data["state_deltas"][key] = s
-        self.is_dirty = True
+        self._log("state_delta", addr, delta.encode())
 
+    @rwlock.writes
     def remove_state_delta(self, addr):
-        key = encode_address_key(addr)
         del self.state_delta_cache[addr]
-        del self.data["state_deltas"][key]
-        self.is_dirty = True
+        self._log("state_delta", addr, None)
 
     def get_label(self, addr):
         """Get the first label for a given address."""
@@ -99,46 +206,86 @@ class Database:
         labels = self.labels_of_address.get(addr, [])
         return labels[:]
 
+    def get_labels_for_addresses(self, addresses):
+        """Get all labels for many addresses at once.
+
+        Returns a dict of {address: [labels]}. Addresses without labels are
+        left out of the dict.
+        """
+        return {addr: labels[:]
+                for addr, labels
+                in _get_many(self.labels_of_address, addresses)}
+
     def get_all_labels(self):
         """Get all labels in use."""
-        labels = [x for x in self.address_of_label.keys()]
-        return labels[:]
+        return list(self.address_of_label)
+
+    def has_label(self, label):
+        """Check if a label is in use."""
+        return label in self.address_of_label
+
+    def complete_label(self, prefix, limit=None):
+        """Get the labels that start with prefix, in sorted order."""
+        return self.label_index.complete(prefix, limit)
+
+    def search_labels(self, text, limit=None):
+        """Get the labels that roughly match some text, best first."""
+        return self.label_index.search(text, limit)
 
     def get_address_with_label(self, label):
         """Get the address that the label applies to."""
         return self.address_of_label.get(label, None)
 
+    def nearest_label(self, addr, max_offset=None):
+        """Get the closest label at or before an address, in the same bank.
+
+        Labels more than max_offset bytes before the address are ignored.
+        Returns (label_address, label), or None.
+        """
+        addresses = self.label_addresses
+        idx = bisect_right(addresses, addr) - 1
+        if idx < 0:
+            return None
+        label_addr = addresses[idx]
+        if (label_addr & 0xFF0000) != (addr & 0xFF0000):
+            return None
+        if max_offset is not None and addr - label_addr > max_offset:
+            return None
+        return label_addr, self.labels_of_address[label_addr][0]
+
+    @rwlock.writes
     def add_label(self, addr, label):
         """Add a label to an address."""
-        if label in self.get_all_labels():
+        if label in self.address_of_label:
             raise ValueError("Label {!r} is already in use".format(label))
-        key = encode_address_key(addr)
+        check_address(addr)
         self._register_label(addr, label)
+        self._log("add_label", addr, label)
 
-        labels = self.data["labels"]
-        try:
-            lst = labels[key]
-        except LookupError:
-            lst = []
-            labels[key] = lst
-        lst.append(label)
-        self.is_dirty = True
+    def _register_label(self, addr, label, index=True):
+        """Register the label in the internal lookups.
 
-    def _register_label(self, addr, label):
-        """Register the label in the internal lookups."""
+        index is False if the label is already in the label index.
+        """
         if label in self.address_of_label:
             raise ValueError(
                 "Label {!r} has already been used for 0x{:06x}".format(
                     label, self.address_of_label[label]))
         self.address_of_label[label] = addr
+        if index:
+            self.label_index.add(label)
 
+        # The lists are replaced rather than changed, so that a snapshot
+        # can share them.
         if addr not in self.labels_of_address:
             self.labels_of_address[addr] = [label]
+            insort(self.label_addresses, addr)
         else:
             lst = self.labels_of_address[addr]
             assert label not in lst
-            lst.append(label)
+            self.labels_of_address[addr] = lst + [label]
 
+    @rwlock.writes
     def remove_label(self, addr, label):
         """Remove a label from an address."""
         stored_address = self.address_of_label.get(label, None)
@@ -149,91 +296,436 @@ class Database:
             raise ValueError(
                 "Label {!r} is not applied to the address {}".format(
                     label, addr))
-        key = encode_address_key(addr)
 
-        label_list = self.data["labels"][key]
-        label_list.remove(label)
-        if len(label_list) == 0:
-            del self.data["labels"][key]
         del self.address_of_label[label]
-        label_list = self.labels_of_address[addr]
-        label_list.remove(label)
-        if len(label_list) == 0:
+        self.label_index.remove(label)
+        label_list = [x for x in self.labels_of_address[addr] if x != label]
+        if label_list:
+            self.labels_of_address[addr] = label_list
+        else:
             del self.labels_of_address[addr]
+            addresses = self.label_addresses
+            del addresses[bisect_right(addresses, addr) - 1]
 
-        self.is_dirty = True
+        self._log("remove_label", addr, label)
 
     def get_pre_comment(self, addr):
         """Get the pre-instruction comment for an address."""
-        key = encode_address_key(addr)
-        return self.data["pre_comments"].get(key, None)
+        return self.pre_comments.get(addr, None)
+
+    def get_pre_comments(self, addresses):
+        """Get the pre-instruction comments for many addresses at once.
+
+        Returns a dict of {address: comment}. Addresses without a comment
+        are left out of the dict.
+        """
+        return dict(_get_many(self.pre_comments, addresses))
 
+    @rwlock.writes
     def set_pre_comment(self, addr, comment):
         assert comment is not None
-        key = encode_address_key(addr)
-        self.data["pre_comments"][key] = comment
-        self.is_dirty = True
+        check_address(addr)
+        self.pre_comments[addr] = comment
+        self._log("pre_comment", addr, comment)
 
+    @rwlock.writes
     def delete_pre_comment(self, addr):
-        key = encode_address_key(addr)
-        del self.data["pre_comments"][key]
-        self.is_dirty = True
+        del self.pre_comments[addr]
+        self._log("pre_comment", addr, None)
 
     def get_inline_comment(self, addr):
         """Get the inline comment for an address."""
-        key = encode_address_key(addr)
-        return self.data["inline_comments"].get(key, None)
+        return self.inline_comments.get(addr, None)
+
+    def get_inline_comments(self, addresses):
+        """Get the inline comments for many addresses at once.
 
+        Returns a dict of {address: comment}. Addresses without a comment
+        are left out of the dict.
+        """
+        return dict(_get_many(self.inline_comments, addresses))
+
+    @rwlock.writes
     def set_inline_comment(self, addr, comment):
         assert comment is not None
-        key = encode_address_key(addr)
-        self.data["inline_comments"][key] = comment
-        self.is_dirty = True
+        check_address(addr)
+        self.inline_comments[addr] = comment
+        self._log("inline_comment", addr, comment)
 
+    @rwlock.writes
     def delete_inline_comment(self, addr):
-        key = encode_address_key(addr)
-        del self.data["inline_comments"][key]
+        del self.inline_comments[addr]
+        self._log("inline_comment", addr, None)
+
+    def check(self):
+        """Check every state and state delta, parsing those not yet parsed.
+
+        Raises ValueError for the first one that isn't valid, or for an
+        address that has both.
+        """
+        for addr, value in list(self.state_cache.items()):
+            if isinstance(value, str):
+                self._parse_state(addr, value)
+        for addr, value in list(self.state_delta_cache.items()):
+            if isinstance(value, str):
+                self._parse_state_delta(addr, value)
+        _check_exclusive(self.state_cache, self.state_delta_cache)
+
+    def _log(self, op, addr, value):
+        """Record a change, to be written to the journal on save."""
         self.is_dirty = True
-
+        if not self._replaying:
+            self.pending.append({"op": op, "addr": addr, "value": value})
+        self.changes.changed(changes.OP_KINDS[op], addr)
+
+    def _replay(self, record):
+        """Apply a change that was read back from the journal."""
+        batch.apply_record(self, record)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect edits, and make them all at once at the end of the block.
+
+        Yields a Batch to make the edits on. Nothing is changed if the block
+        raises an exception, or if any of the edits can't be made.
+        """
+        edits = batch.Batch()
+        yield edits
+        self.apply_batch(edits)
+
+    @rwlock.writes
+    def apply_batch(self, edits):
+        """Make every edit in a Batch, or none of them.
+
+        Raises ValueError if any of the edits can't be made.
+        """
+        edits.validate(self)
+        with self.changes.hold():
+            for record in edits:
+                batch.apply_record(self, record)
+
+    @rwlock.writes
     def load(self, path):
         self.path = path
-        self.data = toml.load(path)
         self.is_dirty = False
+        # The last journal record that the snapshot includes.
+        snapshot_seq = self._load_snapshot(path)
 
-        self.state_cache = state_cache = {}
-        for key, value in self.data["states"].items():
-            addr = parse_address_key(key)
-            state = dsnes.State.parse(value)
-            assert state is not None
-            # Database should not contain multiple definitions for an address.
-            if addr in state_cache:
-                raise ValueError(
-                    "State for {} has already been declared".format(key))
-            state_cache[addr] = state
-
-        self.state_delta_cache = delta_cache = {}
-        for key, value in self.data["state_deltas"].items():
-            addr = parse_address_key(key)
-            delta = dsnes.StateDelta.parse(value)
-            assert delta is not None
-            # Database should not contain multiple definitions for an address.
-            if addr in delta_cache:
-                raise ValueError(
-                    "State delta for {} has already been declared".format(key))
-            if addr in state_cache:
-                raise ValueError("Cannot set both an absolute and a delta "
-                    "state for {}".format(key))
-            delta_cache[addr] = delta
+        # Bring the snapshot up to date.
+        self.journal = journal.Journal(path + journal.SUFFIX)
+        self.pending = []
+        self._replaying = True
+        try:
+            for record in self.journal.read(snapshot_seq):
+                self._replay(record)
+        finally:
+            self._replaying = False
+        self.is_dirty = False
+
+    def _load_snapshot(self, path):
+        """Load the TOML file, or its sidecar if that's up to date.
+
+        Returns the last journal record that the snapshot includes.
+        """
+        stat = os.stat(path)
+        sidecar = _read_sidecar(path + SIDECAR_SUFFIX)
+        raw = None
+        if sidecar is not None and (
+                sidecar["mtime_ns"] != stat.st_mtime_ns
+                or sidecar["size"] != stat.st_size):
+            # Touched, but maybe not changed.
+            with open(path, "rb") as infile:
+                raw = infile.read()
+            if hashlib.sha1(raw).hexdigest() != sidecar["sha1"]:
+                sidecar = None
+            else:
+                # Record the new mtime and size, so the next load doesn't
+                # read and hash the file again.
+                self._write_sidecar(stat, sidecar["sha1"],
+                                    sidecar["journal_seq"], sidecar["tables"])
+        if sidecar is not None:
+            self._restore_tables(sidecar["tables"])
+            return sidecar["journal_seq"]
+
+        if raw is None:
+            with open(path, "rb") as infile:
+                raw = infile.read()
+        data = toml.loads(raw.decode("utf-8"))
+        snapshot_seq = self._parse_tables(data)
+        self._write_sidecar(stat, hashlib.sha1(raw).hexdigest(), snapshot_seq)
+        return snapshot_seq
+
+    def _parse_tables(self, data):
+        """Fill the lookups from the TOML file's data.
+
+        Returns the last journal record that the data includes.
+        """
+        self.extra_data = {key: value for key, value in data.items()
+                           if key not in self.TABLES}
+        snapshot_seq = self.extra_data.pop("journal_seq", 0)
+
+        # Parsed when they're first looked up.
+        self.state_cache = _key_by_address(data["states"], "State")
+        self.state_delta_cache = _key_by_address(
+            data["state_deltas"], "State delta")
+        _check_exclusive(self.state_cache, self.state_delta_cache)
 
         self.labels_of_address = {}
         self.address_of_label = {}
-        for key, labels in self.data["labels"].items():
+        self.label_addresses = []
+        self.label_index = labelindex.LabelIndex()
+        for key, labels in data["labels"].items():
             addr = parse_address_key(key)
             for label in labels:
                 self._register_label(addr, label)
 
+        self.pre_comments = {parse_address_key(key): value
+                             for key, value in data["pre_comments"].items()}
+        self.inline_comments = {
+            parse_address_key(key): value
+            for key, value in data["inline_comments"].items()}
+        return snapshot_seq
+
+    def _restore_tables(self, tables):
+        """Fill the lookups from the tables saved in a sidecar."""
+        (self.extra_data, self.state_cache, self.state_delta_cache,
+            self.labels_of_address, self.pre_comments,
+            self.inline_comments) = tables
+        self.address_of_label = {
+            label: addr
+            for addr, labels in self.labels_of_address.items()
+            for label in labels}
+        self.label_addresses = sorted(self.labels_of_address)
+        self.label_index = labelindex.LabelIndex(self.address_of_label)
+
+    def _write_sidecar(self, stat, sha1, snapshot_seq, tables=None):
+        """Save the parsed lookups, to load quickly next time.
+
+        Must only be called when the lookups (or the snapshot of them in
+        tables) match the TOML file exactly.
+        """
+        if tables is None:
+            tables = self.snapshot()
+        sidecar = {
+            "version": SIDECAR_VERSION,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": sha1,
+            "journal_seq": snapshot_seq,
+            "tables": tables,
+        }
+        sidecar_path = self.path + SIDECAR_SUFFIX
+        tmp_path = sidecar_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as outfile:
+                pickle.dump(sidecar, outfile,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, sidecar_path)
+        except OSError:
+            # Only makes loading slower next time.
+            pass
+
+    def snapshot(self):
+        """Get a copy of the tables that later edits won't change.
+
+        Only the dicts are copied. The values in them are never changed in
+        place, so they are shared with the live tables.
+        """
+        return (dict(self.extra_data), dict(self.state_cache),
+                dict(self.state_delta_cache), dict(self.labels_of_address),
+                dict(self.pre_comments), dict(self.inline_comments))
+
+    def view(self):
+        """Get a read-only copy of the database, that later edits won't change.
+
+        For reading on another thread while this one carries on editing.
+        Like snapshot(), only the dicts are copied. The label index is
+        shared, so label searches on the view see the latest labels.
+        """
+        with self.lock.read():
+            view = copy.copy(self)
+            (view.extra_data, view.state_cache, view.state_delta_cache,
+                view.labels_of_address, view.pre_comments,
+                view.inline_comments) = self.snapshot()
+            view.address_of_label = dict(self.address_of_label)
+            view.label_addresses = list(self.label_addresses)
+            view.changes = self.changes.copy()
+        view.journal = None
+        view.pending = []
+        view.lock = rwlock.ReadOnlyLock()
+        view.is_view = True
+        return view
+
+    def to_toml_data(self, tables=None):
+        """Get the database in the string-keyed layout of the TOML file.
+
+        tables is a snapshot to use instead of the live tables.
+        """
+        if tables is None:
+            tables = self.snapshot()
+        (extra_data, state_cache, state_delta_cache, labels_of_address,
+            pre_comments, inline_comments) = tables
+        data = dict(extra_data)
+        data["states"] = _encode_table(state_cache, encode_state)
+        data["state_deltas"] = _encode_table(state_delta_cache, encode_state)
+        data["labels"] = _encode_table(labels_of_address, list)
+        data["pre_comments"] = _encode_table(pre_comments)
+        data["inline_comments"] = _encode_table(inline_comments)
+        return data
+
     def save(self):
-        path = self.path
-        with open(path, 'w') as outfile:
-            toml.dump(self.data, outfile)
+        """Save the changes made since the last save.
+
+        Only the changes are written, to the journal. The journal is
+        compacted into the TOML file once it's long enough.
+        """
+        self.prepare_save().run()
+
+    def compact(self):
+        """Write the whole database to the TOML file, and empty the journal.
+
+        The TOML file is replaced atomically, and records the last journal
+        record that it includes, so a crash at any point leaves a database
+        that loads with every saved change.
+        """
+        self.prepare_save(compact=True).run()
+
+    @rwlock.writes
+    def prepare_save(self, compact=False):
+        """Take what needs saving, and return a SaveJob that writes it.
+
+        The job can be run on another thread while the database carries on
+        being edited. Jobs must be run one at a time, in the order they
+        were made. The database counts as saved as soon as the job is made;
+        if the job fails, pass it to restore_unsaved().
+        """
+        records = self.pending
+        self.pending = []
         self.is_dirty = False
+        if (compact or
+                self.journal.length + len(records) >= self.COMPACT_AFTER):
+            tables = self.snapshot()
+        else:
+            tables = None
+        return SaveJob(self, records, tables)
+
+    @rwlock.writes
+    def restore_unsaved(self, job):
+        """Take back the changes from a SaveJob that failed."""
+        if not job.appended:
+            self.pending[:0] = job.records
+            self.is_dirty = True
+
+    def _write_snapshot(self, tables):
+        """Write a snapshot of the tables to the TOML file."""
+        path = self.path
+        data = self.to_toml_data(tables)
+        if self.journal.seq:
+            data["journal_seq"] = self.journal.seq
+        raw = toml.dumps(data).encode("utf-8")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(raw)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, path)
+        self._write_sidecar(
+            os.stat(path), hashlib.sha1(raw).hexdigest(), self.journal.seq,
+            tables)
+        self.journal.clear()
+
+
+class SaveJob:
+    """Writes out the changes that a database had when the job was made."""
+
+    def __init__(self, database, records, tables):
+        self.database = database
+        # Journal records to append.
+        self.records = records
+        # Snapshot to compact the journal into, or None.
+        self.tables = tables
+        # Whether the records made it into the journal.
+        self.appended = False
+
+    def run(self):
+        database = self.database
+        database.journal.append(self.records)
+        self.appended = True
+        if self.tables is not None:
+            database._write_snapshot(self.tables)
+
+
+def _read_sidecar(path):
+    """Read a sidecar file, or return None if it can't be used."""
+    try:
+        with open(path, "rb") as infile:
+            sidecar = pickle.load(infile)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError,
+            TypeError, AttributeError, ImportError):
+        return None
+    if not isinstance(sidecar, dict):
+        return None
+    if sidecar.get("version") != SIDECAR_VERSION:
+        return None
+    return sidecar
+
+def encode_state(value):
+    """Encode a State or StateDelta, or the string it was loaded as."""
+    if isinstance(value, str):
+        return value
+    return value.encode()
+
+def _key_by_address(table, what):
+    """Convert a TOML table to an int-keyed dict.
+
+    Raises ValueError if two keys are for the same address.
+    """
+    converted = {parse_address_key(key): value
+                 for key, value in table.items()}
+    if len(converted) != len(table):
+        addr = find_duplicate_keys(table)[0]
+        raise ValueError("{} for {} has already been declared".format(
+            what, encode_address_key(addr)))
+    return converted
+
+def _check_exclusive(state_cache, delta_cache):
+    """Raise ValueError if any address has both a state and a delta."""
+    both = state_cache.keys() & delta_cache.keys()
+    if both:
+        raise ValueError("Cannot set both an absolute and a delta state "
+            "for {}".format(encode_address_key(min(both))))
+
+def _get_many(table, addresses):
+    """Generate (address, value) for the addresses that are in a table.
+
+    Works from whichever side is smaller, so a handful of comments costs
+    a handful of lookups however long the listing is.
+    """
+    if not isinstance(addresses, (set, frozenset, dict)):
+        addresses = set(addresses)
+    if len(table) < len(addresses):
+        for addr, value in table.items():
+            if addr in addresses:
+                yield addr, value
+    else:
+        for addr in addresses:
+            value = table.get(addr, None)
+            if value is not None:
+                yield addr, value
+
+def _encoded(get, addr, value):
+    """Encode a state or delta from a table, or give its text if it's bad."""
+    try:
+        return get(addr).encode()
+    except ValueError:
+        return value
+
+def _encode_table(table, encode_fn=None):
+    """Convert an int-keyed table to a TOML table, sorted by address."""
+    if encode_fn is None:
+        return {encode_address_key(addr): table[addr]
+                for addr in sorted(table)}
+    return {encode_address_key(addr): encode_fn(table[addr])
+            for addr in sorted(table)}
@@ -0,0 +1,102 @@
+"""Append-only journal of database changes.
+
+Each change to the database is one JSON line in the journal, numbered with
+an increasing sequence number. Saving only has to append the new lines,
+and the journal is replayed on top of the TOML snapshot when the database
+is loaded. Now and then the journal is compacted: the whole database is
+written to the snapshot, along with the sequence number it includes, and
+the journal is emptied.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import json
+import os
+
+
+SUFFIX = ".journal"
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        # The sequence number of the last record written.
+        self.seq = 0
+        # Number of records in the journal file.
+        self.length = 0
+        # Size of the journal without a torn record at the end, if it has
+        # one.
+        self.good_size = None
+
+    def read(self, after_seq=0):
+        """Generate the records in the journal, in order.
+
+        Records up to and including after_seq are skipped, as they're
+        already in the snapshot. A torn record at the end (from a crash
+        part way through a write) is ignored.
+        """
+        self.seq = after_seq
+        self.length = 0
+        self.good_size = None
+        try:
+            infile = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        size = 0
+        with infile:
+            for line in infile:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete record")
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    self.good_size = size
+                    break
+                size += len(line)
+                self.length += 1
+                seq = record["seq"]
+                if seq <= after_seq:
+                    continue
+                self.seq = seq
+                yield record
+
+    def append(self, records):
+        """Append records to the journal, and flush them to the disk.
+
+        records is a list of dicts, which are given sequence numbers.
+        """
+        if not records:
+            return
+        seq = self.seq
+        lines = []
+        for record in records:
+            seq += 1
+            record["seq"] = seq
+            lines.append(json.dumps(record, sort_keys=True))
+        lines.append("")
+        if self.good_size is not None:
+            # Don't write after a torn record.
+            with open(self.path, "r+b") as outfile:
+                outfile.truncate(self.good_size)
+            self.good_size = None
+        with open(self.path, "a", encoding="utf-8") as outfile:
+            start = outfile.tell()
+            try:
+                outfile.write("\n".join(lines))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            except OSError:
+                # Whatever got written is a torn record.
+                self.good_size = start
+                raise
+        self.seq = seq
+        self.length += len(records)
+
+    def clear(self):
+        """Empty the journal, once the snapshot has everything in it."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.length = 0
+        self.good_size = None
@@ -0,0 +1,71 @@
+"""Resolve the targets of indexed indirect jumps and calls.
+
+`jmp ($xxxx,x)` and `jsr ($xxxx,x)` read a 16 bit pointer from a table in the
+program bank. The index register is almost never known statically, so the
+length of the table has to be guessed.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+
+
+# Upper bound on the number of entries read from a single table.
+MAX_ENTRIES = 256
+
+
+def is_jump_table_operation(operation):
+    """Check if an operation jumps or calls through an indexed table."""
+    info = dsnes.disassembler.codes[operation.raw[0]]
+    return isinstance(info, dsnes.disassembler.AbsXInd)
+
+def resolve(bus, database, table_addr, known_code=(), max_entries=MAX_ENTRIES):
+    """Find the targets of the jump table at table_addr.
+
+    The whole table is read from the bus in one go, then cut short by these
+    heuristics:
+    * A table entry can't overlap known code (i.e. an address in known_code).
+    * A labelled address after the first entry is the start of something
+      else.
+    * Every target must be a readable address in the same bank.
+    * A table entry can't be a target, or lie beyond a target. Code often
+      immediately follows the table.
+
+    Returns a list of target addresses, one per table entry. Duplicates are
+    kept so that entry N of the table is at index N.
+    """
+    pbr = table_addr & 0xFF0000
+    raw = bus.read_block(table_addr, max_entries * 2)
+    targets = []
+    # Targets are usually laid out after the table, so the lowest target seen
+    # so far bounds the end of the table.
+    limit = None
+
+    for n in range(len(raw) // 2):
+        entry_addr = pbr | ((table_addr + n * 2) & 0xFFFF)
+        second_byte = pbr | ((entry_addr + 1) & 0xFFFF)
+        if entry_addr in known_code or second_byte in known_code:
+            break
+        if n > 0 and database.get_label(entry_addr) is not None:
+            break
+        if limit is not None and entry_addr >= limit:
+            break
+
+        target = pbr | raw[n * 2] | (raw[n * 2 + 1] << 8)
+        if not _is_readable(bus, target):
+            break
+        # Pointing back into the table itself means we've run into data.
+        if table_addr <= target <= second_byte:
+            break
+        targets.append(target)
+        if target > table_addr and (limit is None or target < limit):
+            limit = target
+
+    return targets
+
+def _is_readable(bus, addr):
+    try:
+        bus.read(addr)
+    except (dsnes.UnmappedMemoryAccess, dsnes.BusReadImpossible):
+        return False
+    return True
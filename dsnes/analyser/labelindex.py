@@ -0,0 +1,119 @@
+"""Search index over the labels in a database.
+
+Big projects have tens of thousands of labels, too many to scan on every
+key press. The index keeps them in a set for existence checks, a trie for
+prefix completion, and a map of trigrams for fuzzy matching.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+from collections import Counter
+
+
+# Key in a trie node that marks the end of a label.
+_END = None
+
+
+def trigrams(text):
+    """Get the set of case-folded trigrams in some text.
+
+    The text is padded, so that its start and end count for more, and so
+    that short text still has trigrams.
+    """
+    padded = "  " + text.casefold() + " "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class LabelIndex:
+    def __init__(self, labels=()):
+        self.labels = set()
+        # Nested dicts of {character: node}.
+        self.trie = {}
+        # {trigram: set of labels}
+        self.trigrams = {}
+        for label in labels:
+            self.add(label)
+
+    def __contains__(self, label):
+        return label in self.labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def add(self, label):
+        if label in self.labels:
+            return
+        self.labels.add(label)
+        node = self.trie
+        for char in label:
+            node = node.setdefault(char, {})
+        node[_END] = True
+        for trigram in trigrams(label):
+            self.trigrams.setdefault(trigram, set()).add(label)
+
+    def remove(self, label):
+        """Remove a label. Raises KeyError if it isn't in the index."""
+        self.labels.remove(label)
+        # Walk down, remembering the path so empty nodes can be pruned.
+        path = []
+        node = self.trie
+        for char in label:
+            path.append((node, char))
+            node = node[char]
+        del node[_END]
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+        for trigram in trigrams(label):
+            holders = self.trigrams[trigram]
+            holders.discard(label)
+            if not holders:
+                del self.trigrams[trigram]
+
+    def complete(self, prefix, limit=None):
+        """Get the labels that start with prefix, in sorted order.
+
+        At most limit labels are returned, if it's given.
+        """
+        node = self.trie
+        for char in prefix:
+            node = node.get(char, None)
+            if node is None:
+                return []
+        found = []
+        # Depth first, in character order, so the results come out sorted.
+        stack = [(prefix, node)]
+        while stack:
+            text, node = stack.pop()
+            if _END in node:
+                found.append(text)
+                if limit is not None and len(found) >= limit:
+                    break
+            children = sorted(
+                (char for char in node if char is not _END), reverse=True)
+            for char in children:
+                stack.append((text + char, node[char]))
+        return found
+
+    def search(self, text, limit=None):
+        """Get the labels that roughly match some text, best first.
+
+        Matching ignores case. A label matches if it shares at least half of
+        the text's trigrams; those that share more come first, then the
+        shorter ones.
+        """
+        wanted = trigrams(text)
+        scores = Counter()
+        for trigram in wanted:
+            scores.update(self.trigrams.get(trigram, ()))
+        needed = (len(wanted) + 1) // 2
+        ranked = sorted(
+            (-score, len(label), label)
+            for label, score in scores.items() if score >= needed)
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [label for _, _, label in ranked]
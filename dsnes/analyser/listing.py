@@ -0,0 +1,116 @@
+"""Render collated disassembly as a text listing."""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import bz2
+import gzip
+import io
+import lzma
+
+
+# Number of lines to join up before each write.
+LINES_PER_CHUNK = 4096
+
+# Wrap a binary file object in a compressing writer.
+COMPRESSORS = {
+    "gzip": lambda outfile: gzip.GzipFile(fileobj=outfile, mode="wb"),
+    "bz2": lambda outfile: bz2.BZ2File(outfile, mode="wb"),
+    "xz": lambda outfile: lzma.LZMAFile(outfile, mode="wb"),
+}
+
+
+def format_address(addr):
+    pbr = (addr & 0xFF0000) >> 16
+    pc = addr & 0xFFFF
+    return "{:02x}:{:04x}".format(pbr, pc)
+
+def format_disassembly(item):
+    """Format a Disassembly item as a single line."""
+    operation = item.operation
+    return (" {addr}:{raw:<11}  {asm:<15s}   {target:<18s}  "
+            "{comment:<35s}   {state}".format(
+                addr=format_address(operation.addr),
+                raw=" ".join([format(n, "02x") for n in operation.raw]),
+                asm=operation.asm_str,
+                target=item.target_str,
+                comment=item.comment or "",
+                state=operation.state.encode()))
+
+def format_error(error):
+    """Format an AnalyserError as a single line."""
+    error_msg = "!!!{}!!!".format(error.msg)
+    return " {addr}{pad:<12}  {msg:^73}   {state}".format(
+        addr=format_address(error.addr),
+        pad="",
+        msg=error_msg,
+        state=error.state.encode())
+
+def iter_lines(disassembly):
+    """Generate the lines of a listing, without line endings."""
+    for item in disassembly:
+        kind = item.kind
+        if kind == "disassembly":
+            yield format_disassembly(item)
+        elif kind == "label":
+            yield item.text
+        elif kind == "pre-comment":
+            for line in item.text.splitlines():
+                yield " {}".format(line)
+        elif kind == "error":
+            yield format_error(item)
+        else:
+            raise ValueError("Unexpected item kind {!r}".format(kind))
+
+def iter_chunks(lines, lines_per_chunk=LINES_PER_CHUNK):
+    """Join lines into large newline-terminated chunks of text."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= lines_per_chunk:
+            chunk.append("")
+            yield "\n".join(chunk)
+            chunk = []
+    if chunk:
+        chunk.append("")
+        yield "\n".join(chunk)
+
+def write_listing(disassembly, outfile, compress=None):
+    """Write a listing of the disassembly to a file object.
+
+    outfile can be a text or binary file object. If compress is one of
+    "gzip", "bz2" or "xz" then the listing is compressed on the fly, and
+    outfile must be binary, or a text file with a binary buffer under it
+    such as sys.stdout.
+    Returns the number of lines written.
+    """
+    count = 0
+    chunks = iter_chunks(iter_lines(disassembly))
+
+    if compress is not None:
+        try:
+            compressor = COMPRESSORS[compress]
+        except LookupError:
+            raise ValueError(
+                "Unknown compression {!r}".format(compress)) from None
+        if isinstance(outfile, io.TextIOBase):
+            buffer = getattr(outfile, "buffer", None)
+            if buffer is None:
+                raise ValueError(
+                    "A compressed listing needs a binary file")
+            # Anything already written to the text file goes first.
+            outfile.flush()
+            outfile = buffer
+        with compressor(outfile) as packed:
+            for chunk in chunks:
+                packed.write(chunk.encode("utf-8"))
+                count += chunk.count("\n")
+        outfile.flush()
+    elif isinstance(outfile, io.TextIOBase):
+        for chunk in chunks:
+            outfile.write(chunk)
+            count += chunk.count("\n")
+    else:
+        for chunk in chunks:
+            outfile.write(chunk.encode("utf-8"))
+            count += chunk.count("\n")
+    return count
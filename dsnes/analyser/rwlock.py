@@ -0,0 +1,122 @@
+"""A lock that many threads can read under at once, but only one can write.
+
+Analyses can run on background threads while the GUI thread edits
+annotations. Anything that changes the database or the session's analysis
+state does so under the write lock; anything that reads them from another
+thread does so under the read lock, so it never sees a half made change.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import contextlib
+import functools
+import threading
+
+
+class RWLock:
+    """A reentrant reader-writer lock.
+
+    A thread can take the read lock again while it holds it, and can take
+    either lock while it holds the write lock. It can't take the write lock
+    while it only holds the read lock, as two threads doing so would wait
+    for each other forever.
+    While a writer is waiting, new readers wait too, so that a steady
+    stream of readers can't keep it out.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        # Read holds, by every thread.
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+        # Each thread's own read holds.
+        self._local = threading.local()
+
+    def _read_depth(self):
+        return getattr(self._local, "depth", 0)
+
+    @property
+    def is_writing(self):
+        """Whether the current thread holds the write lock."""
+        return self._writer == threading.get_ident()
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me and not self._read_depth():
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers += 1
+        self._local.depth = self._read_depth() + 1
+
+    def release_read(self):
+        depth = self._read_depth()
+        if not depth:
+            raise RuntimeError("Read lock isn't held")
+        self._local.depth = depth - 1
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            if self._read_depth():
+                raise RuntimeError(
+                    "Can't take the write lock while holding the read lock")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._condition:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("Write lock isn't held")
+            self._write_depth -= 1
+            if not self._write_depth:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class ReadOnlyLock(RWLock):
+    """The lock of something that can be read but never changed."""
+
+    def acquire_write(self):
+        raise RuntimeError("Can't change a read-only view")
+
+
+def writes(method):
+    """Wrap a method so that it runs under its object's write lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
@@ -0,0 +1,360 @@
+"""Database backend stored as a TOML file for each bank.
+
+For big projects, where reading and writing a single database.toml gets
+slow. The files live in a "database" directory in the project:
+    manifest.toml    The banks that have files, with the sequence number of
+                     the save that last wrote each of them, and anything
+                     else from the database.
+    bank_XX.toml     The annotations for bank XX, laid out like
+                     database.toml, and its sequence number.
+
+Opening the database only reads the manifest. A bank's file is read the
+first time an address in it is looked up, and saving only writes the
+files for the banks that have been edited. Looking up or searching for a
+label by its name needs every bank, so the first such lookup reads them
+all.
+A bank's file is written before the manifest, so it can be newer than the
+manifest says if a save was cut short, but never older.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import collections
+import functools
+import os
+import threading
+
+import toml
+
+from dsnes.analyser import changes, database, labelindex, rwlock
+
+
+DIRNAME = "database"
+MANIFEST = "manifest.toml"
+# Bump this whenever the layout of the files changes.
+VERSION = 2
+
+
+def load(path):
+    """Open the sharded database in a directory."""
+    db = ShardedDatabase()
+    db.load(path)
+    return db
+
+def split_toml(toml_path, path):
+    """Make a sharded database from a TOML database.
+
+    Returns the ShardedDatabase, with everything saved.
+    """
+    source = database.load(toml_path)
+    os.makedirs(path, exist_ok=True)
+    db = ShardedDatabase()
+    db.path = path
+    db.extra_data = dict(source.extra_data)
+    db.extra_data.pop("journal_seq", None)
+    (_, db.state_cache, db.state_delta_cache, db.labels_of_address,
+        db.pre_comments, db.inline_comments) = source.snapshot()
+    db.address_of_label = dict(source.address_of_label)
+    db.label_addresses = list(source.label_addresses)
+    db.label_index = labelindex.LabelIndex(db.address_of_label)
+    for table in (db.state_cache, db.state_delta_cache, db.labels_of_address,
+                  db.pre_comments, db.inline_comments):
+        for addr in table:
+            db.bank_addresses[addr >> 16].add(addr)
+    db.loaded_banks = set(range(0x100))
+    db.dirty_banks = set(db.bank_addresses)
+    if db.dirty_banks:
+        db.save()
+    else:
+        # Nothing to save, but the manifest marks out the directory.
+        _write_file(os.path.join(path, MANIFEST),
+                    toml.dumps(db._manifest_data()))
+    return db
+
+def shard_filename(bank):
+    return "bank_{:02x}.toml".format(bank)
+
+def _for_bank(method):
+    """Wrap a method that takes an address, so that its bank is loaded."""
+    @functools.wraps(method)
+    def wrapper(self, addr, *args):
+        self._load_bank(addr >> 16)
+        return method(self, addr, *args)
+    return wrapper
+
+def _for_banks(method):
+    """Wrap a method that takes many addresses, so their banks are loaded."""
+    @functools.wraps(method)
+    def wrapper(self, addresses, *args):
+        if not isinstance(addresses, (set, frozenset, dict)):
+            addresses = set(addresses)
+        if self.shard_banks.keys() - self.loaded_banks:
+            for bank in {addr >> 16 for addr in addresses}:
+                self._load_bank(bank)
+        return method(self, addresses, *args)
+    return wrapper
+
+def _for_all_banks(method):
+    """Wrap a method that looks labels up by name, so every bank is loaded."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.load_all()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ShardedDatabase(database.Database):
+    """A Database that is split into a file for each bank.
+
+    The lookups are the same as a Database's, but only hold the banks that
+    have been loaded.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # {bank: sequence number} for the banks that have a file.
+        self.shard_banks = {}
+        # Banks that have been read, or that have no file to read.
+        self.loaded_banks = set()
+        # Banks with changes that haven't been saved.
+        self.dirty_banks = set()
+        # {bank: set of addresses} that have, or had, annotations in each
+        # loaded bank, so a bank can be saved without searching the tables.
+        self.bank_addresses = collections.defaultdict(set)
+        # The sequence number of the last save.
+        self.seq = 0
+        # Held while a bank is read. Taken after the read-write lock.
+        self._load_lock = threading.Lock()
+
+    @rwlock.writes
+    def load(self, path):
+        self.path = path
+        self.is_dirty = False
+        with open(os.path.join(path, MANIFEST), "r") as infile:
+            manifest = toml.load(infile)
+        if manifest.get("version") != VERSION:
+            raise ValueError("{} has unknown version {!r}".format(
+                MANIFEST, manifest.get("version")))
+        self.extra_data = manifest.get("extra", {})
+        self.shard_banks = {int(bank, 16): seq
+                            for bank, seq in manifest["banks"].items()}
+        self.seq = max(self.shard_banks.values(), default=0)
+
+    def _load_bank(self, bank):
+        """Read a bank's file, if it has one and it hasn't been read."""
+        if bank in self.loaded_banks:
+            return
+        with self._load_lock:
+            if bank not in self.loaded_banks:
+                if bank in self.shard_banks:
+                    self._read_bank(bank)
+                self.loaded_banks.add(bank)
+
+    def _read_bank(self, bank):
+        path = os.path.join(self.path, shard_filename(bank))
+        try:
+            with open(path, "r") as infile:
+                data = toml.load(infile)
+        except FileNotFoundError:
+            # Emptied, but the manifest wasn't written afterwards.
+            return
+        if data.get("seq", 0) < self.shard_banks[bank]:
+            raise ValueError("{} is older than {}".format(
+                shard_filename(bank), MANIFEST))
+        addresses = self.bank_addresses[bank]
+
+        def items(table):
+            for key, value in data.get(table, {}).items():
+                addr = database.parse_address_key(key)
+                if addr >> 16 != bank:
+                    raise ValueError("{} has an entry for {}".format(
+                        shard_filename(bank), key))
+                addresses.add(addr)
+                yield addr, value
+
+        # Like a Database, states are parsed when they're first looked up.
+        states = dict(items("states"))
+        deltas = dict(items("state_deltas"))
+        database._check_exclusive(states, deltas)
+        self.state_cache.update(states)
+        self.state_delta_cache.update(deltas)
+        for addr, labels in items("labels"):
+            for label in labels:
+                # A view shares the database's label index.
+                self._register_label(addr, label, index=not self.is_view)
+        self.pre_comments.update(items("pre_comments"))
+        self.inline_comments.update(items("inline_comments"))
+
+    def load_all(self):
+        """Read every bank's file."""
+        for bank in sorted(self.shard_banks):
+            self._load_bank(bank)
+
+    get_state = _for_bank(database.Database.get_state)
+    get_state_strings = _for_banks(database.Database.get_state_strings)
+    set_state = _for_bank(database.Database.set_state)
+    remove_state = _for_bank(database.Database.remove_state)
+    get_state_delta = _for_bank(database.Database.get_state_delta)
+    get_state_delta_strings = _for_banks(
+        database.Database.get_state_delta_strings)
+    set_state_delta = _for_bank(database.Database.set_state_delta)
+    remove_state_delta = _for_bank(database.Database.remove_state_delta)
+    get_label = _for_bank(database.Database.get_label)
+    get_labels = _for_bank(database.Database.get_labels)
+    get_labels_for_addresses = _for_banks(
+        database.Database.get_labels_for_addresses)
+    get_all_labels = _for_all_banks(database.Database.get_all_labels)
+    has_label = _for_all_banks(database.Database.has_label)
+    complete_label = _for_all_banks(database.Database.complete_label)
+    search_labels = _for_all_banks(database.Database.search_labels)
+    get_address_with_label = _for_all_banks(
+        database.Database.get_address_with_label)
+    nearest_label = _for_bank(database.Database.nearest_label)
+    remove_label = _for_bank(database.Database.remove_label)
+    get_pre_comment = _for_bank(database.Database.get_pre_comment)
+    get_pre_comments = _for_banks(database.Database.get_pre_comments)
+    set_pre_comment = _for_bank(database.Database.set_pre_comment)
+    delete_pre_comment = _for_bank(database.Database.delete_pre_comment)
+    get_inline_comment = _for_bank(database.Database.get_inline_comment)
+    get_inline_comments = _for_banks(database.Database.get_inline_comments)
+    set_inline_comment = _for_bank(database.Database.set_inline_comment)
+    delete_inline_comment = _for_bank(
+        database.Database.delete_inline_comment)
+
+    @rwlock.writes
+    def add_label(self, addr, label):
+        """Add a label to an address."""
+        # It mustn't be in use in any bank.
+        self.load_all()
+        super().add_label(addr, label)
+
+    def _log(self, op, addr, value):
+        """Record a change to a bank, to be written on save."""
+        bank = addr >> 16
+        self.is_dirty = True
+        self.dirty_banks.add(bank)
+        self.bank_addresses[bank].add(addr)
+        self.changes.changed(changes.OP_KINDS[op], addr)
+
+    def view(self):
+        """Get a read-only copy of the database, as for Database.view().
+
+        Banks that haven't been loaded are read into the view when it needs
+        them, and not into the database.
+        """
+        with self.lock.read(), self._load_lock:
+            view = super().view()
+            view.shard_banks = dict(self.shard_banks)
+            view.loaded_banks = set(self.loaded_banks)
+        view.dirty_banks = set()
+        view.bank_addresses = collections.defaultdict(set)
+        view._load_lock = threading.Lock()
+        return view
+
+    def to_toml_data(self, tables=None):
+        """Get the whole database in the layout of a database.toml file."""
+        if tables is None:
+            self.load_all()
+        return super().to_toml_data(tables)
+
+    @rwlock.writes
+    def prepare_save(self, compact=False):
+        """Take the banks that need saving, and return a ShardSaveJob.
+
+        Every edited bank is written in full, under a new sequence number,
+        and then the manifest. compact has no effect, as there is no
+        journal.
+        """
+        banks = self.dirty_banks
+        self.dirty_banks = set()
+        self.is_dirty = False
+        shards = {}
+        manifest = None
+        if banks:
+            self.seq += 1
+            for bank in banks:
+                data = self._bank_data(bank)
+                if data is None:
+                    self.shard_banks.pop(bank, None)
+                else:
+                    data["seq"] = self.seq
+                    shards[bank] = data
+                    self.shard_banks[bank] = self.seq
+            manifest = self._manifest_data()
+        return ShardSaveJob(self, banks, shards, manifest)
+
+    @rwlock.writes
+    def restore_unsaved(self, job):
+        """Take back the changes from a ShardSaveJob that failed."""
+        if not job.finished:
+            self.dirty_banks |= job.banks
+            self.is_dirty = True
+
+    def _bank_data(self, bank):
+        """Get the TOML data for a bank, or None if it's empty."""
+        addresses = self.bank_addresses[bank]
+        used = set()
+        data = {}
+        for name, table, encode_fn in (
+                ("states", self.state_cache, database.encode_state),
+                ("state_deltas", self.state_delta_cache,
+                 database.encode_state),
+                ("labels", self.labels_of_address, list),
+                ("pre_comments", self.pre_comments, None),
+                ("inline_comments", self.inline_comments, None)):
+            entries = {addr: table[addr] for addr in addresses
+                       if addr in table}
+            used.update(entries)
+            data[name] = database._encode_table(entries, encode_fn)
+        # Forget the addresses whose annotations have all been removed.
+        self.bank_addresses[bank] = used
+        if not used:
+            return None
+        return data
+
+    def _manifest_data(self):
+        return {
+            "version": VERSION,
+            "banks": {"{:02x}".format(bank): seq
+                      for bank, seq in sorted(self.shard_banks.items())},
+            "extra": dict(self.extra_data),
+        }
+
+
+class ShardSaveJob:
+    """Writes out the banks that a database had changed when it was made."""
+
+    def __init__(self, database, banks, shards, manifest):
+        self.database = database
+        # The banks to save. Those that aren't in shards are now empty.
+        self.banks = banks
+        # {bank: TOML data}
+        self.shards = shards
+        # The manifest's TOML data, or None if there's nothing to save.
+        self.manifest = manifest
+        self.finished = False
+
+    def run(self):
+        path = self.database.path
+        for bank in sorted(self.banks):
+            shard_path = os.path.join(path, shard_filename(bank))
+            if bank in self.shards:
+                _write_file(shard_path, toml.dumps(self.shards[bank]))
+            elif os.path.exists(shard_path):
+                os.remove(shard_path)
+        # Last, so that it never lists a bank whose file hasn't been
+        # written.
+        if self.manifest is not None:
+            _write_file(os.path.join(path, MANIFEST),
+                        toml.dumps(self.manifest))
+        self.finished = True
+
+
+def _write_file(path, text):
+    """Replace a file atomically."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as outfile:
+        outfile.write(text)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,528 @@
+"""Database backend stored in an SQLite file.
+
+For big projects, where loading and saving the whole TOML database gets
+slow. Annotations are looked up as they're needed rather than all being
+loaded up front, and each table is indexed by address so ranges of
+addresses can be queried directly.
+
+Changes are made inside an SQLite transaction that save() commits, so the
+file on disk only ever holds saved changes. They are made under the write
+lock. A view() is an in-memory copy of the file, unsaved changes and all,
+for another thread to read while this one carries on editing.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import contextlib
+import json
+import os
+import sqlite3
+
+import toml
+
+import dsnes
+from dsnes.analyser import batch, changes, database, labelindex, rwlock
+
+
+FILENAME = "database.sqlite"
+# Bump this whenever the schema changes.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (
+    addr INTEGER PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS state_deltas (
+    addr INTEGER PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS labels (
+    label TEXT PRIMARY KEY,
+    addr INTEGER NOT NULL,
+    position INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS labels_by_addr ON labels (addr, position);
+CREATE TABLE IF NOT EXISTS pre_comments (
+    addr INTEGER PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS inline_comments (
+    addr INTEGER PRIMARY KEY,
+    value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS extra_data (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL);
+"""
+
+# SQLite limits the number of parameters in a query.
+MAX_PARAMETERS = 500
+
+# The kind of change made to each table.
+TABLE_KINDS = {
+    "states": changes.STATE,
+    "state_deltas": changes.STATE_DELTA,
+    "pre_comments": changes.PRE_COMMENT,
+    "inline_comments": changes.INLINE_COMMENT,
+}
+
+# Marks an address that is known to have nothing in a lazy cache.
+_MISSING = object()
+
+
+def load(path):
+    db = SqliteDatabase()
+    db.load(path)
+    return db
+
+def import_toml(toml_path, path):
+    """Make an SQLite database from a TOML database.
+
+    Returns the SqliteDatabase, with everything saved.
+    """
+    source = database.load(toml_path)
+    db = load(path)
+    with db.transaction():
+        for addr in source.state_cache:
+            db.set_state(addr, source.get_state(addr))
+        for addr in source.state_delta_cache:
+            db.set_state_delta(addr, source.get_state_delta(addr))
+        for addr, labels in source.labels_of_address.items():
+            for label in labels:
+                db.add_label(addr, label)
+        for addr, comment in source.pre_comments.items():
+            db.set_pre_comment(addr, comment)
+        for addr, comment in source.inline_comments.items():
+            db.set_inline_comment(addr, comment)
+        # Keep anything else in the file, so it can be exported again.
+        db.connection.executemany(
+            "INSERT OR REPLACE INTO extra_data (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value))
+             for key, value in source.extra_data.items()])
+    db.save()
+    return db
+
+
+class SqliteDatabase:
+    """Presents the same interface as database.Database."""
+
+    def __init__(self):
+        self.path = None
+        self.connection = None
+        # Lazily filled caches of address:State/StateDelta/_MISSING.
+        self.state_cache = {}
+        self.state_delta_cache = {}
+        # LabelIndex for fuzzy searches, built when first needed.
+        self._label_index = None
+        self.changes = changes.ChangeTracker()
+        self.lock = rwlock.RWLock()
+        self.is_view = False
+
+    @property
+    def is_dirty(self):
+        return self.connection is not None and self.connection.in_transaction
+
+    @rwlock.writes
+    def load(self, path):
+        self.path = path
+        # Transactions are begun explicitly, see _begin().
+        # The project is loaded on a worker thread, then used on the GUI
+        # thread, saved from the autosave thread and copied by view() on
+        # analysis threads, always under the lock.
+        self.connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            self.connection.execute(
+                "PRAGMA user_version = {:d}".format(SCHEMA_VERSION))
+        elif version != SCHEMA_VERSION:
+            raise ValueError("{} has schema version {}, expected {}".format(
+                path, version, SCHEMA_VERSION))
+        self._clear_caches()
+
+    def close(self):
+        """Close the file. Unsaved changes are lost."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @rwlock.writes
+    def save(self):
+        if self.connection.in_transaction:
+            self.connection.execute("COMMIT")
+
+    def prepare_save(self, compact=False):
+        """Save now, as for database.Database.prepare_save().
+
+        SQLite has already written the changes to the file, so committing
+        them is quick and there's nothing to leave for a SaveJob.
+        Returns None.
+        """
+        self.save()
+        return None
+
+    @rwlock.writes
+    def revert(self):
+        """Throw away every change since the last save."""
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+            self.changes.changed(changes.ALL, None)
+        self._clear_caches()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group changes, so that either all or none of them are made.
+
+        If the block raises an exception, every change made inside it is
+        undone. The changes still need to be saved.
+        """
+        with self.lock.write():
+            self._begin()
+            self.connection.execute("SAVEPOINT batch")
+            try:
+                yield self
+            except BaseException:
+                self.connection.execute("ROLLBACK TO batch")
+                self.connection.execute("RELEASE batch")
+                self._clear_caches()
+                self.changes.changed(changes.ALL, None)
+                raise
+            else:
+                self.connection.execute("RELEASE batch")
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect edits, and make them all at once at the end of the block.
+
+        Yields a Batch to make the edits on. Nothing is changed if the block
+        raises an exception, or if any of the edits can't be made.
+        """
+        edits = batch.Batch()
+        yield edits
+        self.apply_batch(edits)
+
+    @rwlock.writes
+    def apply_batch(self, edits):
+        """Make every edit in a Batch, or none of them.
+
+        Raises ValueError if any of the edits can't be made.
+        """
+        edits.validate(self)
+        with self.changes.hold(), self.transaction():
+            for record in edits:
+                batch.apply_record(self, record)
+
+    def view(self):
+        """Get a read-only copy of the database, that later edits won't change.
+
+        For reading on another thread while this one carries on editing.
+        The file, with any unsaved changes, is copied into an in-memory
+        database. The label index is shared, as for database.Database.
+        """
+        with self.lock.read():
+            connection = sqlite3.connect(
+                ":memory:", isolation_level=None, check_same_thread=False)
+            if hasattr(self.connection, "serialize"):
+                connection.deserialize(self.connection.serialize())
+            else:
+                # Before Python 3.11.
+                connection.executescript(
+                    "\n".join(self.connection.iterdump()))
+            view = SqliteDatabase()
+            view.path = self.path
+            view.connection = connection
+            view.state_cache = dict(self.state_cache)
+            view.state_delta_cache = dict(self.state_delta_cache)
+            view._label_index = self._label_index
+            view.changes = self.changes.copy()
+        connection.execute("PRAGMA query_only = ON")
+        view.lock = rwlock.ReadOnlyLock()
+        view.is_view = True
+        return view
+
+    def _begin(self):
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+
+    def _clear_caches(self):
+        self.state_cache = {}
+        self.state_delta_cache = {}
+        self._label_index = None
+
+    def _get_value(self, table, addr):
+        row = self.connection.execute(
+            "SELECT value FROM {} WHERE addr = ?".format(table),
+            (addr,)).fetchone()
+        return row[0] if row else None
+
+    def _get_values(self, table, addresses):
+        """Get {address: value} for the addresses that are in a table."""
+        found = {}
+        addresses = list(set(addresses))
+        for start in range(0, len(addresses), MAX_PARAMETERS):
+            chunk = addresses[start:start + MAX_PARAMETERS]
+            query = "SELECT addr, value FROM {} WHERE addr IN ({})".format(
+                table, ",".join("?" * len(chunk)))
+            found.update(self.connection.execute(query, chunk))
+        return found
+
+    def _get_range(self, table, lo, hi):
+        """Get [(address, value)] for addresses in [lo, hi], in order."""
+        return self.connection.execute(
+            "SELECT addr, value FROM {} WHERE addr BETWEEN ? AND ? "
+            "ORDER BY addr".format(table), (lo, hi)).fetchall()
+
+    def _set_value(self, table, addr, value):
+        database.check_address(addr)
+        self._begin()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO {} (addr, value) VALUES (?, ?)".format(
+                table), (addr, value))
+        self.changes.changed(TABLE_KINDS[table], addr)
+
+    def _delete_value(self, table, addr):
+        self._begin()
+        cursor = self.connection.execute(
+            "DELETE FROM {} WHERE addr = ?".format(table), (addr,))
+        if cursor.rowcount == 0:
+            raise KeyError(addr)
+        self.changes.changed(TABLE_KINDS[table], addr)
+
+    def get_state(self, addr):
+        state = self.state_cache.get(addr, None)
+        if state is None:
+            value = self._get_value("states", addr)
+            state = _MISSING if value is None else dsnes.State.parse(value)
+            self.state_cache[addr] = state
+        if state is _MISSING:
+            return None
+        return state.clone()
+
+    def get_state_strings(self, addresses):
+        return self._get_values("states", addresses)
+
+    def get_states_in_range(self, lo, hi):
+        """Get [(address, State)] for the addresses in [lo, hi]."""
+        return [(addr, dsnes.State.parse(value))
+                for addr, value in self._get_range("states", lo, hi)]
+
+    @rwlock.writes
+    def set_state(self, addr, state):
+        if self.get_state_delta(addr) is not None:
+            raise ValueError("Cannot set both an absolute and a delta state "
+                "for {}".format(database.encode_address_key(addr)))
+        s = state.encode()
+        assert s is not None
+        self._set_value("states", addr, s)
+        self.state_cache[addr] = state.clone()
+
+    @rwlock.writes
+    def remove_state(self, addr):
+        self._delete_value("states", addr)
+        self.state_cache[addr] = _MISSING
+
+    def get_state_delta(self, addr):
+        delta = self.state_delta_cache.get(addr, None)
+        if delta is None:
+            value = self._get_value("state_deltas", addr)
+            delta = (_MISSING if value is None
+                     else dsnes.StateDelta.parse(value))
+            self.state_delta_cache[addr] = delta
+        if delta is _MISSING:
+            return None
+        return delta.clone()
+
+    def get_state_delta_strings(self, addresses):
+        return self._get_values("state_deltas", addresses)
+
+    def get_state_deltas_in_range(self, lo, hi):
+        """Get [(address, StateDelta)] for the addresses in [lo, hi]."""
+        return [(addr, dsnes.StateDelta.parse(value))
+                for addr, value in self._get_range("state_deltas", lo, hi)]
+
+    @rwlock.writes
+    def set_state_delta(self, addr, delta):
+        if self.get_state(addr) is not None:
+            raise ValueError("Cannot set both an absolute and a delta state "
+                "for {}".format(database.encode_address_key(addr)))
+        self._set_value("state_deltas", addr, delta.encode())
+        self.state_delta_cache[addr] = delta
+
+    @rwlock.writes
+    def remove_state_delta(self, addr):
+        self._delete_value("state_deltas", addr)
+        self.state_delta_cache[addr] = _MISSING
+
+    def get_label(self, addr):
+        """Get the first label for a given address."""
+        labels = self.get_labels(addr)
+        if labels:
+            return labels[0]
+        else:
+            return None
+
+    def get_labels(self, addr):
+        """Get all labels for a given address."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT label FROM labels WHERE addr = ? ORDER BY position",
+            (addr,))]
+
+    def get_labels_for_addresses(self, addresses):
+        labels = {}
+        addresses = list(set(addresses))
+        for start in range(0, len(addresses), MAX_PARAMETERS):
+            chunk = addresses[start:start + MAX_PARAMETERS]
+            query = ("SELECT addr, label FROM labels WHERE addr IN ({}) "
+                     "ORDER BY addr, position".format(
+                         ",".join("?" * len(chunk))))
+            for addr, label in self.connection.execute(query, chunk):
+                labels.setdefault(addr, []).append(label)
+        return labels
+
+    def get_labels_in_range(self, lo, hi):
+        """Get [(address, label)] for the addresses in [lo, hi]."""
+        return self.connection.execute(
+            "SELECT addr, label FROM labels WHERE addr BETWEEN ? AND ? "
+            "ORDER BY addr, position", (lo, hi)).fetchall()
+
+    def get_all_labels(self):
+        """Get all labels in use."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT label FROM labels")]
+
+    def get_address_with_label(self, label):
+        """Get the address that the label applies to."""
+        row = self.connection.execute(
+            "SELECT addr FROM labels WHERE label = ?", (label,)).fetchone()
+        return row[0] if row else None
+
+    def has_label(self, label):
+        """Check if a label is in use."""
+        return self.get_address_with_label(label) is not None
+
+    def complete_label(self, prefix, limit=None):
+        """Get the labels that start with prefix, in sorted order."""
+        # A range scan of the primary key, stopping at the first label
+        # that's past the prefix.
+        found = []
+        for (label,) in self.connection.execute(
+                "SELECT label FROM labels WHERE label >= ? ORDER BY label",
+                (prefix,)):
+            if not label.startswith(prefix):
+                break
+            found.append(label)
+            if limit is not None and len(found) >= limit:
+                break
+        return found
+
+    def search_labels(self, text, limit=None):
+        """Get the labels that roughly match some text, best first."""
+        if self._label_index is None:
+            self._label_index = labelindex.LabelIndex(self.get_all_labels())
+        return self._label_index.search(text, limit)
+
+    def nearest_label(self, addr, max_offset=None):
+        """Get the closest label at or before an address, in the same bank.
+
+        Labels more than max_offset bytes before the address are ignored.
+        Returns (label_address, label), or None.
+        """
+        lowest = addr & 0xFF0000
+        if max_offset is not None:
+            lowest = max(lowest, addr - max_offset)
+        return self.connection.execute(
+            "SELECT addr, label FROM labels WHERE addr BETWEEN ? AND ? "
+            "ORDER BY addr DESC, position LIMIT 1", (lowest, addr)).fetchone()
+
+    @rwlock.writes
+    def add_label(self, addr, label):
+        """Add a label to an address."""
+        if self.get_address_with_label(label) is not None:
+            raise ValueError("Label {!r} is already in use".format(label))
+        database.check_address(addr)
+        self._begin()
+        self.connection.execute(
+            "INSERT INTO labels (label, addr, position) VALUES (?, ?, "
+            "(SELECT COALESCE(MAX(position), -1) + 1 FROM labels "
+            "WHERE addr = ?))", (label, addr, addr))
+        if self._label_index is not None:
+            self._label_index.add(label)
+        self.changes.changed(changes.LABEL, addr)
+
+    @rwlock.writes
+    def remove_label(self, addr, label):
+        """Remove a label from an address."""
+        stored_address = self.get_address_with_label(label)
+        if stored_address is None:
+            raise ValueError("Label {!r} does not exist".format(label))
+        if stored_address != addr:
+            raise ValueError(
+                "Label {!r} is not applied to the address {}".format(
+                    label, addr))
+        self._begin()
+        self.connection.execute("DELETE FROM labels WHERE label = ?", (label,))
+        if self._label_index is not None:
+            self._label_index.remove(label)
+        self.changes.changed(changes.LABEL, addr)
+
+    def get_pre_comment(self, addr):
+        """Get the pre-instruction comment for an address."""
+        return self._get_value("pre_comments", addr)
+
+    def get_pre_comments(self, addresses):
+        return self._get_values("pre_comments", addresses)
+
+    def get_pre_comments_in_range(self, lo, hi):
+        """Get [(address, comment)] for the addresses in [lo, hi]."""
+        return self._get_range("pre_comments", lo, hi)
+
+    @rwlock.writes
+    def set_pre_comment(self, addr, comment):
+        assert comment is not None
+        self._set_value("pre_comments", addr, comment)
+
+    @rwlock.writes
+    def delete_pre_comment(self, addr):
+        self._delete_value("pre_comments", addr)
+
+    def get_inline_comment(self, addr):
+        """Get the inline comment for an address."""
+        return self._get_value("inline_comments", addr)
+
+    def get_inline_comments(self, addresses):
+        return self._get_values("inline_comments", addresses)
+
+    def get_inline_comments_in_range(self, lo, hi):
+        """Get [(address, comment)] for the addresses in [lo, hi]."""
+        return self._get_range("inline_comments", lo, hi)
+
+    @rwlock.writes
+    def set_inline_comment(self, addr, comment):
+        assert comment is not None
+        self._set_value("inline_comments", addr, comment)
+
+    @rwlock.writes
+    def delete_inline_comment(self, addr):
+        self._delete_value("inline_comments", addr)
+
+    def to_toml_data(self):
+        """Get the database in the string-keyed layout of the TOML file."""
+        execute = self.connection.execute
+        encode = database.encode_address_key
+        data = {key: json.loads(value) for key, value in execute(
+            "SELECT key, value FROM extra_data")}
+        for table in ("states", "state_deltas", "pre_comments",
+                      "inline_comments"):
+            data[table] = {
+                encode(addr): value for addr, value in execute(
+                    "SELECT addr, value FROM {} ORDER BY addr".format(table))}
+        labels = {}
+        for addr, label in execute(
+                "SELECT addr, label FROM labels ORDER BY addr, position"):
+            labels.setdefault(encode(addr), []).append(label)
+        data["labels"] = labels
+        return data
+
+    def export_toml(self, path):
+        """Write the database to a TOML file that Database can load."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as outfile:
+            toml.dump(self.to_toml_data(), outfile)
+        os.replace(tmp_path, path)
@@ -0,0 +1,69 @@
+"""Timers and counters for the phases of an analysis."""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import contextlib
+import json
+import time
+
+
+# The phases that an analysis spends its time in.
+WALK = "walk"
+DECODE = "decode"
+STATE = "state"
+DATABASE = "database"
+COLLATE = "collate"
+LABELS = "labels"
+PHASES = (WALK, DECODE, STATE, DATABASE, COLLATE, LABELS)
+
+
+class AnalysisStats:
+    """Where an analysis spent its time, and how much work it did.
+
+    times holds the seconds spent in each phase. The walk phase is the
+    whole walk of the code. The decode, state and database phases split it
+    up by instruction, and are only timed when the AnalysisControl asks for
+    them, as reading the clock for every instruction slows the walk down.
+    The collate phase includes the labels phase and the database lookups
+    made while collating, so the phases don't add up to the total.
+    counts holds the number of instructions, blocks, lookups etc.
+    """
+
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = {
+            "instructions": 0,
+            "blocks": 0,
+            "errors": 0,
+            "jump_tables": 0,
+            "database_lookups": 0,
+            "labels": 0,
+            "lines": 0,
+        }
+        self.total = 0.0
+
+    def add_time(self, phase, seconds):
+        self.times[phase] += seconds
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Time a block of code as part of a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[phase] += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            "total": self.total,
+            "times": dict(self.times),
+            "counts": dict(self.counts),
+        }
+
+    def to_json(self, **kwargs):
+        """Get the stats as a JSON string. kwargs go to json.dumps()."""
+        return json.dumps(self.as_dict(), **kwargs)
@@ -0,0 +1,197 @@
+"""Import labels from other tools' symbol files.
+
+These formats are understood:
+    sym   bsnes-plus, no$sns and WLA DX .sym files. Lines of "BB:AAAA name"
+          or "BBAAAA name", in a [labels] or [symbol] section if the file
+          has sections.
+    mlb   Mesen-S label files. Lines of "TYPE:ADDR:name[:comment]", where
+          ADDR is an offset within the memory TYPE.
+    vice  ca65/ld65 label files, made with -Ln. Lines of "al BBAAAA .name".
+
+Community symbol sets run to tens of thousands of labels, so the files are
+read a line at a time, and the labels are checked against the database's
+label index and a set of the names seen so far rather than by searching
+lists. Lines that aren't labels are skipped.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import collections
+import os
+import re
+
+
+# The memory that a symbol's address is in.
+CPU = "cpu"
+ROM = "rom"
+WRAM = "wram"
+SRAM = "sram"
+REGISTER = "register"
+
+WRAM_BASE = 0x7E0000
+WRAM_SIZE = 0x20000
+
+Symbol = collections.namedtuple("Symbol", ["space", "addr", "name"])
+
+# What happened to the symbols in an import. existing were already applied
+# at the same address, conflicts were labels already used elsewhere, and
+# unmapped couldn't be placed at a CPU address.
+ImportResult = collections.namedtuple(
+    "ImportResult", ["added", "existing", "conflicts", "unmapped"])
+
+SYM_RE = re.compile(
+    r"\s*([0-9A-Fa-f]{2}):?([0-9A-Fa-f]{4})\s+([^\s;]+)")
+# no$sns writes the address as eight digits.
+NOCASH_RE = re.compile(r"\s*[0-9A-Fa-f]{2}([0-9A-Fa-f]{6})\s+([^\s;]+)")
+SECTION_RE = re.compile(r"\s*\[([^\]]*)\]")
+LABEL_SECTIONS = {"labels", "symbol", "symbols"}
+VICE_RE = re.compile(r"\s*al\s+([0-9A-Fa-f]{1,6})\s+\.?(\S+)")
+
+# The memory types in Mesen-S and Mesen 2 label files.
+MLB_SPACES = {
+    "PRG": ROM,
+    "SnesPrgRom": ROM,
+    "WORK": WRAM,
+    "SnesWorkRam": WRAM,
+    "SAVE": SRAM,
+    "SnesSaveRam": SRAM,
+    "REG": REGISTER,
+    "SnesRegister": REGISTER,
+}
+
+FORMATS = ("sym", "mlb", "vice")
+EXTENSIONS = {
+    ".sym": "sym",
+    ".mlb": "mlb",
+    ".lbl": "vice",
+    ".vice": "vice",
+}
+
+
+def read_sym(lines):
+    """Generate the Symbols in the lines of a .sym file."""
+    in_labels = True
+    for line in lines:
+        match = SECTION_RE.match(line)
+        if match:
+            in_labels = match.group(1).strip().lower() in LABEL_SECTIONS
+            continue
+        if not in_labels:
+            continue
+        match = SYM_RE.match(line)
+        if match:
+            bank, addr, name = match.groups()
+            yield Symbol(CPU, (int(bank, 16) << 16) | int(addr, 16), name)
+            continue
+        match = NOCASH_RE.match(line)
+        if match:
+            addr, name = match.groups()
+            yield Symbol(CPU, int(addr, 16), name)
+
+def read_mlb(lines):
+    """Generate the Symbols in the lines of a Mesen .mlb file."""
+    for line in lines:
+        fields = line.rstrip("\r\n").split(":", 3)
+        if len(fields) < 3:
+            continue
+        space = MLB_SPACES.get(fields[0].strip(), None)
+        name = fields[2].strip()
+        if space is None or not name:
+            continue
+        # A label over several bytes has a range; it goes on the first.
+        addr = fields[1].split("-", 1)[0]
+        try:
+            addr = int(addr, 16)
+        except ValueError:
+            continue
+        yield Symbol(space, addr, name)
+
+def read_vice(lines):
+    """Generate the Symbols in the lines of a ca65 VICE label file."""
+    for line in lines:
+        match = VICE_RE.match(line)
+        if match:
+            addr, name = match.groups()
+            yield Symbol(CPU, int(addr, 16), name)
+
+READERS = {
+    "sym": read_sym,
+    "mlb": read_mlb,
+    "vice": read_vice,
+}
+
+def guess_format(path):
+    """Guess the format of a symbol file from its name, or None."""
+    extension = os.path.splitext(path)[1].lower()
+    return EXTENSIONS.get(extension, None)
+
+def read(path, fmt=None):
+    """Generate the Symbols in a symbol file.
+
+    fmt is one of FORMATS; by default it's guessed from the file name.
+    Raises ValueError if the format isn't known.
+    """
+    if fmt is None:
+        fmt = guess_format(path)
+        if fmt is None:
+            raise ValueError(
+                "Can't tell the symbol format of {}".format(path))
+    try:
+        reader = READERS[fmt]
+    except LookupError:
+        raise ValueError("Unknown symbol format {!r}".format(fmt)) from None
+    with open(path, "r", errors="replace") as infile:
+        yield from reader(infile)
+
+def make_resolver(bus, rom_device):
+    """Make a function that gets the CPU address of a Symbol, or None."""
+    if rom_device is None:
+        rom_addresses = {}
+    else:
+        rom_addresses = bus.get_cpu_addresses(rom_device)
+
+    def resolve(symbol):
+        space, addr, _ = symbol
+        if space == CPU:
+            return addr if 0 < addr <= 0xFFFFFF else None
+        elif space == ROM:
+            return rom_addresses.get(addr, None)
+        elif space == WRAM:
+            return WRAM_BASE + addr if 0 <= addr < WRAM_SIZE else None
+        elif space == REGISTER:
+            return addr if 0 < addr <= 0xFFFF else None
+        # Where SRAM is mapped isn't known to the bus by device.
+        return None
+    return resolve
+
+def add_to_batch(symbols, edits, database, resolve):
+    """Add the labels for some Symbols to a Batch.
+
+    Labels that are already applied at the same address, or that are used
+    for another address by the database or an earlier symbol, are skipped.
+    Returns an ImportResult.
+    """
+    # Labels added by this import, with their addresses.
+    added = {}
+    existing = conflicts = unmapped = 0
+    for symbol in symbols:
+        name = symbol.name
+        addr = resolve(symbol)
+        if addr is None:
+            unmapped += 1
+            continue
+        if name in added:
+            if added[name] == addr:
+                existing += 1
+            else:
+                conflicts += 1
+            continue
+        if database.has_label(name):
+            if database.get_address_with_label(name) == addr:
+                existing += 1
+            else:
+                conflicts += 1
+            continue
+        added[name] = addr
+        edits.add_label(addr, name)
+    return ImportResult(len(added), existing, conflicts, unmapped)
@@ -0,0 +1,251 @@
+"""Import CPU trace logs from emulators.
+
+A trace log has a line for every instruction that the emulator executed,
+along with the register values at the time, so it's the most reliable source
+of the m/x/b/d state at an address. Traces of a few seconds of play run to
+gigabytes, so they are streamed a line at a time and reduced to the set of
+distinct (PC, state) pairs and control flow edges that were seen.
+
+Both bsnes-style and Mesen-style lines are understood, e.g.
+    008000 sei            A:0000 X:0000 Y:0000 S:01ff D:0000 DB:00 nvMXdIzc
+    00:8000 $78  SEI      A:0000 X:0000 Y:0000 S:01FF D:0000 DB:00 P:34
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import gzip
+import re
+
+import dsnes
+from dsnes.analyser import xref
+
+
+PC_RE = re.compile(r"\s*([0-9A-Fa-f]{2})[:/]?([0-9A-Fa-f]{4})\s")
+D_RE = re.compile(r"\bD:([0-9A-Fa-f]{4})\b")
+DB_RE = re.compile(r"\b(?:DB|B):([0-9A-Fa-f]{2})\b")
+# Flags as letters, where upper case is set, and an optional E after them.
+FLAGS_RE = re.compile(
+    r"\b(?:P:)?([Nn][Vv][Mm1][XxBb][Dd][Ii][Zz][Cc])\b(?:\s+([Ee])\b)?")
+# Flags as a hex byte.
+P_RE = re.compile(r"\bP:([0-9A-Fa-f]{2})\b")
+E_RE = re.compile(r"\bE:([01])\b")
+
+# The furthest apart two instructions can be and still run one after the
+# other.
+MAX_INSTRUCTION_LENGTH = 4
+
+# The kind of reference made by each NextAction.
+REFERENCE_KINDS = {
+    "call": xref.CALL,
+    "jump": xref.JUMP,
+    "branch": xref.BRANCH,
+}
+
+
+def read(path):
+    """Read a trace log file. It may be gzip compressed.
+
+    Returns a Trace.
+    """
+    trace = Trace()
+    if path.endswith(".gz"):
+        infile = gzip.open(path, "rt", errors="replace")
+    else:
+        infile = open(path, "r", errors="replace")
+    with infile:
+        trace.add_lines(infile)
+    return trace
+
+def parse_line(line):
+    """Parse a single trace log line.
+
+    Returns (pc, State), or None if the line isn't an instruction.
+    """
+    match = PC_RE.match(line)
+    if not match:
+        return None
+    pc = (int(match.group(1), 16) << 16) | int(match.group(2), 16)
+
+    e = m = x = c = None
+    flags = FLAGS_RE.search(line)
+    if flags:
+        p = flags.group(1)
+        if p[2] == "1":
+            # Emulation mode shows the fixed m bit and the break flag.
+            e = m = x = True
+        else:
+            # Only native mode shows the m and x bits.
+            e = False
+            m = p[2] == "M"
+            x = p[3] == "X"
+        c = p[7] == "C"
+        if flags.group(2):
+            e = flags.group(2) == "E"
+    else:
+        flags = P_RE.search(line)
+        if not flags:
+            return None
+        p = int(flags.group(1), 16)
+        m = bool(p & 0x20)
+        x = bool(p & 0x10)
+        c = bool(p & 0x01)
+    match = E_RE.search(line)
+    if match:
+        e = match.group(1) == "1"
+
+    b = d = None
+    match = DB_RE.search(line)
+    if match:
+        b = int(match.group(1), 16)
+    match = D_RE.search(line)
+    if match:
+        # The State only tracks a direct page within the zero page.
+        direct = int(match.group(1), 16)
+        if direct <= 0xFF:
+            d = direct
+    return pc, dsnes.State(e=e, m=m, x=x, c=c, b=b, d=d)
+
+def iter_records(lines):
+    """Generate (pc, packed state) for each instruction in the lines."""
+    for line in lines:
+        parsed = parse_line(line)
+        if parsed is not None:
+            pc, state = parsed
+            yield pc, state.pack()
+
+def merge_states(states):
+    """Merge States, keeping only what they all agree on."""
+    states = iter(states)
+    merged = next(states).clone()
+    for state in states:
+        for var in dsnes.State.VALID_VARS:
+            if getattr(merged, var) != getattr(state, var):
+                setattr(merged, var, None)
+    return merged
+
+
+class Trace:
+    """The distinct states and control flow seen in a trace."""
+
+    def __init__(self):
+        # Set of (packed state << 24) | pc.
+        self.keys = set()
+        # Set of addresses that execution arrived at from somewhere other
+        # than the instruction just before it.
+        self.entries = set()
+        # Set of (from << 24) | to, for each of those arrivals.
+        self.edges = set()
+        self.line_count = 0
+        self.instruction_count = 0
+        self._previous_pc = None
+
+    def add_lines(self, lines):
+        """Add the lines of a trace. Can be called again to continue it."""
+        keys = self.keys
+        entries = self.entries
+        edges = self.edges
+        previous = self._previous_pc
+        count = 0
+
+        def count_lines(lines):
+            for line in lines:
+                self.line_count += 1
+                yield line
+
+        for pc, packed in iter_records(count_lines(lines)):
+            count += 1
+            keys.add((packed << 24) | pc)
+            if previous is None:
+                entries.add(pc)
+            elif not (0 < pc - previous <= MAX_INSTRUCTION_LENGTH):
+                entries.add(pc)
+                edges.add((previous << 24) | pc)
+            previous = pc
+        self._previous_pc = previous
+        self.instruction_count += count
+
+    def get_states(self, addresses=None):
+        """Get the merged State for each address seen in the trace.
+
+        Returns a dict of {address: State}, optionally limited to some
+        addresses.
+        """
+        seen = {}
+        for key in self.keys:
+            pc = key & 0xFFFFFF
+            if addresses is None or pc in addresses:
+                seen.setdefault(pc, []).append(
+                    dsnes.State.unpack(key >> 24))
+        return {pc: merge_states(states) for pc, states in seen.items()}
+
+    def seed_database(self, database):
+        """Set states where execution arrived from somewhere else.
+
+        Like add_to_batch(), but makes the edits straight away.
+        Returns the number of states and deltas that were set.
+        """
+        with database.batch() as edits:
+            count = self.add_to_batch(edits, database)
+        return count
+
+    def add_to_batch(self, edits, database):
+        """Add the states where execution arrived from elsewhere to a Batch.
+
+        Where the trace doesn't show whether the CPU was in emulation mode,
+        the rest of the state can't stand on its own, so the bits that are
+        known are set as a state delta instead.
+        Addresses that already have a state or a state delta are left alone.
+        Returns the number of states and deltas that were added.
+        """
+        count = 0
+        for pc, state in sorted(self.get_states(self.entries).items()):
+            if state.encode() == "unknown":
+                continue
+            if (database.get_state(pc) is not None
+                    or database.get_state_delta(pc) is not None):
+                continue
+            if state.e is None:
+                known = [(var, getattr(state, var))
+                         for var in dsnes.State.VALID_VARS
+                         if getattr(state, var) is not None]
+                edits.set_state_delta(
+                    pc, dsnes.StateDelta(to_add=known, to_clear=[]))
+            else:
+                edits.set_state(pc, state)
+            count += 1
+        return count
+
+    def decode(self, bus):
+        """Disassemble every address in the trace with its merged state.
+
+        Returns a dict of {address: operation}. Addresses that can't be
+        disassembled are left out.
+        """
+        decoded = {}
+        for pc, state in self.get_states().items():
+            try:
+                decoded[pc] = dsnes.disassemble(pc, bus, state)
+            except (dsnes.AmbiguousDisassembly, dsnes.InvalidDisassembly,
+                    dsnes.BusReadImpossible, dsnes.UnmappedMemoryAccess,
+                    NotImplementedError):
+                continue
+        return decoded
+
+    def get_references(self, decoded):
+        """Get the control flow references that the trace took.
+
+        decoded is the result of decode(). Returns a list of
+        (source, target, kind) as for the XrefIndex.
+        """
+        references = []
+        for edge in self.edges:
+            source = edge >> 24
+            operation = decoded.get(source, None)
+            if operation is None:
+                continue
+            # Interrupts and returns also leave the instruction stream, but
+            # aren't references.
+            kind = REFERENCE_KINDS.get(operation.next_addr[0].name, None)
+            if kind is not None:
+                references.append((source, edge & 0xFFFFFF, kind))
+        return references
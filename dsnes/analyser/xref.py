@@ -0,0 +1,225 @@
+"""Cross-reference indexes built from analysis results."""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+from array import array
+from bisect import bisect_left
+
+import dsnes
+
+
+CALL = 1
+JUMP = 2
+BRANCH = 3
+
+KIND_NAMES = {
+    CALL: "call",
+    JUMP: "jump",
+    BRANCH: "branch",
+}
+
+READ = 1
+WRITE = 2
+MODIFY = 3
+
+ACCESS_NAMES = {
+    READ: "read",
+    WRITE: "write",
+    MODIFY: "modify",
+}
+
+WRITE_MNEMONICS = frozenset(("sta", "stx", "sty", "stz"))
+MODIFY_MNEMONICS = frozenset(
+    ("inc", "dec", "asl", "lsr", "rol", "ror", "tsb", "trb"))
+
+# The bits of a key in an entry that is sorted by source.
+KEY_MASK = (1 << 38) - 1
+
+
+def by_source(entry):
+    """Repack a (key << 26) | (source << 2) | kind entry to sort by source."""
+    return (((entry >> 2) & 0xFFFFFF) << 40) | ((entry >> 26) << 2) | (
+        entry & 0x3)
+
+def by_key(entry):
+    """Undo by_source()."""
+    return ((((entry >> 2) & KEY_MASK) << 26) | ((entry >> 40) << 2)
+            | (entry & 0x3))
+
+def splice(entries, remove, insert):
+    """Copy a sorted array, taking some entries out and putting others in.
+
+    remove and insert are sorted. Only the runs of entries between them are
+    copied, so the cost is a binary search for each of them and a copy of
+    the array, rather than a sort of the whole thing. Entries to insert
+    that are already there aren't doubled up.
+    """
+    edits = [(entry, False) for entry in remove]
+    edits.extend((entry, True) for entry in insert)
+    edits.sort()
+    result = array("Q")
+    start = 0
+    size = len(entries)
+    for entry, is_insert in edits:
+        i = bisect_left(entries, entry, start)
+        result.extend(entries[start:i])
+        start = i
+        if i < size and entries[i] == entry:
+            if not is_insert:
+                # Skip over it.
+                start += 1
+        elif is_insert:
+            result.append(entry)
+    result.extend(entries[start:])
+    return result
+
+
+class PackedIndex:
+    """Entries packed as (key << 26) | (source << 2) | kind, in sorted arrays.
+
+    The entries are sorted by key so that a lookup is a pair of binary
+    searches, and also sorted by source so that replacing what a source
+    refers to only touches its own entries.
+    """
+
+    def __init__(self):
+        self.keys = array("Q")
+        # The same entries repacked by by_source().
+        self.sources = array("Q")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def replace(self, sources, new):
+        """Replace the entries from some sources with a set of new ones."""
+        old = []
+        entries = self.sources
+        for source in sorted(set(sources)):
+            lo = bisect_left(entries, source << 40)
+            hi = bisect_left(entries, (source + 1) << 40, lo)
+            old.extend(entries[lo:hi])
+        self.sources = splice(
+            entries, old, sorted(by_source(entry) for entry in new))
+        self.keys = splice(
+            self.keys, sorted(by_key(entry) for entry in old), sorted(new))
+
+
+class XrefIndex(PackedIndex):
+    """Index of control flow references, keyed by target address.
+
+    Each reference is packed into a single int as
+    (target << 26) | (source << 2) | kind.
+    """
+
+    def add_analysis(self, analyser):
+        """Add (or replace) the references found by an analyser."""
+        self.update(analyser.visited, analyser.references)
+
+    def update(self, sources, refs):
+        """Replace all references made from the given source addresses.
+
+        refs is an iterable of (source, target, kind).
+        """
+        self.replace(sources, {(target << 26) | (source << 2) | kind
+                               for source, target, kind in refs})
+
+    def get_references_to(self, target):
+        """Get the references to a target address.
+
+        Returns a list of (source, kind), sorted by source address.
+        """
+        keys = self.keys
+        lo = bisect_left(keys, target << 26)
+        hi = bisect_left(keys, (target + 1) << 26, lo)
+        return [((k >> 2) & 0xFFFFFF, k & 0x3) for k in keys[lo:hi]]
+
+
+class DataXrefIndex(PackedIndex):
+    """Index of data accesses, keyed by the memory that is accessed.
+
+    Accesses are keyed by the bus' canonical key for the target address, so
+    every mirror of a WRAM variable or I/O register shares the same entries.
+    Each access is packed into a single int as
+    (canonical_key << 26) | (source << 2) | access.
+    """
+
+    def __init__(self, bus):
+        super().__init__()
+        self.bus = bus
+        # Canonical key to the first CPU address seen for it.
+        self.addresses = {}
+
+    def add_analysis(self, analyser):
+        """Add (or replace) the data accesses found by an analyser."""
+        refs = []
+        for operation in analyser.operations:
+            if isinstance(operation, dsnes.analyser.AnalyserError):
+                continue
+            target = operation.target_info.addr
+            if target is None:
+                continue
+            access = access_kind(operation)
+            if access is not None:
+                refs.append((operation.addr, target, access))
+        self.update(analyser.visited, refs)
+
+    def update(self, sources, refs):
+        """Replace all accesses made from the given source addresses.
+
+        refs is an iterable of (source, target, access).
+        """
+        canonical_key = self.bus.canonical_key
+        addresses = self.addresses
+        new = set()
+        for source, target, access in refs:
+            key = canonical_key(target)
+            addresses.setdefault(key, target)
+            new.add((key << 26) | (source << 2) | access)
+        self.replace(sources, new)
+
+    def get_accesses(self, lo, hi=None):
+        """Get the accesses to the memory in the CPU address range [lo, hi].
+
+        Both ends of the range must map to the same memory device.
+        Returns a list of (source, target, access), sorted by target.
+        """
+        if hi is None:
+            hi = lo
+        key_lo = self.bus.canonical_key(lo)
+        key_hi = self.bus.canonical_key(hi)
+        if (key_lo >> 24) != (key_hi >> 24) or key_lo > key_hi:
+            raise ValueError(
+                "0x{:06x}-0x{:06x} is not a range within one "
+                "device".format(lo, hi))
+
+        keys = self.keys
+        start = bisect_left(keys, key_lo << 26)
+        end = bisect_left(keys, (key_hi + 1) << 26, start)
+        addresses = self.addresses
+        return [((k >> 2) & 0xFFFFFF, addresses[k >> 26], k & 0x3)
+                for k in keys[start:end]]
+
+
+def access_kind(operation):
+    """Work out how an operation accesses its target.
+
+    Returns READ, WRITE, MODIFY, or None if the target isn't data (e.g. the
+    destination of a branch).
+    """
+    info = dsnes.disassembler.codes[operation.raw[0]]
+    if isinstance(info, (dsnes.disassembler.AbsXInd,
+                         dsnes.disassembler.JumpAbsInd,
+                         dsnes.disassembler.JumpAbsIndLong)):
+        # Reads the pointer to jump to.
+        return READ
+    if operation.next_addr[0] is not dsnes.NextAction.step:
+        return None
+    if isinstance(info, dsnes.disassembler.PushEffectiveAbs):
+        # Pushes the operand itself, not what it points at.
+        return None
+    mnemonic = info.mnemonic
+    if mnemonic in WRITE_MNEMONICS:
+        return WRITE
+    if mnemonic in MODIFY_MNEMONICS:
+        return MODIFY
+    return READ
@@ -25,9 +25,20 @@ class Bus:
         # Maps ids to access functions.
         self.reader = {}
         self.labeller = {}
+        # Ids of the mappings that are I/O registers, rather than memory.
+        self.registers = set()
+        # Maps ids to device ids. Mappings that share the same access
+        # functions are treated as views of the same memory device.
+        self.device = {}
+        # Maps (read_fn, label_fn) to device ids.
+        self.device_ids = {}
+        # Maps device ids to {device memory address: CPU address}. Built
+        # when first needed.
+        self.cpu_addresses = {}
 
     def map(self, bank_lo, bank_hi, addr_lo, addr_hi, size=0, base=0,
-            mask=0, source_offset=0, read_fn=None, label_fn=None):
+            mask=0, source_offset=0, read_fn=None, label_fn=None,
+            register=False):
         if read_fn is None:
             read_fn = default_read_fn
         if label_fn is None:
@@ -56,7 +67,13 @@ class Bus:
 
         self.reader[idx] = read_fn
         self.labeller[idx] = label_fn
+        if register:
+            self.registers.add(idx)
+        # Device id 0 is reserved for unmapped memory.
+        self.device[idx] = self.device_ids.setdefault(
+            (read_fn, label_fn), len(self.device_ids) + 1)
         self.map_count = idx
+        self.cpu_addresses.clear()
 
     def read(self, addr):
         addr = int(addr)
@@ -68,6 +85,84 @@ class Bus:
             raise dsnes.UnmappedMemoryAccess(addr) from ex
         return reader(dev_addr)
 
+    def read_block(self, addr, length):
+        """Read up to length bytes, starting at addr.
+
+        Reads stay within the bank of the starting address, wrapping from
+        $FFFF back to $0000 as the CPU does for program and table reads.
+        Stops early at the first byte that can't be read, so the result may
+        be shorter than requested.
+        Returns bytes.
+        """
+        addr = int(addr)
+        pbr = addr & 0xFF0000
+        pc = addr & 0xFFFF
+        lookup = self.lookup
+        target = self.target
+        reader_of = self.reader
+        data = bytearray()
+        for _ in range(length):
+            a = pbr | pc
+            try:
+                data.append(reader_of[lookup[a]](target[a]))
+            except (LookupError, dsnes.BusReadImpossible):
+                break
+            pc = (pc + 1) & 0xFFFF
+        return bytes(data)
+
+    def resolve(self, addr):
+        """Get the (device id, device address) that a CPU address maps to."""
+        addr = int(addr)
+        try:
+            map_id = self.lookup[addr]
+            dev_addr = self.target[addr]
+        except LookupError as ex:
+            raise dsnes.UnmappedMemoryAccess(addr) from ex
+        return self.device[map_id], dev_addr
+
+    def device_for(self, read_fn, label_fn=None):
+        """Get the device id of the memory with these access functions.
+
+        Returns None if that memory hasn't been mapped.
+        """
+        if label_fn is None:
+            label_fn = default_label_fn
+        return self.device_ids.get((read_fn, label_fn), None)
+
+    def get_cpu_addresses(self, device):
+        """Get a CPU address for each address within a memory device.
+
+        Where several CPU addresses are mirrors of the same memory, the one
+        from the earliest mapping is used.
+        Returns a dict of {device address: CPU address}.
+        """
+        try:
+            return self.cpu_addresses[device]
+        except LookupError:
+            pass
+        map_ids = {idx for idx, dev in self.device.items() if dev == device}
+        lookup = self.lookup
+        addresses = {}
+        for cpu_addr, dev_addr in self.target.items():
+            if lookup[cpu_addr] in map_ids:
+                addresses.setdefault(dev_addr, cpu_addr)
+        self.cpu_addresses[device] = addresses
+        return addresses
+
+    def canonical_key(self, addr):
+        """Get an int that identifies the memory behind a CPU address.
+
+        All mirrors of the same memory location have the same key, so e.g.
+        00:0010 and 7e:0010 share a key. Unmapped addresses are keyed as
+        themselves, in device 0.
+        """
+        addr = int(addr)
+        try:
+            map_id = self.lookup[addr]
+        except LookupError:
+            return addr
+        return (self.device[map_id] << 24) | self.target[addr]
+
     def get_label(self, addr):
         addr = int(addr)
         try:
@@ -78,6 +173,28 @@ class Bus:
             raise dsnes.UnmappedMemoryAccess(addr) from ex
         return labeller(dev_addr)
 
+    def is_register(self, addr):
+        """Check if a CPU address maps to an I/O register."""
+        return self.lookup.get(int(addr), None) in self.registers
+
+    def get_labels(self, addresses):
+        """Get the hardware labels for many addresses at once.
+
+        Returns a dict of {address: label}. The label may be None.
+        Unmapped addresses are left out of the dict.
+        """
+        lookup = self.lookup
+        target = self.target
+        labeller_of = self.labeller
+        labels = {}
+        for addr in addresses:
+            try:
+                map_id = lookup[addr]
+            except LookupError:
+                continue
+            labels[addr] = labeller_of[map_id](target[addr])
+        return labels
+
 
 def make_reduce_fn(mask):
     """Make a function that computes the effective memory device address.
@@ -98,6 +215,10 @@ def make_reduce_fn(mask):
         def reduce_fn(addr, mask):
             return (addr & 0x7FFF) + ((addr >> 1) & 0xFFFF8000)
 
+    elif mask == 0xFF0000:
+        def reduce_fn(addr, mask):
+            return addr & 0xFFFF
+
     else:
         def reduce_fn(addr, mask):
             while mask:
@@ -7,6 +7,11 @@ import os
 import dsnes
 
 
+# The I/O registers don't decode the bank; every bank they are mapped into
+# sees the same register.
+REGISTER_MASK = 0xFF0000
+
+
 class Cartridge:
     def __init__(self):
         self.rom = None
@@ -67,6 +72,7 @@ class Cartridge:
                     bank_lo=bank_lo, bank_hi=bank_hi,
                     addr_lo=addr_lo, addr_hi=addr_hi,
                     source_offset=offset,
+                    register=True,
                     label_fn=dsnes.superfxreg.get_label)
 
     @staticmethod
@@ -102,6 +108,8 @@ class Cartridge:
                 project.bus.map(
                     bank_lo=bank_lo, bank_hi=bank_hi,
                     addr_lo=addr_lo, addr_hi=addr_hi,
+                    mask=REGISTER_MASK,
+                    register=True,
                     label_fn=dsnes.apureg.get_label)
 
     @staticmethod
@@ -111,6 +119,8 @@ class Cartridge:
                 project.bus.map(
                     bank_lo=bank_lo, bank_hi=bank_hi,
                     addr_lo=addr_lo, addr_hi=addr_hi,
+                    mask=REGISTER_MASK,
+                    register=True,
                     label_fn=dsnes.cpureg.get_label)
 
     @staticmethod
@@ -120,6 +130,8 @@ class Cartridge:
                 project.bus.map(
                     bank_lo=bank_lo, bank_hi=bank_hi,
                     addr_lo=addr_lo, addr_hi=addr_hi,
+                    mask=REGISTER_MASK,
+                    register=True,
                     label_fn=dsnes.dmareg.get_label)
 
     @staticmethod
@@ -129,6 +141,8 @@ class Cartridge:
                 project.bus.map(
                     bank_lo=bank_lo, bank_hi=bank_hi,
                     addr_lo=addr_lo, addr_hi=addr_hi,
+                    mask=REGISTER_MASK,
+                    register=True,
                     label_fn=dsnes.ppureg.get_label)
 
     @staticmethod
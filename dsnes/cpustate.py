@@ -98,6 +98,35 @@ class State:
         else:
             return "unknown"
 
+    def pack(self):
+        """Pack the state into a single int.
+
+        Each flag takes 2 bits (0 unknown, 1 clear, 2 set) and each register
+        takes 9 bits (0 unknown, else value + 1).
+        """
+        code = 0
+        for shift, flag in enumerate((self.e, self.m, self.x, self.c)):
+            if flag is not None:
+                code |= (2 if flag else 1) << (shift * 2)
+        if self.b is not None:
+            code |= (self.b + 1) << 8
+        if self.d is not None:
+            code |= (self.d + 1) << 17
+        return code
+
+    @classmethod
+    def unpack(cls, code):
+        """Make a State from the result of pack()."""
+        flags = []
+        for shift in range(4):
+            bits = (code >> (shift * 2)) & 0x3
+            flags.append(None if bits == 0 else bits == 2)
+        e, m, x, c = flags
+        b = (code >> 8) & 0x1FF
+        d = (code >> 17) & 0x1FF
+        return cls(e=e, m=m, x=x, c=c,
+                   b=b - 1 if b else None, d=d - 1 if d else None)
+
     @classmethod
     def parse(cls, s):
         kwargs = {}
@@ -1,4 +1,5 @@
 # Copyright 2017 Adrian Chan
 # Licensed under GPLv3
 
+from . import autosave, undo
 from .session import Session, NoOperation
@@ -0,0 +1,124 @@
+"""Save the database on a background thread.
+
+The changes to save are taken on the calling thread, which is cheap, and
+written out on a worker thread, so editing carries on while a big database
+is written. Jobs are written one at a time, in order.
+Other project files, such as the analysis cache, can be saved along with
+the database each time, or the same way with add().
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import queue
+import threading
+import time
+
+
+class Autosaver:
+    def __init__(self, database, interval=None, others=(), lock=None):
+        self.database = database
+        # Saved after the database each time, while holding lock if there is
+        # one. Like add(), for files that must keep in step with it.
+        self.others = list(others)
+        self.lock = lock
+        # Seconds between automatic saves, or None for none.
+        self.interval = interval
+        self.last_save = time.monotonic()
+        # The exceptions from jobs that failed, oldest first.
+        self.errors = []
+        self._jobs = queue.Queue()
+        self._finished = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._work, name="autosave", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Finish the jobs that have been queued, and stop the thread."""
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+            self._thread = None
+        self._collect()
+
+    @property
+    def is_dirty(self):
+        return (self.database.is_dirty
+                or any(owner.is_dirty for owner in self.others))
+
+    def save(self):
+        """Queue a save of the changes made so far."""
+        self.last_save = time.monotonic()
+        self.add(self.database)
+        if self.lock is None:
+            self._add_others()
+        else:
+            # After the database's lock, which prepare_save() has let go of.
+            with self.lock.write():
+                self._add_others()
+
+    def _add_others(self):
+        for owner in self.others:
+            self.add(owner)
+
+    def add(self, owner):
+        """Queue a save of something other than the database.
+
+        Like the database, owner has prepare_save(), which returns a job or
+        None, and restore_unsaved() for a job that failed.
+        """
+        job = owner.prepare_save()
+        if job is not None:
+            self.start()
+            self._jobs.put((owner, job))
+
+    def flush(self):
+        """Wait for the queued jobs to be written.
+
+        Returns the errors from jobs that failed since the last call.
+        """
+        self._jobs.join()
+        return self.poll()
+
+    def poll(self):
+        """Deal with finished jobs, and save if it's time to.
+
+        Must be called on the same thread as save(), now and then.
+        Returns the errors from jobs that failed since the last call.
+        """
+        self._collect()
+        if (self.interval is not None and self.is_dirty
+                and time.monotonic() - self.last_save >= self.interval):
+            self.save()
+        errors = self.errors
+        self.errors = []
+        return errors
+
+    def _collect(self):
+        while True:
+            try:
+                owner, job, error = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            if error is not None:
+                owner.restore_unsaved(job)
+                self.errors.append(error)
+
+    def _work(self):
+        while True:
+            item = self._jobs.get()
+            try:
+                if item is None:
+                    return
+                owner, job = item
+                try:
+                    job.run()
+                except Exception as ex:
+                    self._finished.put((owner, job, ex))
+                else:
+                    self._finished.put((owner, job, None))
+            finally:
+                self._jobs.task_done()
@@ -2,6 +2,7 @@
 # Licensed under GPLv3
 
 import collections
+import contextlib
 
 import dsnes
 
@@ -16,6 +17,21 @@ class Session:
         self.analysis_stack = collections.deque()
         self.current_analysis = None
         self.line_number = None
+        self.xrefs = None
+        self.data_xrefs = None
+        self.analysis_cache = None
+        self.codemap = None
+        # Queue of (address, state) of functions still to be analysed.
+        self.entry_points = collections.deque()
+        # Open analysers that the database has changed under, and what
+        # they need to catch up.
+        self.stale_analyses = {}
+        # Saves the database in the background.
+        self.autosaver = None
+        self.history = dsnes.interactive.undo.UndoHistory()
+        # Guards the analysis state above, for analyses on other threads.
+        # Always taken after the database's lock, never before it.
+        self.lock = dsnes.analyser.rwlock.RWLock()
 
     @property
     def has_unsaved_changes(self):
@@ -62,33 +78,175 @@ class Session:
             raise RuntimeError("Project already loaded")
         if not path:
             raise RuntimeError("Must provide a path")
-        self.project = dsnes.project.load(path)
-        self.analysis_stack.clear()
-
-    def save_project(self):
+        project = dsnes.project.load(path)
+        with self.lock.write():
+            self.project = project
+            self.analysis_stack.clear()
+            self.entry_points.clear()
+            self.xrefs = dsnes.analyser.xref.XrefIndex()
+            self.data_xrefs = dsnes.analyser.xref.DataXrefIndex(project.bus)
+            self.analysis_cache = dsnes.analyser.cache.load(project)
+            self.analysis_cache.validate(project.database)
+            for visited, references in self.analysis_cache.iter_references():
+                self.xrefs.update(visited, references)
+            self.codemap = dsnes.analyser.codemap.load(project)
+            self.stale_analyses.clear()
+            project.database.changes.subscribe(self._on_database_changed)
+            self.autosaver = dsnes.interactive.autosave.Autosaver(
+                project.database,
+                others=(self.analysis_cache, self.codemap), lock=self.lock)
+            self.history.clear()
+
+    def _on_database_changed(self, events):
+        """Note which open analyses a database change affects."""
+        with self.lock.write():
+            open_analyses = [analyser for analyser, _ in self.analysis_stack]
+            if self.current_analysis is not None:
+                open_analyses.append(self.current_analysis)
+            stale = self.stale_analyses
+            for analyser in open_analyses:
+                if (stale.get(analyser, None)
+                        == dsnes.analyser.changes.REANALYSE):
+                    continue
+                action = analyser.affected_by(events)
+                if action is not None:
+                    stale[analyser] = action
+
+    def save_project(self, background=False):
+        """Save the database, the analysis cache and the code map.
+
+        With background, they're written by the autosaver's thread and this
+        returns straight away.
+        """
         if self.project is None:
             raise RuntimeError("No project is loaded")
-        self.project.save()
-
-    def new_analysis(self, address, state=None):
-        analyser = dsnes.Analyser(self.project)
-        analyser.analyse_function(address, state)
+        if background:
+            self.autosaver.save()
+        else:
+            # Let queued saves finish first, so they're written in order.
+            # The changes from any that failed are saved again here.
+            self.autosaver.flush()
+            self.project.save()
+            with self.lock.write():
+                self.analysis_cache.save()
+                self.codemap.save()
+
+    def _analyse(self, address, state, control=None):
+        """Analyse a function, and record what was found in the indexes.
+
+        Uses the cached result if the function has been analysed before.
+        control is an optional AnalysisControl for a fresh analysis. Only
+        analyses that run to completion are cached.
+        """
+        with self.lock.write():
+            analyser = self.analysis_cache.restore(
+                self.project, address, state)
+            if analyser is None:
+                analyser = dsnes.Analyser(self.project)
+                analyser.analyse_function(address, state, control=control)
+                if analyser.is_complete:
+                    self.analysis_cache.store(analyser)
+            self._add_to_indexes(analyser)
+        return analyser
+
+    def _add_to_indexes(self, analyser):
+        self.xrefs.add_analysis(analyser)
+        self.data_xrefs.add_analysis(analyser)
+        self.codemap.add_analysis(analyser)
+
+    def new_analysis(self, address, state=None, control=None):
+        with self.lock.write():
+            analyser = self._analyse(address, state, control)
+            self._open(analyser)
+
+    def _open(self, analyser):
         self.analysis_stack.clear()
+        self.stale_analyses.clear()
         self.current_analysis = analyser
         self.line_number = 0
 
-    def refresh_analysis(self):
-        address = self.current_analysis.start_address
+    def analyse_detached(self, address, state=None, control=None):
+        """Analyse a function without changing the session.
+
+        Can be called on a background thread while the GUI thread carries
+        on editing, as the analysis reads a view of the database taken when
+        it starts. Pass the result to open_analysis() on the GUI thread.
+        Returns the Analyser.
+        """
+        if self.project is None:
+            raise RuntimeError("No project is loaded")
+        view = self.project.database.view()
+        with view.lock.read():
+            # Looking up can drop a stale entry from the cache, but the
+            # rebuild only reads the entry and the view.
+            with self.lock.write():
+                entry = self.analysis_cache.lookup(address, state, view)
+            if entry is not None:
+                analyser = dsnes.analyser.cache.rebuild(
+                    self.project, address, state, entry, view)
+            else:
+                analyser = dsnes.Analyser(self.project, view)
+                analyser.analyse_function(address, state, control=control)
+        return analyser
+
+    def open_analysis(self, analyser):
+        """Make an analysis from analyse_detached() the current one.
+
+        If the database has changed since the analysis started in a way
+        that might affect it, refresh_analysis() will analyse it again.
+        """
+        database = self.project.database
+        with database.lock.read(), self.lock.write():
+            view = analyser.database
+            changed = False
+            if view is not database:
+                banks = {addr >> 16 for addr in analyser.visited}
+                banks.update(addr >> 16 for addr in analyser.targets)
+                before = view.changes.bank_generations
+                after = database.changes.bank_generations
+                changed = any(before[bank] != after[bank] for bank in banks)
+            if analyser.is_complete and not changed:
+                self.analysis_cache.store(analyser)
+            analyser.database = database
+            self._add_to_indexes(analyser)
+            self._open(analyser)
+            if changed:
+                self.stale_analyses[analyser] = (
+                    dsnes.analyser.changes.REANALYSE)
+
+    def refresh_analysis(self, control=None):
+        """Bring the current analysis up to date with the database.
+
+        Only does as much as the database changes since it was last brought
+        up to date need. Returns changes.RECOLLATE or changes.REANALYSE for
+        what was done, or None if nothing needed doing.
+        """
+        with self.lock.write():
+            return self._refresh_analysis(control)
+
+    def _refresh_analysis(self, control):
+        current = self.current_analysis
+        address = current.start_address
         assert address is not None
-        state = self.current_analysis.start_state
+        state = current.start_state
 
-        new_analysis = dsnes.Analyser(self.project)
-        new_analysis.analyse_function(address, state)
-        self.current_analysis = new_analysis
+        action = self.stale_analyses.pop(current, None)
+        if action is None and not current.is_complete:
+            # Carry on with an analysis that was stopped early.
+            action = dsnes.analyser.changes.REANALYSE
+        if action is None:
+            return None
+        elif action == dsnes.analyser.changes.RECOLLATE:
+            current.recollate()
+        else:
+            self.current_analysis = self._analyse(address, state, control)
 
-        max_line = len(new_analysis.disassembly) - 1
-        if self.line_number > max_line:
+        max_line = len(self.current_analysis.disassembly) - 1
+        if max_line < 0:
+            self.line_number = None
+        elif self.line_number is not None and self.line_number > max_line:
             self.line_number = max_line
+        return action
 
     def get_calls_from_line(self, line_number=None):
         analyser = self.current_analysis
@@ -96,7 +254,11 @@ class Session:
             raise RuntimeError("No analysis is open")
         return analyser.get_calls_from(line_number or self.line_number)
 
-    def follow_call(self, target, state):
+    def follow_call(self, target, state, control=None):
+        with self.lock.write():
+            self._follow_call(target, state, control)
+
+    def _follow_call(self, target, state, control):
         current_analyser = self.current_analysis
         current_line = self.line_number
         if not current_analyser:
@@ -109,24 +271,130 @@ class Session:
         if not valid:
             raise NoOperation("Not a valid call")
 
-        follow_analyser = dsnes.Analyser(self.project)
-        follow_analyser.analyse_function(target, state)
+        follow_analyser = self._analyse(target, state, control)
         self.line_number = 0
 
         self.analysis_stack.append((current_analyser, current_line))
         self.current_analysis = follow_analyser
 
+    def import_trace(self, path):
+        """Import an emulator trace log.
+
+        Seeds the database with the states seen where execution arrived
+        from elsewhere, as a single batch which is undone as one step. Also
+        marks every traced instruction in the code map, and adds the jumps,
+        calls and branches taken to the references.
+        Returns the Trace.
+        """
+        if self.project is None:
+            raise RuntimeError("No project is loaded")
+        trace = dsnes.analyser.trace.read(path)
+        with self.batch() as edits:
+            trace.add_to_batch(edits, self.project.database)
+        decoded = trace.decode(self.project.bus)
+        with self.lock.write():
+            self.codemap.add_operations(decoded.values())
+            self.xrefs.update((), trace.get_references(decoded))
+        return trace
+
+    def import_cdl(self, path):
+        """Import an emulator code/data log.
+
+        Marks the logged data in the code map, and queues every logged
+        subroutine entry point for analysis with the m/x state it was
+        entered with.
+        Returns the number of entry points queued.
+        """
+        if self.project is None:
+            raise RuntimeError("No project is loaded")
+        rom = self.project.cartridge.rom
+        if rom is None:
+            raise RuntimeError("Project has no ROM")
+        with dsnes.analyser.cdl.open_cdl(path, rom.size) as cdl:
+            with self.lock.write():
+                cdl.mark_codemap(self.codemap)
+                entry_points = cdl.get_entry_points(
+                    self.project.bus, self.codemap.rom_device)
+                self.entry_points.extend(entry_points)
+        return len(entry_points)
+
+    def import_symbols(self, path, fmt=None):
+        """Import labels from a symbol file made by another tool.
+
+        fmt is one of symbols.FORMATS, and is guessed from the file name if
+        not given. The labels are added as a single batch, which is undone
+        as one step. Labels that are already in use are skipped.
+        Returns a symbols.ImportResult.
+        """
+        if self.project is None:
+            raise RuntimeError("No project is loaded")
+        symbols = dsnes.analyser.symbols
+        resolve = symbols.make_resolver(
+            self.project.bus, self.codemap.rom_device)
+        with self.batch() as edits:
+            result = symbols.add_to_batch(
+                symbols.read(path, fmt), edits, self.project.database,
+                resolve)
+        return result
+
+    def run_queued_analyses(self, control=None):
+        """Analyse the functions in the entry point queue.
+
+        Functions that are already known code are skipped. The results go
+        to the cache and indexes, but don't change the current analysis.
+        control is an optional AnalysisControl used for each analysis;
+        cancelling it leaves the rest of the queue for later.
+        Returns the number of functions analysed.
+        """
+        count = 0
+        entry_points = self.entry_points
+        while entry_points:
+            address, state = entry_points.popleft()
+            if self.codemap.is_opcode(address):
+                continue
+            analyser = self._analyse(address, state, control)
+            count += 1
+            if analyser.stop_reason == dsnes.analyser.control.CANCELLED:
+                break
+        return count
+
+    def get_references_to(self, addr):
+        """Get the known jumps, calls and branches to an address.
+
+        Only covers code that has been analysed during this session.
+        Returns a list of (source_address, kind_name).
+        """
+        if self.xrefs is None:
+            raise RuntimeError("No project is loaded")
+        return [(source, dsnes.analyser.xref.KIND_NAMES[kind])
+                for source, kind in self.xrefs.get_references_to(addr)]
+
+    def get_data_accesses(self, lo, hi=None):
+        """Get the instructions that access memory in the range [lo, hi].
+
+        Mirrors are taken into account, so asking about 7e:0010 also finds
+        accesses to 00:0010. Only covers code that has been analysed during
+        this session.
+        Returns a list of (source_address, target_address, access_name).
+        """
+        if self.data_xrefs is None:
+            raise RuntimeError("No project is loaded")
+        return [(source, target, dsnes.analyser.xref.ACCESS_NAMES[access])
+                for source, target, access
+                in self.data_xrefs.get_accesses(lo, hi)]
+
     def can_jump_back(self):
         return len(self.analysis_stack) > 0
 
     def jump_back(self):
-        try:
-            analyser, line_number = self.analysis_stack.pop()
-        except LookupError:
-            raise NoOperation("Nowhere to jump back to")
-        else:
-            self.current_analysis = analyser
-            self.line_number = line_number
+        with self.lock.write():
+            try:
+                analyser, line_number = self.analysis_stack.pop()
+            except LookupError:
+                raise NoOperation("Nowhere to jump back to")
+            else:
+                self.current_analysis = analyser
+                self.line_number = line_number
 
     def can_create_new_label(self, text):
         """Check if a given label can be created."""
@@ -134,22 +402,112 @@ class Session:
             return False, "Label cannot be empty"
 
         fail_msg = None
-        valid = text not in self.project.database.get_all_labels()
+        valid = not self.project.database.has_label(text)
         if not valid:
             fail_msg = "That label is already used somewhere else"
         return valid, fail_msg
 
+    def suggest_labels(self, text, limit=20):
+        """Get labels to offer as completions of some text.
+
+        Labels that start with the text come first, then fuzzy matches.
+        """
+        database = self.project.database
+        suggestions = database.complete_label(text, limit)
+        if len(suggestions) < limit and len(text) >= 2:
+            seen = set(suggestions)
+            for label in database.search_labels(text, limit):
+                if label not in seen:
+                    suggestions.append(label)
+                    if len(suggestions) >= limit:
+                        break
+        return suggestions
+
+    def parse_goto_target(self, text):
+        """Get the address for a label or a number typed into goto.
+
+        Raises ValueError if it's neither.
+        """
+        text = text.strip()
+        address = self.project.database.get_address_with_label(text)
+        if address is not None:
+            return address
+        try:
+            address = int(text, 0)
+        except ValueError:
+            raise ValueError("{!r} is not a label or an address".format(
+                text)) from None
+        if address < 0 or address > 0xFFFFFF:
+            raise ValueError("Address 0x{:06x} is out of range".format(address))
+        return address
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Make many database edits at once, at the end of the block.
+
+        Yields a Batch to make the edits on. The edits are all checked before
+        any are made, and the current analysis is refreshed once afterwards.
+        They are undone as a single step.
+        Raises ValueError, and changes nothing, if any edit can't be made.
+        """
+        if self.project is None:
+            raise RuntimeError("No project is loaded")
+        edits = dsnes.analyser.batch.Batch()
+        yield edits
+        if not edits:
+            return
+        database = self.project.database
+        undo_edits = dsnes.interactive.undo.edits_for(database, edits)
+        database.apply_batch(edits)
+        self.history.record(undo_edits)
+        if self.current_analysis is not None:
+            self.refresh_analysis()
+
+    def _apply_history_batch(self, edits):
+        self.project.database.apply_batch(edits)
+        if self.current_analysis is not None:
+            self.refresh_analysis()
+
+    def can_undo(self):
+        return self.history.can_undo()
+
+    def can_redo(self):
+        return self.history.can_redo()
+
+    def undo(self):
+        """Undo the last annotation edit, or batch of edits.
+
+        Raises ValueError, and changes nothing, if the database has been
+        changed in a way that stops the edits being undone.
+        """
+        if not self.history.can_undo():
+            raise NoOperation("Nothing to undo")
+        self.history.undo(self._apply_history_batch)
+
+    def redo(self):
+        """Make the last undone edit again."""
+        if not self.history.can_redo():
+            raise NoOperation("Nothing to redo")
+        self.history.redo(self._apply_history_batch)
+
+    def _record(self, kind, addr, old, new):
+        """Remember a single edit that has been made, for undo."""
+        self.history.record(
+            [dsnes.interactive.undo.Edit(kind, addr, old, new)])
+
     def apply_new_label(self, addr, text):
         """Apply a label to an address."""
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
         self.project.database.add_label(addr, text)
+        self._record(dsnes.analyser.changes.LABEL, addr, None, text)
 
     def remove_label(self, addr, text):
         """Remove the label from an address."""
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
         self.project.database.remove_label(addr, text)
+        self._record(dsnes.analyser.changes.LABEL, addr, text, None)
 
     def is_valid_state(self, text):
         """Check if something is a valid state string."""
@@ -162,18 +520,30 @@ class Session:
             fail_msg = str(ex)
         return valid, fail_msg
 
+    def _encoded_state(self, addr):
+        state = self.project.database.get_state(addr)
+        return None if state is None else state.encode()
+
+    def _encoded_state_delta(self, addr):
+        delta = self.project.database.get_state_delta(addr)
+        return None if delta is None else delta.encode()
+
     def set_state(self, addr, text):
         """Set the state at an address."""
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
         state = dsnes.State.parse(text)
+        old = self._encoded_state(addr)
         self.project.database.set_state(addr, state)
+        self._record(dsnes.analyser.changes.STATE, addr, old, state.encode())
 
     def remove_state(self, addr):
         """Remove the state from an address."""
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
+        old = self._encoded_state(addr)
         self.project.database.remove_state(addr)
+        self._record(dsnes.analyser.changes.STATE, addr, old, None)
 
     def is_valid_state_delta(self, text):
         """Check is something is a valid state delta string."""
@@ -191,13 +561,42 @@ class Session:
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
         delta = dsnes.StateDelta.parse(text)
+        old = self._encoded_state_delta(addr)
         self.project.database.set_state_delta(addr, delta)
+        self._record(
+            dsnes.analyser.changes.STATE_DELTA, addr, old, delta.encode())
 
     def remove_state_delta(self, addr):
         """Remove the state delta from an address."""
         if addr < 0 or addr > 0xFFFFFF:
             raise ValueError("Address 0x{:06x} is out of range".format(addr))
+        old = self._encoded_state_delta(addr)
         self.project.database.remove_state_delta(addr)
+        self._record(dsnes.analyser.changes.STATE_DELTA, addr, old, None)
+
+    def set_pre_comment(self, addr, text):
+        """Set the comment shown before an address."""
+        old = self.project.database.get_pre_comment(addr)
+        self.project.database.set_pre_comment(addr, text)
+        self._record(dsnes.analyser.changes.PRE_COMMENT, addr, old, text)
+
+    def delete_pre_comment(self, addr):
+        """Delete the comment shown before an address."""
+        old = self.project.database.get_pre_comment(addr)
+        self.project.database.delete_pre_comment(addr)
+        self._record(dsnes.analyser.changes.PRE_COMMENT, addr, old, None)
+
+    def set_inline_comment(self, addr, text):
+        """Set the comment shown on an address's line."""
+        old = self.project.database.get_inline_comment(addr)
+        self.project.database.set_inline_comment(addr, text)
+        self._record(dsnes.analyser.changes.INLINE_COMMENT, addr, old, text)
+
+    def delete_inline_comment(self, addr):
+        """Delete the comment shown on an address's line."""
+        old = self.project.database.get_inline_comment(addr)
+        self.project.database.delete_inline_comment(addr)
+        self._record(dsnes.analyser.changes.INLINE_COMMENT, addr, old, None)
 
     def get_hardware_label(self, addr):
         """Get a hardware label for the given address.
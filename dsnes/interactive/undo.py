@@ -0,0 +1,127 @@
+"""Undo and redo for annotation edits.
+
+Each step is a tuple of Edits, which hold the old and new value of one
+annotation as the strings that the database stores. Undoing a step makes
+its edits in reverse, as a database batch, so the open analyses only
+catch up with what actually changed.
+"""
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import collections
+
+from dsnes.analyser import batch, changes
+
+
+# kind is one of the changes kinds. For a label, old is the label removed
+# and new is the label added; only one of them is set.
+Edit = collections.namedtuple("Edit", ["kind", "addr", "old", "new"])
+
+# Default limit on the number of edits that are remembered.
+MAX_EDITS = 100000
+
+
+def _encode(value):
+    return None if value is None else value.encode()
+
+def edits_for(database, records):
+    """Get the Edits that a list of journal records would make.
+
+    Must be called before the records are applied, to see the old values.
+    """
+    getters = {
+        changes.STATE: lambda addr: _encode(database.get_state(addr)),
+        changes.STATE_DELTA:
+            lambda addr: _encode(database.get_state_delta(addr)),
+        changes.PRE_COMMENT: database.get_pre_comment,
+        changes.INLINE_COMMENT: database.get_inline_comment,
+    }
+    # Values set by earlier records.
+    current = {}
+    edits = []
+    for record in records:
+        op = record["op"]
+        addr = record["addr"]
+        value = record["value"]
+        if op == "add_label":
+            edits.append(Edit(changes.LABEL, addr, None, value))
+        elif op == "remove_label":
+            edits.append(Edit(changes.LABEL, addr, value, None))
+        elif op in getters:
+            key = (op, addr)
+            if key in current:
+                old = current[key]
+            else:
+                old = getters[op](addr)
+            current[key] = value
+            edits.append(Edit(op, addr, old, value))
+        else:
+            raise ValueError("Unknown edit {!r}".format(record))
+    return edits
+
+def to_batch(edits, undo=False):
+    """Get a Batch that makes the edits, or with undo, reverses them."""
+    records = []
+    if undo:
+        edits = [Edit(kind, addr, new, old)
+                 for kind, addr, old, new in reversed(edits)]
+    for kind, addr, old, new in edits:
+        if kind == changes.LABEL:
+            if new is not None:
+                records.append(
+                    {"op": "add_label", "addr": addr, "value": new})
+            else:
+                records.append(
+                    {"op": "remove_label", "addr": addr, "value": old})
+        else:
+            records.append({"op": kind, "addr": addr, "value": new})
+    return batch.Batch(records)
+
+
+class UndoHistory:
+    def __init__(self, max_edits=MAX_EDITS):
+        self.max_edits = max_edits
+        self.undo_steps = collections.deque()
+        self.redo_steps = collections.deque()
+        # Number of edits in all of the steps.
+        self.size = 0
+
+    def can_undo(self):
+        return len(self.undo_steps) > 0
+
+    def can_redo(self):
+        return len(self.redo_steps) > 0
+
+    def record(self, edits):
+        """Remember a step made of a list of Edits. Forgets the redo steps."""
+        if not edits:
+            return
+        self.size -= sum(len(step) for step in self.redo_steps)
+        self.redo_steps.clear()
+        self.undo_steps.append(tuple(edits))
+        self.size += len(edits)
+        # Forget the oldest steps to stay within the limit.
+        while self.size > self.max_edits and self.undo_steps:
+            self.size -= len(self.undo_steps.popleft())
+
+    def undo(self, apply_fn):
+        """Undo the last step by calling apply_fn with a Batch.
+
+        The step only moves to the redo steps if apply_fn succeeds.
+        """
+        step = self.undo_steps[-1]
+        apply_fn(to_batch(step, undo=True))
+        self.undo_steps.pop()
+        self.redo_steps.append(step)
+
+    def redo(self, apply_fn):
+        """Redo the last undone step by calling apply_fn with a Batch."""
+        step = self.redo_steps[-1]
+        apply_fn(to_batch(step))
+        self.redo_steps.pop()
+        self.undo_steps.append(step)
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.size = 0
@@ -2,6 +2,7 @@
 # Copyright 2017 Adrian Chan
 # Licensed under GPLv3
 
+import hashlib
 import os
 
 import toml
@@ -20,15 +21,35 @@ class Project:
         self.config = None
         self.database = None
         self.bus = None
+        # Hashes that identify the inputs to an analysis.
+        self.config_hash = None
+        self.rom_hash = None
 
     def load(self, path):
         assert os.path.isdir(path), "{} is not a directory".format(path)
         self.path = path
-        self.config = self.load_config(os.path.join(path, "config.toml"))
-        self.database = self.load_database(os.path.join(path, "database.toml"))
+        config_path = os.path.join(path, "config.toml")
+        self.config = self.load_config(config_path)
+        with open(config_path, "rb") as config_file:
+            self.config_hash = hashlib.sha1(config_file.read()).hexdigest()
+        # Big projects can use an SQLite database, or a TOML file for each
+        # bank, instead of the single TOML file.
+        sqlite_path = os.path.join(path, dsnes.analyser.sqlitedb.FILENAME)
+        shards_path = os.path.join(path, dsnes.analyser.shardeddb.DIRNAME)
+        if os.path.isfile(sqlite_path):
+            self.database = dsnes.analyser.sqlitedb.load(sqlite_path)
+        elif os.path.isfile(os.path.join(
+                shards_path, dsnes.analyser.shardeddb.MANIFEST)):
+            self.database = dsnes.analyser.shardeddb.load(shards_path)
+        else:
+            self.database = self.load_database(
+                os.path.join(path, "database.toml"))
         self.bus = dsnes.Bus()
         self.cartridge = dsnes.Cartridge()
         self.cartridge.load(self)
+        rom = self.cartridge.rom
+        if rom is not None:
+            self.rom_hash = hashlib.sha1(rom.data).hexdigest()
 
     def save(self):
         assert self.database
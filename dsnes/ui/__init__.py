@@ -1,2 +1,3 @@
 from .disassemblyview import DisassemblyView
-from .dialog import TextDialog, LabelDialog, QueryStringValidated
+from .dialog import (
+    TextDialog, LabelDialog, ListDialog, QueryStringValidated, GotoDialog)
@@ -213,3 +213,118 @@ class LabelDialog(ResizeDialog):
             self.made_changes = True
 
         self.update_list()
+
+
+class ListDialog(ResizeDialog):
+    """Dialog that shows a read-only list of lines."""
+    def __init__(self, title, prompt, lines, parent=None):
+        if not parent:
+            parent = tk._default_root
+
+        self.prompt = prompt
+        self.lines = lines
+        super().__init__(parent, title)
+
+    def body(self, master):
+        w = tk.Label(master, text=self.prompt, justify="left")
+        w.grid(column=0, row=0, padx=5, sticky="w")
+        master.columnconfigure(0, weight=1)
+        master.rowconfigure(0, weight=0)
+
+        listbox = tk.Listbox(master, width=60, font="TkFixedFont")
+        for line in self.lines:
+            listbox.insert("end", line)
+        listbox.grid(column=0, row=1, padx=5, sticky="nesw")
+        master.rowconfigure(1, weight=1)
+
+        vscroll = ttk.Scrollbar(
+            master, orient="vertical", command=listbox.yview)
+        vscroll.grid(column=1, row=1, sticky="ns")
+        listbox["yscrollcommand"] = vscroll.set
+
+        return listbox
+
+    def buttonbox(self):
+        box = ttk.Frame(self)
+
+        w = ttk.Button(box, text="Done", width=10, command=self.cancel)
+        w.pack(side="right", padx=10, pady=10)
+
+        self.bind("<Escape>", self.cancel)
+
+        return box
+
+
+class GotoDialog(ResizeDialog):
+    """Ask for an address or a label, suggesting labels while typing.
+
+    suggest_fn gets the text typed so far and returns a list of labels.
+    parse_fn turns the text into the result, or raises ValueError.
+    """
+    def __init__(self, title, prompt, suggest_fn, parse_fn,
+                 initialvalue=None, parent=None):
+        if not parent:
+            parent = tk._default_root
+
+        self.prompt = prompt
+        self.suggest_fn = suggest_fn
+        self.parse_fn = parse_fn
+        self.initialvalue = initialvalue
+        self.entry = None
+        self.suggestions = None
+        super().__init__(parent, title)
+
+    def body(self, master):
+        w = tk.Label(master, text=self.prompt, justify="left")
+        w.grid(column=0, row=0, padx=5, sticky="w")
+        master.columnconfigure(0, weight=1)
+        master.rowconfigure(0, weight=0)
+
+        self.entry = ttk.Entry(master, width=40)
+        self.entry.grid(column=0, row=1, padx=5, sticky="ew")
+        master.rowconfigure(1, weight=0)
+        if self.initialvalue is not None:
+            self.entry.insert(0, self.initialvalue)
+            self.entry.select_range(0, "end")
+        self.entry.bind("<KeyRelease>", self.on_key)
+        self.entry.bind("<Down>", self.on_focus_list)
+
+        self.suggestions = tk.Listbox(
+            master, height=8, font="TkFixedFont", exportselection=False)
+        self.suggestions.grid(column=0, row=2, padx=5, sticky="nesw")
+        master.rowconfigure(2, weight=1)
+        self.suggestions.bind("<<ListboxSelect>>", self.on_select)
+        self.suggestions.bind("<Double-Button-1>", self.ok)
+        self.bind("<Return>", self.ok)
+
+        return self.entry
+
+    def on_key(self, event):
+        if event.keysym in ("Return", "Escape", "Down"):
+            return
+        self.suggestions.delete(0, "end")
+        text = self.entry.get().strip()
+        if text:
+            for label in self.suggest_fn(text):
+                self.suggestions.insert("end", label)
+
+    def on_focus_list(self, *args):
+        if self.suggestions.size():
+            self.suggestions.focus_set()
+            self.suggestions.selection_clear(0, "end")
+            self.suggestions.selection_set(0)
+            self.on_select()
+
+    def on_select(self, *args):
+        selected = self.suggestions.curselection()
+        if selected:
+            self.entry.delete(0, "end")
+            self.entry.insert(0, self.suggestions.get(selected[0]))
+
+    def validate(self):
+        try:
+            self.result = self.parse_fn(self.entry.get())
+        except ValueError as ex:
+            messagebox.showwarning("Invalid value", str(ex), parent=self)
+            return 0
+        return 1
@@ -15,6 +15,8 @@ MENU_SEARCH = "Search"
 MENU_ITEM_GOTO = "Goto..."
 MENU_ITEM_FOLLOW = "Follow jump/call"
 MENU_ITEM_RETURN = "Undo follow"
+MENU_ITEM_REFERENCES = "References to line"
+MENU_ITEM_ACCESSES = "Accesses to target"
 
 SUBMENU_INTERRUPTS = "Interrupts"
 SUBMENU_EMU_INT = "Emulation"
@@ -27,6 +29,8 @@ MENU_ITEM_NAT_BRK = "BRK"
 MENU_ITEM_EMU_COP = MENU_ITEM_NAT_COP = "COP"
 
 MENU_ANNOTATE = "Annotate"
+MENU_ITEM_UNDO = "Undo"
+MENU_ITEM_REDO = "Redo"
 MENU_ITEM_INLINE_COMMENT = "Inline comment"
 MENU_ITEM_PRE_COMMENT = "Pre-comment"
 MENU_ITEM_LABEL = "Label instruction"
@@ -55,6 +59,15 @@ class DisassemblyView(ttk.Frame):
             label=MENU_ITEM_RETURN, accelerator="Left",
             command=self.on_return)
         root.bind("<Left>", lambda _e: menu_search.invoke(MENU_ITEM_RETURN))
+        menu_search.add_command(
+            label=MENU_ITEM_REFERENCES, accelerator="R",
+            command=self.on_references)
+        root.bind("<r>",
+            lambda _e: menu_search.invoke(MENU_ITEM_REFERENCES))
+        menu_search.add_command(
+            label=MENU_ITEM_ACCESSES, accelerator="A",
+            command=self.on_accesses)
+        root.bind("<a>", lambda _e: menu_search.invoke(MENU_ITEM_ACCESSES))
         menu_search.add_separator()
         menu_search.add_command(
             label=MENU_ITEM_GOTO, accelerator="Ctrl+G",
@@ -103,6 +116,15 @@ class DisassemblyView(ttk.Frame):
             command=partial(self.on_interrupt_nat, MENU_ITEM_NAT_COP))
 
         self.menu_annotate = menu_annotate = tk.Menu(app.menu_bar)
+        menu_annotate.add_command(
+            label=MENU_ITEM_UNDO, accelerator="Ctrl+Z",
+            command=self.on_undo)
+        root.bind("<Control-z>", lambda _e: menu_annotate.invoke(MENU_ITEM_UNDO))
+        menu_annotate.add_command(
+            label=MENU_ITEM_REDO, accelerator="Ctrl+Y",
+            command=self.on_redo)
+        root.bind("<Control-y>", lambda _e: menu_annotate.invoke(MENU_ITEM_REDO))
+        menu_annotate.add_separator()
         menu_annotate.add_command(
             label=MENU_ITEM_INLINE_COMMENT, accelerator="I",
             command=self.on_inline_comment)
@@ -142,6 +164,9 @@ class DisassemblyView(ttk.Frame):
         self.item_lookup = {}
         # Map actual index to displayed id/index/item.
         self.display_lookup = {}
+        # Text and width of each displayed row.
+        self.row_texts = []
+        self.row_widths = []
 
         style = ttk.Style()
         self.font = tkfont.Font(name="DasmFont", font="TkFixedFont", size=12)
@@ -189,8 +214,12 @@ class DisassemblyView(ttk.Frame):
         menu_search.entryconfig(SUBMENU_INTERRUPTS, state="disabled")
         menu_search.entryconfig(MENU_ITEM_FOLLOW, state="disabled")
         menu_search.entryconfig(MENU_ITEM_RETURN, state="disabled")
+        menu_search.entryconfig(MENU_ITEM_REFERENCES, state="disabled")
+        menu_search.entryconfig(MENU_ITEM_ACCESSES, state="disabled")
 
         menu_bar.entryconfig(MENU_ANNOTATE, state="disabled")
+        menu_annotate.entryconfig(MENU_ITEM_UNDO, state="disabled")
+        menu_annotate.entryconfig(MENU_ITEM_REDO, state="disabled")
         menu_annotate.entryconfig(MENU_ITEM_INLINE_COMMENT, state="disabled")
         menu_annotate.entryconfig(MENU_ITEM_PRE_COMMENT, state="disabled")
         menu_annotate.entryconfig(MENU_ITEM_LABEL, state="disabled")
@@ -238,6 +267,16 @@ class DisassemblyView(ttk.Frame):
         else:
             follow_state = "normal"
         self.menu_search.entryconfig(MENU_ITEM_FOLLOW, state=follow_state)
+        self.menu_search.entryconfig(MENU_ITEM_REFERENCES, state="normal")
+
+        # Can we look up accesses to the target of this instruction?
+        if (item.kind == "disassembly"
+                and item.operation.target_info.addr is not None
+                and dsnes.analyser.xref.access_kind(item.operation)):
+            accesses_state = "normal"
+        else:
+            accesses_state = "disabled"
+        self.menu_search.entryconfig(MENU_ITEM_ACCESSES, state=accesses_state)
 
         # What kinds of things can we annotate?
         if item.kind == "disassembly":
@@ -300,32 +339,64 @@ class DisassemblyView(ttk.Frame):
     def handle_analysis_updated(self, *args):
         print(events.ANALYSIS_UPDATED + " dasmview")
         dasm = self.dasm
-        old_items = self.dasm.get_children()
-        if old_items:
-            dasm.delete(*old_items)
-        self.item_lookup.clear()
-        self.display_lookup.clear()
         dasm_lines = self.app.session.current_analysis.get_disassembly_lines()
         curr_selected_idx = self.app.session.line_number
 
+        # (text, orig_index, item) for every displayed row.
+        rows = []
         for idx, item in enumerate(dasm_lines):
-            self.add_item(item, idx, idx==curr_selected_idx)
+            for text in self.item_rows(item):
+                rows.append((text, idx, item))
+        new_texts = [text for text, _, _ in rows]
+
+        # Only replace the rows between the unchanged start and end of the
+        # listing, so a small edit only touches a few rows.
+        old_ids = list(dasm.get_children())
+        old_texts = self.row_texts
+        old_widths = self.row_widths
+        limit = min(len(old_texts), len(new_texts))
+        start = 0
+        while start < limit and old_texts[start] == new_texts[start]:
+            start += 1
+        end = 0
+        while (end < limit - start
+                and old_texts[-1 - end] == new_texts[-1 - end]):
+            end += 1
+        old_end = len(old_texts) - end
+        new_end = len(new_texts) - end
+        if start < old_end:
+            dasm.delete(*old_ids[start:old_end])
+        inserted_ids = []
+        inserted_widths = []
+        for index, text in enumerate(new_texts[start:new_end], start):
+            inserted_ids.append(dasm.insert(parent="", index=index, text=text))
+            # Need extra mmmmm due to padding weirdness.
+            inserted_widths.append(self.font.measure(text + "mmmmm"))
+        new_ids = old_ids[:start] + inserted_ids + old_ids[old_end:]
+        self.row_texts = new_texts
+        self.row_widths = (
+            old_widths[:start] + inserted_widths + old_widths[old_end:])
+
+        self.item_lookup.clear()
+        self.display_lookup.clear()
+        for display_index, (identity, (_, orig_index, item)) in enumerate(
+                zip(new_ids, rows)):
+            self.item_lookup[identity] = (display_index, orig_index, item)
+            # This points to the first row of a multi-row item.
+            if orig_index not in self.display_lookup:
+                self.display_lookup[orig_index] = (
+                    identity, display_index, item)
         identity, _, _ = self.display_lookup[curr_selected_idx]
         dasm.selection_set(identity)
 
         # Resize the column to fit the widest item.
         # This lets the Treeview work properly with the horizontal scrollbar.
-        col_width = 0
-        for item in dasm.get_children():
-            # Need extra mmmmm due to padding weirdness.
-            text = dasm.item(item, option="text") + "mmmmm"
-            width = self.font.measure(text)
-            if col_width < width:
-                dasm.column("#0", width=width, minwidth=width)
-                col_width = width
+        col_width = max(self.row_widths, default=0)
+        dasm.column("#0", width=col_width, minwidth=col_width)
 
         menu_bar = self.app.menu_bar
         menu_search = self.menu_search
+        self.update_undo_menu()
         if self.app.session.current_analysis:
             menu_bar.entryconfig(MENU_ANNOTATE, state="normal")
 
@@ -338,32 +409,111 @@ class DisassemblyView(ttk.Frame):
             menu_bar.entryconfig(MENU_ANNOTATE, state="disabled")
             menu_search.entryconfig(MENU_ITEM_RETURN, state="disabled")
 
+    def update_undo_menu(self):
+        session = self.app.session
+        self.menu_annotate.entryconfig(
+            MENU_ITEM_UNDO,
+            state="normal" if session.can_undo() else "disabled")
+        self.menu_annotate.entryconfig(
+            MENU_ITEM_REDO,
+            state="normal" if session.can_redo() else "disabled")
+
+    def on_undo(self, *args):
+        self._undo_or_redo(self.app.session.undo)
+
+    def on_redo(self, *args):
+        self._undo_or_redo(self.app.session.redo)
+
+    def _undo_or_redo(self, fn):
+        try:
+            fn()
+        except dsnes.interactive.NoOperation:
+            return
+        except ValueError as ex:
+            messagebox.showerror(title="dSNES", message=str(ex))
+            return
+        self.app.root.event_generate(events.ANALYSIS_UPDATED)
+
     def on_follow(self, *args):
         self.app.root.event_generate(events.FOLLOW)
 
     def on_return(self, *args):
         self.app.root.event_generate(events.RETURN)
 
+    def on_references(self, *args):
+        selected_id, display_index, orig_index, item = self.get_selected()
+        if item.kind == "error":
+            address = item.addr
+        else:
+            address = item.operation.addr
+
+        session = self.app.session
+        database = session.project.database
+        lines = []
+        for source, kind in session.get_references_to(address):
+            lines.append("{addr}  {kind:<6s}  {label}".format(
+                addr=format_address(source), kind=kind,
+                label=database.get_label(source) or ""))
+        if not lines:
+            lines.append("No references found in analysed code")
+
+        dsnes.ui.ListDialog(
+            title="dSNES",
+            prompt="References to {}:".format(format_address(address)),
+            lines=lines, parent=self.app.root)
+
+    def on_accesses(self, *args):
+        selected_id, display_index, orig_index, item = self.get_selected()
+        assert item.kind == "disassembly"
+        address = item.operation.target_info.addr
+
+        lines = []
+        for source, target, access in self.app.session.get_data_accesses(
+                address):
+            lines.append("{addr}  {access:<6s}  {target}".format(
+                addr=format_address(source), access=access,
+                target=format_address(target)))
+        if not lines:
+            lines.append("No accesses found in analysed code")
+
+        dsnes.ui.ListDialog(
+            title="dSNES",
+            prompt="Accesses to {}:".format(format_address(address)),
+            lines=lines, parent=self.app.root)
+
     def on_goto(self, *args):
-        address = tk.simpledialog.askinteger(
-            title="dSNES", prompt="New analysis at address:",
-            initialvalue="0x",
-            minvalue=0, maxvalue=0xffffff)
+        goto_dialog = dsnes.ui.GotoDialog(
+            title="dSNES", prompt="New analysis at address or label:",
+            suggest_fn=self.app.session.suggest_labels,
+            parse_fn=self.app.session.parse_goto_target,
+            initialvalue="0x", parent=self.app.root)
+        address = goto_dialog.result
         if address is not None:
-            self.app.session.new_analysis(address)
-            self.app.root.event_generate(events.ANALYSIS_UPDATED)
+            self.start_analysis(address)
 
     def on_interrupt_emu(self, kind):
         address = self.app.session.get_address_of_interrupt_handler(
             emulation=True, kind=kind)
-        self.app.session.new_analysis(address, state="p=E")
-        self.app.root.event_generate(events.ANALYSIS_UPDATED)
+        self.start_analysis(address, state="p=E")
 
     def on_interrupt_nat(self, kind):
         address = self.app.session.get_address_of_interrupt_handler(
             emulation=False, kind=kind)
-        self.app.session.new_analysis(address, state="p=e")
-        self.app.root.event_generate(events.ANALYSIS_UPDATED)
+        self.start_analysis(address, state="p=e")
+
+    def start_analysis(self, address, state=None):
+        """Analyse a function on a background thread, then show it.
+
+        Annotations can carry on being edited while it runs.
+        """
+        session = self.app.session
+        def task():
+            analyser = session.analyse_detached(address, state)
+            def in_gui():
+                session.open_analysis(analyser)
+                self.app.root.event_generate(events.ANALYSIS_UPDATED)
+            return in_gui
+        self.app.start_background_task(task, name="analysis")
 
     def on_inline_comment(self, *args):
         selected_id, display_index, orig_index, item = self.get_selected()
@@ -382,12 +532,11 @@ class DisassemblyView(ttk.Frame):
         elif new_comment == "":
             # Empty comment. Try to delete it.
             try:
-                self.app.session.project.database.delete_inline_comment(address)
+                self.app.session.delete_inline_comment(address)
             except LookupError:
                 refresh = False
         else:
-            self.app.session.project.database.set_inline_comment(
-                address, new_comment)
+            self.app.session.set_inline_comment(address, new_comment)
 
         if refresh:
             self.app.session.refresh_analysis()
@@ -433,13 +582,11 @@ class DisassemblyView(ttk.Frame):
             if new_comment == "":
                 # Empty comment. Try to delete it.
                 try:
-                    self.app.session.project.database.delete_pre_comment(
-                        address)
+                    self.app.session.delete_pre_comment(address)
                 except LookupError:
                     refresh = False
             else:
-                self.app.session.project.database.set_pre_comment(
-                    address, new_comment)
+                self.app.session.set_pre_comment(address, new_comment)
 
         if refresh:
             self.app.session.refresh_analysis()
@@ -637,67 +784,20 @@ class DisassemblyView(ttk.Frame):
             self.app.session.refresh_analysis()
             self.app.root.event_generate(events.ANALYSIS_UPDATED)
 
-    def add_item(self, item, orig_index, is_selected):
+    def item_rows(self, item):
+        """Get the text of each row that displays an item."""
         kind = item.kind
         if kind == "label":
-            self.add_label(item, orig_index)
+            return [item.text + ":"]
         elif kind == "pre-comment":
-            self.add_pre_comment(item, orig_index)
+            return [" " + line for line in item.text.split("\n")]
         elif kind == "error":
-            self.add_error(item, orig_index)
+            return [dsnes.analyser.listing.format_error(item)]
         elif kind == "disassembly":
-            self.add_disassembly(item, orig_index)
+            return [dsnes.analyser.listing.format_disassembly(item)]
         else:
             raise ValueError("Unexpected item kind {!r}".format(kind))
 
-    def add_label(self, item, orig_index):
-        text = item.text + ":"
-        identity = self.dasm.insert(parent="", index="end", text=text)
-        display_index = self.dasm.index(identity)
-        self.item_lookup[identity] = (display_index, orig_index, item)
-        self.display_lookup[orig_index] = (identity, display_index, item)
-
-    def add_pre_comment(self, item, orig_index):
-        lines = item.text.split("\n")
-        first = True
-        for line in lines:
-            text = " " + line
-            identity = self.dasm.insert(parent="", index="end", text=text)
-            display_index = self.dasm.index(identity)
-            self.item_lookup[identity] = (display_index, orig_index, item)
-            # This points to the first line of the multi-line entry.
-            if first:
-                self.display_lookup[orig_index] = \
-                    (identity, display_index, item)
-                first = False
-
-    def add_error(self, item, orig_index):
-        error_msg = "!!!{}!!!".format(item.msg)
-        text = " {addr}{pad:<12}  {msg:^73}   {state}".format(
-            addr=format_address(item.addr),
-            pad="",
-            msg=error_msg,
-            state=item.state.encode())
-        identity = self.dasm.insert(parent="", index="end", text=text)
-        display_index = self.dasm.index(identity)
-        self.item_lookup[identity] = (display_index, orig_index, item)
-        self.display_lookup[orig_index] = (identity, display_index, item)
-
-    def add_disassembly(self, item, orig_index):
-        text = (" {addr}:{raw:<11}  {asm:<15s}   {target:<18s}  "
-                "{comment:<35s}   {state}".format(
-                    addr=format_address(item.operation.addr),
-                    raw=" ".join([format(n, "02x")
-                                  for n in item.operation.raw]),
-                    asm=item.operation.asm_str,
-                    target=item.target_str,
-                    comment=item.comment or "",
-                    state=item.operation.state.encode()))
-        identity = self.dasm.insert(parent="", index="end", text=text)
-        display_index = self.dasm.index(identity)
-        self.item_lookup[identity] = (display_index, orig_index, item)
-        self.display_lookup[orig_index] = (identity, display_index, item)
-
 def format_address(addr):
     if addr < 0 or addr > 0xFFFFFF:
         raise ValueError("Address out of range")
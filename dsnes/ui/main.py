@@ -16,11 +16,18 @@ MENU_ITEM_OPEN_PROJECT = "Open Project..."
 MENU_ITEM_SAVE = "Save"
 MENU_ITEM_EXIT = "Exit"
 
+# Seconds between automatic saves.
+AUTOSAVE_INTERVAL = 120
+# Milliseconds between checks on the autosaver.
+AUTOSAVE_POLL_MS = 1000
+
 
 class MainWindow:
     def __init__(self, path_to_load=None):
         self.session = dsnes.interactive.Session()
         self.path_to_load = path_to_load
+        # The pending call to poll_autosave(), if any.
+        self.autosave_poll = None
 
         self.root = root = tk.Tk()
         root.title("dSNES")
@@ -81,6 +88,10 @@ class MainWindow:
 
     def before_exit(self, *args):
         allow_exit = True
+        autosaver = self.session.autosaver
+        if autosaver is not None:
+            # Changes from a failed autosave count as unsaved again.
+            autosaver.flush()
         if self.session.has_unsaved_changes:
             do_save = messagebox.askyesnocancel(
                 title="dSNES",
@@ -92,6 +103,8 @@ class MainWindow:
                 if do_save:
                     self.session.save_project()
         if allow_exit:
+            if autosaver is not None:
+                autosaver.stop()
             self.root.destroy()
 
     def handle_project_closed(self, *args):
@@ -113,6 +126,21 @@ class MainWindow:
         self.menu_file.entryconfig(MENU_ITEM_SAVE, state="normal")
         self.hide_progress_bar()
         self.show_dasm_view()
+        self.session.autosaver.interval = AUTOSAVE_INTERVAL
+        # Only one poll loop, however many projects have been opened.
+        if self.autosave_poll is not None:
+            self.root.after_cancel(self.autosave_poll)
+        self.autosave_poll = self.root.after(
+            AUTOSAVE_POLL_MS, self.poll_autosave)
+
+    def poll_autosave(self):
+        """Periodic check on the autosaver, which also saves when it's due."""
+        autosaver = self.session.autosaver
+        for error in autosaver.poll():
+            messagebox.showerror(
+                message="Couldn't save the project.\n\n{}".format(error))
+        self.autosave_poll = self.root.after(
+            AUTOSAVE_POLL_MS, self.poll_autosave)
 
     def show_dasm_view(self):
         self.dasm_view.grid(column=0, row=0, sticky="nesw")
@@ -184,7 +212,7 @@ class MainWindow:
             self._do_load(dir_path)
 
     def on_save_menu(self, *args):
-        self.session.save_project()
+        self.session.save_project(background=True)
 
     def _do_load(self, dir_path):
         self.root.event_generate(events.PROJECT_LOADING)
@@ -1,5 +1,6 @@
 import argparse
 from functools import partial
+import sys
 
 import dsnes
 
@@ -9,7 +10,14 @@ parser.add_argument("--address", default=0xff9c, type=partial(int, base=0))
 parser.add_argument("--label")
 parser.add_argument("--state", default=None)
 parser.add_argument("--stop-before", default=None, type=partial(int, base=0))
+parser.add_argument("--max-instructions", default=None, type=int)
+parser.add_argument("--max-seconds", default=None, type=float)
+parser.add_argument("--progress", action="store_true")
 parser.add_argument("--profile-load", action="store_true")
+parser.add_argument("--stats", action="store_true",
+                    help="Print where the analysis spent its time, as JSON")
+parser.add_argument("--output", default=None)
+parser.add_argument("--compress", default=None, choices=("gzip", "bz2", "xz"))
 args = parser.parse_args()
 
 if args.profile_load:
@@ -18,6 +26,7 @@ if args.profile_load:
     profile = cProfile.Profile()
     profile.runcall(dsnes.project.load, "starfox")
     stats = pstats.Stats(profile).sort_stats("cumtime")
+    stats.print_stats(30)
 
 else:
     project = dsnes.project.load("starfox")
@@ -26,8 +35,32 @@ else:
     if args.label:
         address = (project.database.get_address_with_label(args.label)
                    or args.address)
+
+    def show_progress(instructions, queue_depth):
+        print("{} instructions, {} blocks queued".format(
+            instructions, queue_depth), file=sys.stderr)
+
+    def show_breakpoint(analyser, from_address, to_address):
+        print("Stopped at {:02x}:{:04x}".format(
+            (from_address & 0xff0000) >> 16, from_address & 0xFFFF))
+        return True
+
+    control = dsnes.analyser.control.AnalysisControl(
+        progress_fn=show_progress if args.progress else None,
+        max_instructions=args.max_instructions,
+        max_seconds=args.max_seconds)
+    if args.stop_before is not None:
+        control.add_breakpoint(args.stop_before, show_breakpoint)
     try:
-        analyser.analyse_function(address, args.state, args.stop_before)
+        analyser.analyse_function(address, args.state, control=control)
     finally:
-        analyser.display()
+        if args.output:
+            with open(args.output, "wb") as outfile:
+                analyser.display(outfile, args.compress)
+        else:
+            analyser.display()
         print("Processed {} instructions".format(len(analyser.visited)))
+        if analyser.stop_reason:
+            print("Stopped early: {}".format(analyser.stop_reason))
+        if args.stats:
+            print(analyser.stats.to_json(indent=2), file=sys.stderr)
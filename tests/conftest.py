@@ -0,0 +1,56 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+import dsnes
+
+
+CONFIG = """\
+[rom]
+filename = "rom.sfc"
+size = "0x8000"
+map = [
+    {bank_low = "0x00", bank_high = "0x00", address_low = "0x8000", address_high = "0xffff", mask = "0x8000"},
+]
+
+[superfx]
+
+[wram]
+size = "0x20000"
+map = [
+    {bank_low = "0x00", bank_high = "0x00", address_low = "0x0000", address_high = "0x1fff", size = "0x2000"},
+    {bank_low = "0x7e", bank_high = "0x7f", address_low = "0x0000", address_high = "0xffff"},
+]
+"""
+
+DATABASE = """\
+[states]
+
+[state_deltas]
+
+[labels]
+
+[pre_comments]
+
+[inline_comments]
+"""
+
+
+@pytest.fixture
+def make_project(tmp_path):
+    """Make a project with a single 32KiB bank of LoROM mapped at 00:8000.
+
+    Call with a dict of {cpu_address: bytes} to place in the ROM. Unused ROM
+    is filled with `rts`.
+    """
+    def make(code=None, database=DATABASE):
+        rom = bytearray(b"\x60" * 0x8000)
+        for addr, data in (code or {}).items():
+            offset = (addr & 0xFFFF) - 0x8000
+            rom[offset:offset+len(data)] = data
+        (tmp_path / "rom.sfc").write_bytes(bytes(rom))
+        (tmp_path / "config.toml").write_text(CONFIG)
+        (tmp_path / "database.toml").write_text(database)
+        return dsnes.project.load(str(tmp_path))
+    return make
@@ -0,0 +1,174 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import gzip
+import io
+import json
+
+import pytest
+
+import dsnes
+from dsnes.interactive import Session
+
+# sei; lda $2100; jsr $8010; rts
+CODE = {0x8000: b"\x78\xad\x00\x21\x20\x10\x80\x60"}
+
+def describe(analyser):
+    lines = []
+    for item in analyser.get_disassembly_lines():
+        if item.kind == "label":
+            lines.append(("label", item.text))
+        elif item.kind == "pre-comment":
+            lines.append(("pre-comment", item.text))
+        elif item.kind == "disassembly":
+            lines.append((item.operation.asm_str, item.target_str,
+                          item.comment))
+        else:
+            lines.append(("error", item.msg))
+    return lines
+
+def test_collate(make_project):
+    project = make_project(CODE)
+    database = project.database
+    database.add_label(0x8000, "start")
+    database.add_label(0x8000, "also_start")
+    database.add_label(0x8010, "callee")
+    database.set_pre_comment(0x8004, "Call it.")
+    database.set_inline_comment(0x8001, "; Read a register")
+
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    assert describe(analyser) == [
+        ("label", "start"),
+        ("label", "also_start"),
+        ("sei", "", "; Disable interrupts"),
+        ("lda $2100", "[rpINIDISP]", "; Read a register"),
+        ("pre-comment", "Call it."),
+        ("jsr $8010", "[callee]", None),
+        ("rts", "", None),
+    ]
+
+def test_display(make_project):
+    project = make_project(CODE)
+    project.database.add_label(0x8000, "start")
+    project.database.set_pre_comment(0x8004, "Call it.\nTwice.")
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+
+    text = io.StringIO()
+    analyser.display(text)
+    lines = text.getvalue().splitlines()
+    assert len(lines) == 7
+    assert lines[0] == "start"
+    assert lines[1].startswith(" 00:8000:78           sei")
+    assert lines[3:5] == [" Call it.", " Twice."]
+
+    packed = io.BytesIO()
+    count = dsnes.analyser.listing.write_listing(
+        analyser.get_disassembly_lines(), packed, compress="gzip")
+    assert count == 7
+    assert gzip.decompress(packed.getvalue()).decode() == text.getvalue()
+
+def test_display_compressed(make_project, capsysbinary):
+    project = make_project(CODE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    text = io.StringIO()
+    analyser.display(text)
+
+    # To the binary buffer under sys.stdout.
+    analyser.display(compress="gzip")
+    packed = capsysbinary.readouterr().out
+    assert gzip.decompress(packed).decode() == text.getvalue()
+    with pytest.raises(ValueError):
+        analyser.display(io.StringIO(), compress="gzip")
+
+def test_stats(make_project):
+    project = make_project(CODE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+
+    stats = json.loads(analyser.stats.to_json())
+    assert stats["counts"]["instructions"] == 4
+    assert stats["counts"]["blocks"] == 1
+    assert stats["counts"]["lines"] == 4
+    assert set(stats["times"]) == set(dsnes.analyser.stats.PHASES)
+    assert stats["total"] >= stats["times"]["collate"] > 0
+    assert stats["times"]["walk"] > 0
+    # Instructions are only timed when asked for.
+    assert stats["times"]["decode"] == 0
+
+    control = dsnes.analyser.control.AnalysisControl(time_phases=True)
+    analyser.analyse_function(0x8000, "p=e b=0", control=control)
+    times = analyser.stats.times
+    assert times["walk"] >= times["decode"] > 0
+    assert times["database"] > 0
+
+def test_label_offset(make_project):
+    # lda $8023; lda $8123; rts
+    project = make_project({0x8000: b"\xad\x23\x80\xad\x23\x81\x60"})
+    project.database.add_label(0x8020, "table")
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    assert [line[1] for line in describe(analyser)] == [
+        "[table+$3]", "[008123]", ""]
+
+def test_label_offset_register(make_project):
+    # sta $2101; rts
+    project = make_project({0x8000: b"\x8d\x01\x21\x60"})
+    project.database.add_label(0x2100, "screen_display")
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    # The register's own label wins over the nearby user label.
+    assert describe(analyser)[0][1] == "[rpOBSEL]"
+
+def test_label_offset_wram(make_project):
+    # lda $0012; lda $0020; rts
+    project = make_project({0x8000: b"\xad\x12\x00\xad\x20\x00\x60"})
+    project.database.add_label(0x0010, "player_struct")
+    project.database.add_label(0x0020, "enemy_struct")
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    # A field of a labelled struct says more than the generic WRAM label.
+    assert [line[1] for line in describe(analyser)] == [
+        "[player_struct+$2]", "[enemy_struct...]", ""]
+
+BAD_STATE_DATABASE = """\
+[states]
+"00:8001" = "p=Q"
+
+[state_deltas]
+
+[labels]
+
+[pre_comments]
+
+[inline_comments]
+"""
+
+def test_bad_state(make_project):
+    # States are parsed when first looked up, so the project still loads.
+    project = make_project(CODE, database=BAD_STATE_DATABASE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    lines = describe(analyser)
+    assert lines[0][0] == "sei"
+    assert lines[1][0] == "error"
+    assert "00:8001" in lines[1][1]
+    assert analyser.stats.counts["errors"] == 1
+
+def test_session_bad_state(make_project, tmp_path):
+    make_project(CODE, database=BAD_STATE_DATABASE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e b=0")
+    assert session.analysis_lines[1].kind == "error"
+    session.save_project()
+
+    # The cached analysis covers the bad state, and is still checked when
+    # the project is opened again.
+    session = Session()
+    session.load_project(str(tmp_path))
+    assert len(session.analysis_cache) == 1
+    session.new_analysis(0x8000, "p=e b=0")
+    assert "00:8001" in session.analysis_lines[1].msg
@@ -0,0 +1,110 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import threading
+
+import toml
+
+from dsnes.analyser import cache, codemap, database
+from dsnes.interactive import Session, autosave
+from tests.test_database import DATABASE
+
+
+def load(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    return database.load(str(path))
+
+def test_snapshot_is_unchanged_by_edits(tmp_path):
+    db = load(tmp_path)
+    db.add_label(0x8100, "later")
+    job = db.prepare_save(compact=True)
+    assert not db.is_dirty
+    # Edits made while the job waits to run aren't part of it.
+    db.add_label(0x8000, "also")
+    db.remove_label(0x8100, "later")
+    db.set_pre_comment(0x8100, "After.")
+    job.run()
+
+    data = toml.load(str(tmp_path / "database.toml"))
+    assert data["labels"] == {"00:8000": ["reset", "start"],
+                              "00:8100": ["later"]}
+    assert "00:8100" not in data["pre_comments"]
+    assert db.is_dirty
+    db.save()
+    reloaded = database.load(str(tmp_path / "database.toml"))
+    assert reloaded.get_labels(0x8000) == ["reset", "start", "also"]
+    assert reloaded.get_pre_comment(0x8100) == "After."
+
+def test_autosaver(tmp_path):
+    db = load(tmp_path)
+    saver = autosave.Autosaver(db, interval=0)
+    assert saver.poll() == []
+    db.set_inline_comment(0x8100, "; Saved")
+    assert saver.poll() == []
+    assert saver.flush() == []
+    assert not db.is_dirty
+    saver.stop()
+    reloaded = database.load(str(tmp_path / "database.toml"))
+    assert reloaded.get_inline_comment(0x8100) == "; Saved"
+
+def test_failed_save(tmp_path, monkeypatch):
+    db = load(tmp_path)
+    saver = autosave.Autosaver(db)
+    db.set_inline_comment(0x8100, "; Retried")
+
+    def fail(records):
+        raise OSError("Disk full")
+    monkeypatch.setattr(db.journal, "append", fail)
+    saver.save()
+    errors = saver.flush()
+    assert [str(error) for error in errors] == ["Disk full"]
+    # The changes are waiting to be saved again.
+    assert db.is_dirty
+    monkeypatch.undo()
+    saver.save()
+    assert saver.flush() == []
+    saver.stop()
+    reloaded = database.load(str(tmp_path / "database.toml"))
+    assert reloaded.get_inline_comment(0x8100) == "; Retried"
+
+def test_background_project_save(make_project, tmp_path, monkeypatch):
+    # sei; jsr $8010; rts
+    make_project({0x8000: b"\x78\x20\x10\x80\x60"})
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e")
+
+    threads = []
+    original_run = cache.CacheSaveJob.run
+    def run(job):
+        threads.append(threading.current_thread().name)
+        original_run(job)
+    monkeypatch.setattr(cache.CacheSaveJob, "run", run)
+    def fail(job):
+        raise OSError("Disk full")
+    monkeypatch.setattr(codemap.CodeMapSaveJob, "run", fail)
+
+    session.save_project(background=True)
+    assert not session.analysis_cache.is_dirty
+    errors = session.autosaver.flush()
+    assert [str(error) for error in errors] == ["Disk full"]
+    # The cache was pickled and written on the autosaver's thread.
+    assert threads == ["autosave"]
+    assert len(cache.load(session.project)) == 1
+    # The code map is waiting to be saved again.
+    assert session.codemap.is_dirty
+    monkeypatch.undo()
+    session.save_project(background=True)
+    assert session.autosaver.flush() == []
+    assert codemap.load(session.project).is_opcode(0x8001)
+
+    # A periodic autosave writes the cache and the code map too.
+    session.autosaver.interval = 0
+    session.new_analysis(0x8010, "p=e")
+    assert session.autosaver.poll() == []
+    assert session.autosaver.flush() == []
+    assert not session.analysis_cache.is_dirty
+    assert len(cache.load(session.project)) == 2
+    assert codemap.load(session.project).is_opcode(0x8010)
+    session.autosaver.stop()
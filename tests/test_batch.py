@@ -0,0 +1,83 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+import dsnes
+from dsnes.analyser import database, shardeddb, sqlitedb
+from dsnes.interactive import Session
+from tests.test_database import DATABASE
+
+
+def load_toml(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    return database.load(str(path))
+
+def load_sqlite(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    return sqlitedb.import_toml(str(path), str(tmp_path / sqlitedb.FILENAME))
+
+def load_sharded(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    return shardeddb.split_toml(
+        str(path), str(tmp_path / shardeddb.DIRNAME))
+
+@pytest.fixture(params=[load_toml, load_sqlite, load_sharded])
+def db(request, tmp_path):
+    return request.param(tmp_path)
+
+def test_batch(db):
+    with db.batch() as edits:
+        edits.set_state(0x8100, dsnes.State.parse("p=E"))
+        edits.add_label(0x8100, "later")
+        edits.remove_label(0x8000, "reset")
+        # Later edits see the earlier ones.
+        edits.add_label(0x8200, "reset")
+        edits.set_pre_comment(0x8200, "Moved.")
+        edits.remove_state_delta(0x8010)
+        edits.set_state(0x8010, dsnes.State.parse("p=e"))
+    assert len(edits) == 7
+    assert db.is_dirty
+    assert db.get_state(0x8100).encode() == "p=E"
+    assert db.get_labels(0x8000) == ["start"]
+    assert db.get_address_with_label("reset") == 0x8200
+    assert db.get_pre_comment(0x8200) == "Moved."
+    assert db.get_state_delta(0x8010) is None
+    assert db.get_state(0x8010).encode() == "p=e"
+
+def test_batch_is_atomic(db):
+    with pytest.raises(ValueError):
+        with db.batch() as edits:
+            edits.add_label(0x8100, "later")
+            edits.set_pre_comment(0x8100, "Never made.")
+            edits.set_state(0x8010, dsnes.State.parse("p=e"))
+    assert not db.has_label("later")
+    assert db.get_pre_comment(0x8100) is None
+
+    with pytest.raises(ValueError):
+        with db.batch() as edits:
+            edits.add_label(0x8100, "later")
+            edits.add_label(0x8200, "later")
+    with pytest.raises(ValueError):
+        with db.batch() as edits:
+            edits.remove_label(0x8100, "start")
+    with pytest.raises(ValueError):
+        with db.batch() as edits:
+            edits.delete_inline_comment(0x8000)
+    assert not db.has_label("later")
+    assert db.get_labels(0x8000) == ["reset", "start"]
+
+def test_session_batch(make_project, tmp_path):
+    make_project()
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e")
+    with session.batch() as edits:
+        edits.add_label(0x8000, "reset")
+        edits.set_inline_comment(0x8000, "Return.")
+    lines = session.current_analysis.get_disassembly_lines()
+    assert lines[0].text == "reset"
+    assert session.project.database.get_inline_comment(0x8000) == "Return."
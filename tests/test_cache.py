@@ -0,0 +1,48 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+from dsnes.interactive import Session
+
+# sei; lda #$1234 (ambiguous without m); jsr $8010; rts
+CODE = {0x8000: b"\x78\xa9\x34\x12\x20\x10\x80\x60"}
+
+def listing(analyser):
+    return [dsnes.analyser.listing.format_disassembly(item)
+            if item.kind == "disassembly" else item.kind
+            for item in analyser.get_disassembly_lines()]
+
+def open_session(path):
+    session = Session()
+    session.load_project(str(path))
+    return session
+
+def test_restore_after_reopen(make_project, tmp_path, monkeypatch):
+    make_project(CODE)
+    session = open_session(tmp_path)
+    session.project.database.set_state_delta(0x8001, dsnes.StateDelta.parse("+m"))
+    session.new_analysis(0x8000, "p=e")
+    expected = listing(session.current_analysis)
+    session.save_project()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Should have been restored from the cache")
+    monkeypatch.setattr(dsnes.Analyser, "analyse_function", fail)
+    session = open_session(tmp_path)
+    assert session.get_references_to(0x8010) == [(0x8004, "call")]
+    session.new_analysis(0x8000, "p=e")
+    assert listing(session.current_analysis) == expected
+    assert session.get_calls_from_line(2)[0][0] == 0x8010
+
+def test_database_change_invalidates(make_project, tmp_path):
+    make_project(CODE)
+    session = open_session(tmp_path)
+    session.new_analysis(0x8000, "p=e")
+    assert listing(session.current_analysis)[1] == "error"
+    session.save_project()
+
+    session = open_session(tmp_path)
+    assert len(session.analysis_cache) == 1
+    session.set_state_delta(0x8001, "+m")
+    session.new_analysis(0x8000, "p=e")
+    assert "lda #$1234" in listing(session.current_analysis)[1]
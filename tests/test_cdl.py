@@ -0,0 +1,57 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+from dsnes.analyser import cdl, codemap
+from dsnes.interactive import Session
+
+# sei; rts. At $8010 rep #$30; lda #$1234; rts.
+CODE = {
+    0x8000: b"\x78\x60",
+    0x8010: b"\xc2\x30\xa9\x34\x12\x60",
+}
+
+def make_flags():
+    flags = bytearray(0x8000)
+    entry = cdl.CODE | cdl.SUB_ENTRY_POINT | cdl.MEMORY_MODE_8
+    flags[0x0000] = entry
+    flags[0x0001] = cdl.CODE | cdl.MEMORY_MODE_8
+    flags[0x0010] = entry
+    flags[0x0020:0x0030] = bytes((cdl.DATA,)) * 0x10
+    # Code that was also read as data isn't marked as data.
+    flags[0x0030] = cdl.CODE | cdl.DATA
+    return flags
+
+def test_runs(tmp_path):
+    path = tmp_path / "rom.cdl"
+    path.write_bytes(cdl.HEADER + b"\0\0\0\0" + make_flags())
+    with cdl.open_cdl(str(path), 0x8000) as log:
+        assert log.flags_at(0x0001) == cdl.CODE | cdl.MEMORY_MODE_8
+        assert list(log.iter_runs(cdl.CODE)) == [
+            (0x0000, 0x0002), (0x0010, 0x0011), (0x0030, 0x0031)]
+        assert list(log.iter_runs(cdl.DATA, none_of=cdl.CODE)) == [
+            (0x0020, 0x0030)]
+        assert list(log.iter_offsets(cdl.SUB_ENTRY_POINT)) == [0x0, 0x10]
+
+    with pytest.raises(ValueError):
+        cdl.open_cdl(str(path), 0x10000)
+
+def test_session_import(make_project, tmp_path):
+    make_project(CODE)
+    path = tmp_path / "rom.cdl"
+    path.write_bytes(make_flags())
+    session = Session()
+    session.load_project(str(tmp_path))
+
+    assert session.import_cdl(str(path)) == 2
+    entry_points = [(addr, state.encode())
+                    for addr, state in session.entry_points]
+    assert entry_points == [(0x8000, "p=Mxe"), (0x8010, "p=Mxe")]
+    assert session.codemap.kind_at(0x8020) == codemap.DATA
+    assert session.codemap.kind_at(0x8030) == codemap.UNKNOWN
+
+    assert session.run_queued_analyses() == 2
+    assert not session.entry_points
+    assert session.codemap.is_opcode(0x8012)
+    assert session.codemap.is_code(0x8015)
@@ -0,0 +1,99 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+from dsnes.analyser import changes, control
+from dsnes.interactive import Session
+
+# sei; lda $2100; jsr $8010; rts
+CODE = {0x8000: b"\x78\xad\x00\x21\x20\x10\x80\x60"}
+
+def test_tracker():
+    tracker = changes.ChangeTracker()
+    received = []
+    tracker.subscribe(received.append)
+    tracker.changed(changes.LABEL, 0x018000)
+    assert tracker.generation == 1
+    assert tracker.generation_of(0x018000) == 1
+    assert tracker.generation_of(0x008000) == 0
+    assert tracker.generation_of(0x000000, 0x02ffff) == 1
+    assert received == [[changes.Change(changes.LABEL, 0x018000)]]
+
+    with tracker.hold():
+        tracker.changed(changes.STATE, 0x8000)
+        tracker.changed(changes.PRE_COMMENT, 0x8001)
+        assert len(received) == 1
+    assert received[1] == [(changes.STATE, 0x8000),
+                           (changes.PRE_COMMENT, 0x8001)]
+
+    tracker.unsubscribe(received.append)
+    tracker.changed(changes.ALL, None)
+    assert len(received) == 2
+    assert tracker.generation_of(0x7e0000) == 4
+
+def test_database_changes(make_project):
+    database = make_project().database
+    received = []
+    database.changes.subscribe(received.append)
+    database.add_label(0x8000, "start")
+    database.set_state(0x8001, dsnes.State.parse("p=e"))
+    with database.batch() as edits:
+        edits.remove_label(0x8000, "start")
+        edits.set_inline_comment(0x8002, "Hi")
+    assert received == [
+        [(changes.LABEL, 0x8000)],
+        [(changes.STATE, 0x8001)],
+        [(changes.LABEL, 0x8000), (changes.INLINE_COMMENT, 0x8002)],
+    ]
+
+def test_affected_by(make_project):
+    project = make_project(CODE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    assert analyser.affected_by([(changes.STATE, 0x8001)]) == \
+        changes.REANALYSE
+    assert analyser.affected_by([(changes.STATE, 0x9000)]) is None
+    assert analyser.affected_by([(changes.PRE_COMMENT, 0x8004)]) == \
+        changes.RECOLLATE
+    # Labels for the jsr target, including ones it's shown as an offset of.
+    assert analyser.affected_by([(changes.LABEL, 0x8010)]) == \
+        changes.RECOLLATE
+    assert analyser.affected_by([(changes.LABEL, 0x8008)]) == \
+        changes.RECOLLATE
+    assert analyser.affected_by([(changes.LABEL, 0x8011)]) is None
+    assert analyser.affected_by([(changes.ALL, None)]) == changes.REANALYSE
+
+def test_session_refresh(make_project, tmp_path):
+    make_project(CODE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e b=0")
+    analyser = session.current_analysis
+    assert session.refresh_analysis() is None
+
+    session.project.database.add_label(0x8010, "callee")
+    assert session.refresh_analysis() == changes.RECOLLATE
+    assert session.current_analysis is analyser
+    jsr = [item for item in analyser.disassembly
+           if item.kind == "disassembly" and item.operation.addr == 0x8004]
+    assert jsr[0].target_str == "[callee]"
+
+    session.project.database.set_state_delta(
+        0x8001, dsnes.StateDelta.parse("+m"))
+    assert session.refresh_analysis() == changes.REANALYSE
+    assert session.current_analysis is not analyser
+
+def test_session_refresh_empty(make_project, tmp_path):
+    make_project(CODE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e b=0")
+    session.line_number = 2
+
+    # Out of time before the first instruction, so there are no lines.
+    session.project.database.set_state_delta(
+        0x8001, dsnes.StateDelta.parse("+m"))
+    ctl = control.AnalysisControl(max_seconds=0)
+    assert session.refresh_analysis(ctl) == changes.REANALYSE
+    assert session.analysis_line_range is None
+    assert session.line_number is None
@@ -0,0 +1,65 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+from dsnes.analyser import codemap
+
+# lda $8010; jmp ($8012); rts
+CODE = {0x8000: b"\xad\x10\x80\x6c\x12\x80\x60"}
+
+def make_codemap(project):
+    return codemap.CodeMap(
+        project.bus, project.cartridge.rom, project.rom_hash)
+
+def test_add_analysis(make_project):
+    project = make_project(CODE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e b=0")
+    cmap = make_codemap(project)
+    cmap.add_analysis(analyser)
+
+    assert cmap.is_opcode(0x8000)
+    assert cmap.is_code(0x8001) and not cmap.is_opcode(0x8001)
+    assert cmap.is_opcode(0x8003)
+    assert cmap.kind_at(0x8006) == codemap.UNKNOWN
+    assert cmap.kind_at(0x8010) == codemap.DATA
+    assert cmap.kind_at(0x8012) == codemap.POINTER
+    assert cmap.kind_at(0x8013) == codemap.POINTER
+    # Not in ROM.
+    assert cmap.kind_at(0x0010) == codemap.UNKNOWN
+    assert cmap.state_at(0x8000).e is False
+    assert cmap.coverage() == [9 / 0x8000]
+    assert not cmap.conflicts
+
+def test_conflicts(make_project):
+    project = make_project()
+    cmap = make_codemap(project)
+    state = dsnes.State.parse("p=EMX")
+    cmap.mark_instruction(0x8000, 3, state)
+    cmap.mark_instruction(0x8000, 3, state)
+    assert not cmap.conflicts
+    # Starts inside the first instruction.
+    cmap.mark_instruction(0x8001, 2, state)
+    assert cmap.conflicts == {0x0001}
+    # Same place, different m flag.
+    cmap.mark_instruction(0x8001, 3, dsnes.State.parse("p=EmX"))
+    assert cmap.conflicts == {0x0001}
+    cmap.mark_instruction(0x8010, 1, state)
+    cmap.mark_instruction(0x8010, 1, dsnes.State.parse("p=EmX"))
+    assert cmap.conflicts == {0x0001, 0x0010}
+
+def test_save_load(make_project, tmp_path):
+    project = make_project(CODE)
+    cmap = make_codemap(project)
+    cmap.mark_instruction(0x8000, 3, dsnes.State.parse("p=e"))
+    path = str(tmp_path / codemap.FILENAME)
+    cmap.save(path)
+
+    loaded = codemap.load(project)
+    assert loaded.kinds == cmap.kinds
+    assert loaded.states == cmap.states
+
+    other = codemap.CodeMap(
+        project.bus, project.cartridge.rom, "another rom")
+    other.load(path)
+    assert other.kinds == bytearray(0x8000)
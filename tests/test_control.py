@@ -0,0 +1,63 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+from dsnes.analyser import control
+
+# 100 nops, then rts.
+NOP_CODE = {0x8000: b"\xea" * 100 + b"\x60"}
+
+def test_progress(make_project):
+    project = make_project(NOP_CODE)
+    reports = []
+    ctl = control.AnalysisControl(
+        progress_fn=lambda n, depth: reports.append(n), check_interval=40)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e", control=ctl)
+
+    assert analyser.is_complete
+    assert reports == [40, 80, 101]
+
+def test_instruction_budget(make_project):
+    project = make_project(NOP_CODE)
+    ctl = control.AnalysisControl(max_instructions=10)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e", control=ctl)
+
+    assert analyser.stop_reason == control.INSTRUCTION_BUDGET
+    assert len(analyser.operations) == 10
+    assert len(analyser.get_disassembly_lines()) == 10
+
+def test_cancel(make_project):
+    project = make_project(NOP_CODE)
+    ctl = control.AnalysisControl()
+    ctl.cancel()
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e", control=ctl)
+    # Cancelling before the analysis starts has no effect.
+    assert analyser.is_complete
+
+    ctl = control.AnalysisControl(
+        progress_fn=lambda n, depth: ctl.cancel(), check_interval=1)
+    analyser.analyse_function(0x8000, "p=e", control=ctl)
+    assert analyser.stop_reason == control.CANCELLED
+    assert len(analyser.operations) == 1
+
+def test_breakpoint(make_project):
+    project = make_project(NOP_CODE)
+    hits = []
+    def hook(analyser, from_address, to_address):
+        hits.append((from_address, to_address))
+        return to_address == 0x8005
+
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e", stop_before=0x8005)
+    assert analyser.stop_reason == control.BREAKPOINT
+    assert analyser.visited == {0x8000, 0x8001, 0x8002, 0x8003, 0x8004}
+
+    ctl = control.AnalysisControl()
+    ctl.add_breakpoint(0x8003, hook)
+    ctl.add_breakpoint(0x8005, hook)
+    analyser.analyse_function(0x8000, "p=e", control=ctl)
+    assert hits == [(0x8002, 0x8003), (0x8004, 0x8005)]
+    assert analyser.stop_reason == control.BREAKPOINT
@@ -0,0 +1,203 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import os
+
+import pytest
+import toml
+
+import dsnes
+from dsnes.analyser import database
+
+DATABASE = """\
+title = "kept as is"
+
+[states]
+"00:8000" = "p=e"
+
+[state_deltas]
+"00:8010" = "+M"
+
+[labels]
+"00:8000" = ["reset", "start"]
+
+[pre_comments]
+"00:8000" = "Entry point."
+
+[inline_comments]
+"01:0010" = "; Somewhere else"
+"""
+
+def test_int_keys(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    db = database.load(str(path))
+
+    assert db.get_state(0x8000).encode() == "p=e"
+    assert db.get_state_delta(0x8010).encode() == "+M"
+    assert db.get_labels(0x8000) == ["reset", "start"]
+    assert db.get_pre_comment(0x8000) == "Entry point."
+    assert db.get_inline_comment(0x010010) == "; Somewhere else"
+    assert db.get_inline_comments([0x8000, 0x010010]) == {
+        0x010010: "; Somewhere else"}
+    assert db.get_state_strings(range(0x8000, 0x8020)) == {0x8000: "p=e"}
+
+def test_save_round_trip(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    db = database.load(str(path))
+    db.set_pre_comment(0x8100, "New.")
+    db.remove_label(0x8000, "start")
+    db.add_label(0x8100, "later")
+    db.delete_inline_comment(0x010010)
+    db.set_state(0x8100, dsnes.State.parse("p=mx"))
+    db.compact()
+    assert not db.is_dirty
+
+    data = toml.load(str(path))
+    assert data["title"] == "kept as is"
+    assert data["labels"] == {"00:8000": ["reset"], "00:8100": ["later"]}
+    assert data["pre_comments"] == {
+        "00:8000": "Entry point.", "00:8100": "New."}
+    assert data["inline_comments"] == {}
+    assert data["states"] == {"00:8000": "p=e", "00:8100": "p=mx"}
+
+    reloaded = database.load(str(path))
+    assert reloaded.get_label(0x8100) == "later"
+    assert reloaded.get_state_delta(0x8010).encode() == "+M"
+
+def test_journal(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    db = database.load(str(path))
+    db.set_pre_comment(0x8100, "New.")
+    db.add_label(0x8100, "later")
+    db.save()
+    db.remove_label(0x8100, "later")
+    db.set_state_delta(0x8100, dsnes.StateDelta.parse("+X"))
+    db.save()
+
+    # Only the journal was written to.
+    assert path.read_text() == DATABASE
+    journal_path = tmp_path / "database.toml.journal"
+    assert len(journal_path.read_text().splitlines()) == 4
+
+    # A torn record from a crash is ignored.
+    with open(str(journal_path), "a") as outfile:
+        outfile.write('{"addr": 33024, "op": "pre_')
+    reloaded = database.load(str(path))
+    assert reloaded.get_pre_comment(0x8100) == "New."
+    assert reloaded.get_labels(0x8100) == []
+    assert reloaded.get_state_delta(0x8100).encode() == "+X"
+    assert not reloaded.is_dirty
+    reloaded.set_pre_comment(0x8000, "Changed.")
+    reloaded.save()
+    assert database.load(str(path)).get_pre_comment(0x8000) == "Changed."
+
+    reloaded.compact()
+    assert not journal_path.exists()
+    assert toml.load(str(path))["journal_seq"] == 5
+    reloaded.set_inline_comment(0x8100, "; After")
+    reloaded.save()
+    again = database.load(str(path))
+    assert again.get_inline_comment(0x8100) == "; After"
+    assert again.get_pre_comment(0x8100) == "New."
+    assert again.journal.seq == 6
+
+def test_sidecar(tmp_path, monkeypatch):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    database.load(str(path))
+    assert (tmp_path / "database.toml.cache").exists()
+
+    def no_parse(*args):
+        raise AssertionError("Parsed the TOML file")
+
+    def no_hash(*args):
+        raise AssertionError("Hashed the TOML file")
+
+    with monkeypatch.context() as m:
+        m.setattr(database.toml, "loads", no_parse)
+        db = database.load(str(path))
+        assert db.get_labels(0x8000) == ["reset", "start"]
+        assert db.get_address_with_label("start") == 0x8000
+        # Touched but not changed.
+        os.utime(str(path), ns=(0, 0))
+        db = database.load(str(path))
+        assert db.get_state(0x8000).encode() == "p=e"
+        # The sidecar now has the new mtime, so the file isn't hashed again.
+        m.setattr(database.hashlib, "sha1", no_hash)
+        db = database.load(str(path))
+        assert db.get_labels(0x8000) == ["reset", "start"]
+
+    # Changed, so the sidecar is stale.
+    path.write_text(DATABASE.replace("Entry point.", "Changed."))
+    db = database.load(str(path))
+    assert db.get_pre_comment(0x8000) == "Changed."
+
+    # Compacting keeps the sidecar up to date.
+    db.set_pre_comment(0x8000, "Compacted.")
+    db.compact()
+    with monkeypatch.context() as m:
+        m.setattr(database.toml, "loads", no_parse)
+        assert database.load(str(path)).get_pre_comment(0x8000) == (
+            "Compacted.")
+
+def test_nearest_label(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    db = database.load(str(path))
+    assert db.nearest_label(0x8000) == (0x8000, "reset")
+    assert db.nearest_label(0x8050) == (0x8000, "reset")
+    assert db.nearest_label(0x8050, max_offset=0x10) is None
+    assert db.nearest_label(0x7fff) is None
+    # Never crosses into another bank.
+    assert db.nearest_label(0x018000) is None
+
+    db.add_label(0x8040, "table")
+    assert db.nearest_label(0x8050) == (0x8040, "table")
+    db.remove_label(0x8040, "table")
+    db.remove_label(0x8000, "reset")
+    assert db.nearest_label(0x8050) == (0x8000, "start")
+    db.remove_label(0x8000, "start")
+    assert db.nearest_label(0x8050) is None
+    assert db.label_addresses == []
+
+def test_lazy_states(tmp_path, monkeypatch):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE.replace(
+        '"00:8010" = "+M"', '"00:8010" = "+M"\n"00:8020" = "bad"'))
+
+    def no_parse(*args):
+        raise AssertionError("Parsed a state")
+
+    with monkeypatch.context() as m:
+        m.setattr(dsnes.State, "parse", no_parse)
+        m.setattr(dsnes.StateDelta, "parse", no_parse)
+        db = database.load(str(path))
+    assert db.state_cache == {0x8000: "p=e"}
+    assert db.get_state(0x8000).encode() == "p=e"
+    assert isinstance(db.state_cache[0x8000], dsnes.State)
+    assert db.get_state_delta_strings([0x8010]) == {0x8010: "+M"}
+    with pytest.raises(ValueError):
+        db.get_state_delta(0x8020)
+    with pytest.raises(ValueError):
+        db.check()
+    # Unparsed strings are written back as they were.
+    assert db.to_toml_data()["state_deltas"]["00:8020"] == "bad"
+
+def test_duplicate_states(tmp_path):
+    assert database.find_duplicate_keys(["00:8000", "01:8000"]) == []
+    assert database.find_duplicate_keys(
+        ["00:8000", "0:8000", "01:8000", "1:8000", "00:8001"]) == [
+            0x8000, 0x018000]
+
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE.replace(
+        '"00:8000" = "p=e"', '"00:8000" = "p=e"\n"0:8000" = "p=E"'))
+    with pytest.raises(ValueError, match="already been declared"):
+        database.load(str(path))
+    path.write_text(DATABASE.replace(
+        '"00:8010" = "+M"', '"00:8000" = "+M"'))
+    with pytest.raises(ValueError, match="both"):
+        database.load(str(path))
@@ -0,0 +1,48 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+
+# jmp ($8003,x), followed by a 3 entry table, followed by the targets.
+JUMP_CODE = {
+    0x8000: b"\x7c\x03\x80",
+    0x8003: b"\x09\x80\x0a\x80\x0b\x80",
+    0x8009: b"\xea\xea\x60",
+}
+
+def test_jump_table_bounded_by_targets(make_project):
+    project = make_project(JUMP_CODE)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e")
+
+    assert analyser.jump_tables[0x8000] == (0x8003, [0x8009, 0x800a, 0x800b])
+    assert {0x8009, 0x800a, 0x800b} <= analyser.visited
+    targets = [t for t, _ in analyser.calls_from[0x8000]]
+    assert targets == [0x8009, 0x800a, 0x800b]
+
+def test_jump_table_stops_at_label(make_project):
+    project = make_project(JUMP_CODE)
+    project.database.add_label(0x8007, "not_in_table")
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e")
+
+    assert analyser.jump_tables[0x8000] == (0x8003, [0x8009, 0x800a])
+    assert 0x800b in analyser.visited
+
+def test_jump_table_stops_at_known_code(make_project):
+    project = make_project(JUMP_CODE)
+    targets = dsnes.analyser.jumptable.resolve(
+        project.bus, project.database, 0x8003, known_code={0x8005})
+    assert targets == [0x8009]
+
+def test_call_table_is_not_walked(make_project):
+    project = make_project({
+        0x8000: b"\xfc\x04\x80\x60",
+        0x8004: b"\x10\x80\x20\x80",
+    })
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e")
+
+    targets = [t for t, _ in analyser.calls_from[0x8000]]
+    assert targets == [0x8010, 0x8020]
+    assert analyser.visited == {0x8000, 0x8003}
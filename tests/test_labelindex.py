@@ -0,0 +1,52 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+from dsnes.analyser import database, labelindex
+from tests.test_database import DATABASE
+
+LABELS = ["reset", "reset_apu", "read_joypad", "nmi", "nmi_handler",
+          "UpdatePalette"]
+
+def test_complete():
+    index = labelindex.LabelIndex(LABELS)
+    assert "nmi" in index
+    assert "nm" not in index
+    assert index.complete("res") == ["reset", "reset_apu"]
+    assert index.complete("nmi") == ["nmi", "nmi_handler"]
+    assert index.complete("r", limit=2) == ["read_joypad", "reset"]
+    assert index.complete("x") == []
+    assert index.complete("") == sorted(LABELS)
+
+def test_search():
+    index = labelindex.LabelIndex(LABELS)
+    # Case is ignored, and a typo still matches.
+    assert index.search("updatepalette")[0] == "UpdatePalette"
+    assert index.search("UpdatePallete")[0] == "UpdatePalette"
+    assert index.search("joypad") == ["read_joypad"]
+    assert index.search("zzzz") == []
+
+def test_remove():
+    index = labelindex.LabelIndex(LABELS)
+    index.remove("reset")
+    assert "reset" not in index
+    assert index.complete("res") == ["reset_apu"]
+    assert "reset" not in index.search("reset")
+    index.remove("reset_apu")
+    assert index.complete("res") == []
+    assert index.trie.get("r", {}).get("e", {}).get("s", None) is None
+    with pytest.raises(KeyError):
+        index.remove("reset")
+
+def test_database(tmp_path):
+    path = tmp_path / "database.toml"
+    path.write_text(DATABASE)
+    db = database.load(str(path))
+    assert db.has_label("start")
+    assert not db.has_label("stop")
+    db.add_label(0x8100, "reset_apu")
+    assert db.complete_label("re") == ["reset", "reset_apu"]
+    db.remove_label(0x8000, "reset")
+    assert db.complete_label("re") == ["reset_apu"]
+    assert db.search_labels("strt") == ["start"]
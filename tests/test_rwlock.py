@@ -0,0 +1,104 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import threading
+
+import pytest
+
+import dsnes
+from dsnes.analyser import cache, changes, rwlock
+from dsnes.interactive import Session
+
+# sei; lda $2100; jsr $8010; rts
+CODE = {0x8000: b"\x78\xad\x00\x21\x20\x10\x80\x60"}
+
+def test_lock():
+    lock = rwlock.RWLock()
+    read_elsewhere = []
+    def read():
+        with lock.read():
+            read_elsewhere.append(True)
+    def write():
+        with lock.write():
+            order.append("write")
+
+    with lock.read():
+        # Reentrant, and other threads can read at the same time.
+        with lock.read():
+            pass
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join()
+        assert read_elsewhere
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+
+    order = []
+    with lock.write():
+        assert lock.is_writing
+        with lock.read(), lock.write():
+            pass
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join(0.1)
+        assert writer.is_alive()
+        order.append("first")
+    writer.join()
+    assert order == ["first", "write"]
+    assert not lock.is_writing
+
+def test_database_view(make_project):
+    database = make_project().database
+    database.add_label(0x8000, "start")
+    view = database.view()
+    database.add_label(0x8010, "callee")
+    database.set_state(0x8000, dsnes.State.parse("p=e"))
+
+    assert view.get_labels_for_addresses([0x8000, 0x8010]) == {
+        0x8000: ["start"]}
+    assert view.get_state(0x8000) is None
+    assert view.changes.generation < database.changes.generation
+    with pytest.raises(RuntimeError):
+        view.add_label(0x8020, "nope")
+    assert not database.has_label("nope")
+
+def test_detached_analysis(make_project, tmp_path):
+    make_project(CODE)
+    session = Session()
+    session.load_project(str(tmp_path))
+
+    analyser = session.analyse_detached(0x8000, "p=e")
+    assert session.current_analysis is None
+    session.open_analysis(analyser)
+    assert session.current_analysis is analyser
+    assert analyser.database is session.project.database
+    assert session.refresh_analysis() is None
+
+    # An edit made while the analysis ran.
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(session.analyse_detached(0x8000)))
+    thread.start()
+    thread.join()
+    session.project.database.set_state(0x8001, dsnes.State.parse("p=E"))
+    session.open_analysis(result[0])
+    assert session.refresh_analysis() == changes.REANALYSE
+
+def test_detached_restore(make_project, tmp_path, monkeypatch):
+    make_project(CODE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e")
+
+    # A cached analysis is rebuilt without holding the session's lock.
+    locked = []
+    original_rebuild = cache.rebuild
+    def rebuild(*args):
+        locked.append(session.lock.is_writing)
+        return original_rebuild(*args)
+    monkeypatch.setattr(cache, "rebuild", rebuild)
+    analyser = session.analyse_detached(0x8000, "p=e")
+    assert locked == [False]
+    assert analyser.database is not session.project.database
+    assert len(analyser.operations) == len(
+        session.current_analysis.operations)
@@ -0,0 +1,114 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+import dsnes
+from dsnes.analyser import shardeddb
+from tests.test_database import DATABASE
+
+class LookupOnly(dict):
+    """A table that can be looked up by address, but not gone through."""
+
+    def __iter__(self):
+        raise AssertionError("Went through a whole table")
+
+    items = keys = values = __iter__
+
+def make_db(tmp_path):
+    toml_path = tmp_path / "database.toml"
+    toml_path.write_text(DATABASE)
+    return shardeddb.split_toml(
+        str(toml_path), str(tmp_path / shardeddb.DIRNAME))
+
+def test_split(tmp_path):
+    make_db(tmp_path)
+    path = tmp_path / shardeddb.DIRNAME
+    assert sorted(p.name for p in path.iterdir()) == [
+        "bank_00.toml", "bank_01.toml", shardeddb.MANIFEST]
+
+    db = shardeddb.load(str(path))
+    assert not db.loaded_banks
+    assert db.extra_data == {"title": "kept as is"}
+    assert db.get_inline_comment(0x010010) == "; Somewhere else"
+    assert db.loaded_banks == {0x01}
+    assert db.get_state(0x8000).encode() == "p=e"
+    assert db.loaded_banks == {0x00, 0x01}
+    assert db.get_labels(0x8000) == ["reset", "start"]
+    assert db.get_labels_for_addresses([0x8000, 0x7E0000]) == {
+        0x8000: ["reset", "start"]}
+    assert db.to_toml_data()["states"] == {"00:8000": "p=e"}
+
+def test_labels_by_name(tmp_path):
+    make_db(tmp_path)
+    db = shardeddb.load(str(tmp_path / shardeddb.DIRNAME))
+    # Only the banks know their labels, so they're all read.
+    assert db.complete_label("st") == ["start"]
+    assert db.loaded_banks == {0x00, 0x01}
+    assert db.has_label("reset")
+    assert db.get_address_with_label("reset") == 0x8000
+
+def test_save_dirty_banks(tmp_path):
+    make_db(tmp_path)
+    path = tmp_path / shardeddb.DIRNAME
+    db = shardeddb.load(str(path))
+    bank_01 = path / "bank_01.toml"
+    before = bank_01.stat().st_mtime_ns
+
+    db.set_pre_comment(0x7E0100, "New bank.")
+    db.add_label(0x7E0100, "player_x")
+    with pytest.raises(ValueError):
+        # In use in a bank that hasn't been loaded.
+        db.add_label(0x7E0200, "reset")
+    assert db.dirty_banks == {0x7E}
+    db.save()
+    assert not db.is_dirty
+    assert bank_01.stat().st_mtime_ns == before
+    assert (path / "bank_7e.toml").exists()
+    # The manifest only names the banks.
+    assert (path / shardeddb.MANIFEST).read_text().count("player_x") == 0
+
+    db.delete_inline_comment(0x010010)
+    db.save()
+    assert not bank_01.exists()
+
+    reopened = shardeddb.load(str(path))
+    assert set(reopened.shard_banks) == {0x00, 0x7E}
+    assert reopened.shard_banks[0x7E] > reopened.shard_banks[0x00]
+    assert reopened.get_address_with_label("player_x") == 0x7E0100
+    assert reopened.get_pre_comment(0x7E0100) == "New bank."
+    assert reopened.get_inline_comment(0x010010) is None
+
+def test_project_load(make_project, tmp_path):
+    make_project()
+    shardeddb.split_toml(
+        str(tmp_path / "database.toml"), str(tmp_path / shardeddb.DIRNAME))
+    project = dsnes.project.load(str(tmp_path))
+    assert isinstance(project.database, shardeddb.ShardedDatabase)
+
+def test_save_only_reads_dirty_banks(tmp_path, monkeypatch):
+    make_db(tmp_path)
+    path = tmp_path / shardeddb.DIRNAME
+    db = shardeddb.load(str(path))
+    db.load_all()
+    db.set_pre_comment(0x010020, "Edited.")
+
+    # Saving a bank only looks up its own addresses.
+    for name in ("state_cache", "state_delta_cache", "labels_of_address",
+                 "pre_comments", "inline_comments"):
+        monkeypatch.setattr(db, name, LookupOnly(getattr(db, name)))
+    job = db.prepare_save()
+    assert set(job.shards) == {0x01}
+    job.run()
+
+def test_old_bank_file(tmp_path):
+    make_db(tmp_path)
+    path = tmp_path / shardeddb.DIRNAME
+    bank_00 = (path / "bank_00.toml").read_text()
+    db = shardeddb.load(str(path))
+    db.set_pre_comment(0x8010, "Later.")
+    db.save()
+    # As if the file had been put back from an older copy.
+    (path / "bank_00.toml").write_text(bank_00)
+    with pytest.raises(ValueError, match="older"):
+        shardeddb.load(str(path)).get_state(0x8000)
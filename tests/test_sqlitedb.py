@@ -0,0 +1,115 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+import toml
+
+import dsnes
+from dsnes.analyser import database, sqlitedb
+from tests.test_database import DATABASE
+
+def make_db(tmp_path):
+    toml_path = tmp_path / "database.toml"
+    toml_path.write_text(DATABASE)
+    return sqlitedb.import_toml(
+        str(toml_path), str(tmp_path / sqlitedb.FILENAME))
+
+def test_same_api(tmp_path):
+    db = make_db(tmp_path)
+    assert not db.is_dirty
+    assert db.get_state(0x8000).encode() == "p=e"
+    assert db.get_state(0x8001) is None
+    assert db.get_state_delta(0x8010).encode() == "+M"
+    assert db.get_labels(0x8000) == ["reset", "start"]
+    assert db.get_address_with_label("start") == 0x8000
+    assert db.get_labels_for_addresses([0x8000, 0x8001]) == {
+        0x8000: ["reset", "start"]}
+    assert db.get_inline_comments([0x8000, 0x010010]) == {
+        0x010010: "; Somewhere else"}
+
+    db.add_label(0x8100, "later")
+    db.set_pre_comment(0x8100, "New.")
+    with pytest.raises(ValueError):
+        db.add_label(0x8200, "later")
+    with pytest.raises(ValueError):
+        db.set_state(0x8010, dsnes.State.parse("p=e"))
+    assert db.is_dirty
+    db.save()
+    assert not db.is_dirty
+    db.close()
+
+    reopened = sqlitedb.load(str(tmp_path / sqlitedb.FILENAME))
+    assert reopened.get_label(0x8100) == "later"
+    assert reopened.get_pre_comments_in_range(0x8000, 0x80ff) == [
+        (0x8000, "Entry point.")]
+    assert reopened.get_labels_in_range(0x8000, 0xffff) == [
+        (0x8000, "reset"), (0x8000, "start"), (0x8100, "later")]
+
+def test_transaction(tmp_path):
+    db = make_db(tmp_path)
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.set_state(0x8100, dsnes.State.parse("p=mx"))
+            db.add_label(0x8100, "reset")
+    assert db.get_state(0x8100) is None
+    assert db.get_labels(0x8100) == []
+
+    db.set_inline_comment(0x8100, "; Unsaved")
+    db.revert()
+    assert db.get_inline_comment(0x8100) is None
+
+def test_export_round_trip(tmp_path):
+    db = make_db(tmp_path)
+    path = tmp_path / "exported.toml"
+    db.export_toml(str(path))
+    exported = toml.load(str(path))
+    original = toml.load(str(tmp_path / "database.toml"))
+    assert exported == original
+    assert database.load(str(path)).get_labels(0x8000) == ["reset", "start"]
+
+def test_project_uses_sqlite(make_project, tmp_path):
+    make_project()
+    db = sqlitedb.import_toml(
+        str(tmp_path / "database.toml"), str(tmp_path / sqlitedb.FILENAME))
+    db.add_label(0x8000, "reset")
+    db.save()
+    db.close()
+    project = dsnes.project.load(str(tmp_path))
+    assert isinstance(project.database, sqlitedb.SqliteDatabase)
+    analyser = dsnes.Analyser(project)
+    analyser.analyse_function(0x8000, "p=e")
+    assert analyser.get_disassembly_lines()[0].text == "reset"
+
+def test_label_search(tmp_path):
+    db = make_db(tmp_path)
+    assert db.has_label("reset")
+    assert not db.has_label("rese")
+    db.add_label(0x8100, "reset_apu")
+    assert db.complete_label("res") == ["reset", "reset_apu"]
+    assert db.complete_label("res", limit=1) == ["reset"]
+    assert db.search_labels("strt") == ["start"]
+    db.remove_label(0x8000, "start")
+    assert db.search_labels("strt") == []
+    db.revert()
+    assert db.search_labels("strt") == ["start"]
+    assert db.complete_label("res") == ["reset"]
+
+def test_view(tmp_path):
+    db = make_db(tmp_path)
+    db.add_label(0x8100, "unsaved")
+    view = db.view()
+    assert view is not db
+    db.add_label(0x8200, "later")
+    db.set_state(0x8001, dsnes.State.parse("p=e"))
+
+    # The view has the unsaved changes from before it was made, and none
+    # of those after. Reading it doesn't need the database's lock.
+    with db.lock.write():
+        assert view.get_label(0x8100) == "unsaved"
+        assert view.get_label(0x8200) is None
+        assert view.get_state(0x8001) is None
+    with pytest.raises(RuntimeError):
+        view.add_label(0x8300, "nope")
+    db.save()
+    assert sqlitedb.load(str(tmp_path / sqlitedb.FILENAME)).get_label(
+        0x8200) == "later"
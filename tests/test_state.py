@@ -69,3 +69,11 @@ def test_bad():
         State.parse("d=potato")
     with pytest.raises(ValueError):
         State.parse("Δ+C")
+
+def test_pack():
+    for s in ("unknown", "p=e", "p=MxcE", "b=0 d=0", "p=mXC b=ff d=ff"):
+        state = State.parse(s)
+        code = state.pack()
+        assert State.unpack(code).encode() == state.encode()
+    assert State().pack() == 0
+    assert State(b=0).pack() != State().pack()
@@ -0,0 +1,114 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import time
+
+import pytest
+
+from dsnes.analyser import batch, symbols
+from dsnes.interactive import Session
+
+
+SYM = """\
+; WLA symbols
+[labels]
+00:8000 reset
+00:8010 nmi ; comment
+7e:0100 player_x
+
+[definitions]
+00000010 SIZE
+"""
+
+NOCASH = """\
+00008000 reset
+00008020 irq
+"""
+
+MLB = """\
+PRG:0000:reset
+PRG:0030-0031:table:A table
+WORK:0100:player_x
+REG:2100:INIDISP
+SAVE:0000:save_data
+"""
+
+VICE = """\
+al 008000 .reset
+al 7E0100 .player_x
+"""
+
+
+def test_read_sym():
+    assert list(symbols.read_sym(SYM.splitlines())) == [
+        (symbols.CPU, 0x8000, "reset"),
+        (symbols.CPU, 0x8010, "nmi"),
+        (symbols.CPU, 0x7E0100, "player_x"),
+    ]
+    assert list(symbols.read_sym(NOCASH.splitlines())) == [
+        (symbols.CPU, 0x8000, "reset"),
+        (symbols.CPU, 0x8020, "irq"),
+    ]
+
+def test_read_mlb():
+    assert list(symbols.read_mlb(MLB.splitlines())) == [
+        (symbols.ROM, 0x0000, "reset"),
+        (symbols.ROM, 0x0030, "table"),
+        (symbols.WRAM, 0x0100, "player_x"),
+        (symbols.REGISTER, 0x2100, "INIDISP"),
+        (symbols.SRAM, 0x0000, "save_data"),
+    ]
+
+def test_read_vice():
+    assert list(symbols.read_vice(VICE.splitlines())) == [
+        (symbols.CPU, 0x8000, "reset"),
+        (symbols.CPU, 0x7E0100, "player_x"),
+    ]
+
+def test_read_unknown(tmp_path):
+    path = tmp_path / "labels.txt"
+    path.write_text(VICE)
+    with pytest.raises(ValueError):
+        list(symbols.read(str(path)))
+    assert len(list(symbols.read(str(path), "vice"))) == 2
+
+def test_session_import(make_project, tmp_path):
+    make_project()
+    session = Session()
+    session.load_project(str(tmp_path))
+    database = session.project.database
+    database.add_label(0x8000, "reset")
+    database.add_label(0x8040, "table")
+    path = tmp_path / "game.mlb"
+    path.write_text(MLB)
+
+    result = session.import_symbols(str(path))
+    assert result == symbols.ImportResult(
+        added=2, existing=1, conflicts=1, unmapped=1)
+    assert database.get_address_with_label("player_x") == 0x7E0100
+    assert database.get_address_with_label("INIDISP") == 0x2100
+    assert database.get_address_with_label("table") == 0x8040
+
+    session.undo()
+    assert not database.has_label("player_x")
+    assert database.has_label("reset")
+
+def test_large_import(make_project):
+    project = make_project()
+    database = project.database
+    count = 50000
+    lines = ["{:02x}:{:04x} label_{}".format(n >> 15, 0x8000 | n & 0x7FFF, n)
+             for n in range(count)]
+    # Every label again, which are skipped.
+    lines += lines[:1000]
+    resolve = symbols.make_resolver(project.bus, None)
+
+    start = time.perf_counter()
+    edits = batch.Batch()
+    result = symbols.add_to_batch(
+        symbols.read_sym(lines), edits, database, resolve)
+    database.apply_batch(edits)
+    assert time.perf_counter() - start < 10
+    assert result.added == count
+    assert result.existing == 1000
+    assert database.get_address_with_label("label_40000") == 0x019C40
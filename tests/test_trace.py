@@ -0,0 +1,111 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import dsnes
+from dsnes.analyser import codemap, trace
+from dsnes.interactive import Session
+
+# sei; rep #$30; jsr $8010; rts. At $8010 lda #$1234; rts.
+CODE = {
+    0x8000: b"\x78\xc2\x30\x20\x10\x80\x60",
+    0x8010: b"\xa9\x34\x12\x60",
+}
+
+REGS = "A:0000 X:0000 Y:0000 S:01ff D:0000 DB:00"
+TRACE = """\
+Trace log header
+008000 sei            {regs} nvMXdizc
+008001 rep #$30       {regs} nvMXdIzc
+008003 jsr $8010      {regs} nvmxdIzc
+008010 lda #$1234     {regs} nvmxdIzc
+008013 rts            {regs} nvmxdIzc
+008006 rts            {regs} nvmxdIzc
+""".format(regs=REGS)
+
+def test_parse_line():
+    pc, state = trace.parse_line(
+        "00:8000 $78  SEI  A:0000 X:0000 Y:0000 S:01FF D:0100 DB:7E P:34")
+    assert pc == 0x8000
+    assert state.encode() == "p=MXc b=7e"
+
+    pc, state = trace.parse_line("008001 rep #$30  {} nvMXdIzc".format(REGS))
+    assert state.e is False
+
+    pc, state = trace.parse_line("00ff9c sei  {} nv1BdIzc".format(REGS))
+    assert pc == 0xff9c
+    assert state.encode() == "p=MXcE b=0 d=0"
+
+    assert trace.parse_line("Trace log header") is None
+
+def test_trace_table():
+    t = trace.Trace()
+    t.add_lines(TRACE.splitlines())
+    assert t.line_count == 7
+    assert t.instruction_count == 6
+    assert t.entries == {0x8000, 0x8010, 0x8006}
+    assert len(t.keys) == 6
+    # Running the same code again doesn't grow the table.
+    t.add_lines(TRACE.splitlines()[1:])
+    assert len(t.keys) == 6
+    assert t.instruction_count == 12
+
+def test_session_import(make_project, tmp_path):
+    make_project(CODE)
+    path = tmp_path / "trace.log"
+    path.write_text(TRACE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.import_trace(str(path))
+
+    database = session.project.database
+    assert database.get_state(0x8010).encode() == "p=mxce b=0 d=0"
+    assert database.get_state(0x8001) is None
+    assert session.codemap.is_opcode(0x8010)
+    assert session.codemap.kind_at(0x8012) == codemap.OPERAND
+    assert session.get_references_to(0x8010) == [(0x8003, "call")]
+    # Returns aren't references.
+    assert session.get_references_to(0x8006) == []
+
+def test_native_trace_analyses(make_project, tmp_path):
+    # As CODE, but at $8010 lda $10; rts, which needs to know e.
+    make_project({0x8000: CODE[0x8000], 0x8010: b"\xa5\x10\x60"})
+    path = tmp_path / "trace.log"
+    path.write_text(TRACE.replace("lda #$1234", "lda $10   "))
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.import_trace(str(path))
+    session.new_analysis(0x8010)
+    assert session.current_analysis.is_complete
+
+def test_seed_without_e(make_project, tmp_path):
+    # Mesen lines don't show e, so only the known bits are seeded.
+    make_project(CODE)
+    path = tmp_path / "trace.log"
+    path.write_text(
+        "00:8003 $20  JSR  A:0000 X:0000 Y:0000 S:01FF D:0000 DB:00 P:04\n"
+        "00:8010 $A9  LDA  A:0000 X:0000 Y:0000 S:01FF D:0000 DB:00 P:04\n")
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.import_trace(str(path))
+    database = session.project.database
+    assert database.get_state(0x8010) is None
+    assert database.get_state_delta(0x8010).encode() == "+mxc b=00 d=00"
+
+def test_import_is_undoable(make_project, tmp_path):
+    make_project(CODE)
+    path = tmp_path / "trace.log"
+    path.write_text(TRACE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e")
+    analyser = session.current_analysis
+    session.import_trace(str(path))
+
+    # The open analysis reached the seeded state, so it was redone.
+    database = session.project.database
+    assert database.get_state(0x8010) is not None
+    assert session.current_analysis is not analyser
+    session.undo()
+    assert database.get_state(0x8010) is None
+    assert database.get_state(0x8006) is None
+    assert not session.can_undo()
@@ -0,0 +1,101 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import pytest
+
+import dsnes
+from dsnes.analyser import changes
+from dsnes.interactive import NoOperation, Session, undo
+
+# sei; lda $2100; jsr $8010; rts
+CODE = {0x8000: b"\x78\xad\x00\x21\x20\x10\x80\x60"}
+
+
+def open_session(make_project, tmp_path):
+    make_project(CODE)
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e b=0")
+    return session
+
+def test_undo_redo(make_project, tmp_path):
+    session = open_session(make_project, tmp_path)
+    database = session.project.database
+    with pytest.raises(NoOperation):
+        session.undo()
+
+    session.apply_new_label(0x8000, "start")
+    session.set_inline_comment(0x8000, "First")
+    session.set_inline_comment(0x8000, "Second")
+    session.set_state_delta(0x8001, "+m")
+    session.remove_label(0x8000, "start")
+
+    session.undo()
+    assert database.get_labels(0x8000) == ["start"]
+    session.undo()
+    assert database.get_state_delta(0x8001) is None
+    session.undo()
+    assert database.get_inline_comment(0x8000) == "First"
+    session.redo()
+    assert database.get_inline_comment(0x8000) == "Second"
+    session.undo()
+    session.undo()
+    session.undo()
+    assert database.get_inline_comment(0x8000) is None
+    assert database.get_labels(0x8000) == []
+    assert not session.can_undo()
+
+    # A new edit forgets what could be redone.
+    session.set_pre_comment(0x8000, "New")
+    assert not session.can_redo()
+
+def test_undo_batch(make_project, tmp_path):
+    session = open_session(make_project, tmp_path)
+    database = session.project.database
+    with session.batch() as edits:
+        edits.add_label(0x8000, "start")
+        edits.set_state(0x8001, dsnes.State.parse("p=E b=0"))
+        edits.remove_state(0x8001)
+        edits.set_pre_comment(0x8004, "Call")
+    session.undo()
+    assert database.get_labels(0x8000) == []
+    assert database.get_pre_comment(0x8004) is None
+    assert session.current_analysis.disassembly[0].kind == "disassembly"
+    session.redo()
+    assert database.get_labels(0x8000) == ["start"]
+    assert database.get_state(0x8001) is None
+
+def test_undo_reanalyses(make_project, tmp_path):
+    session = open_session(make_project, tmp_path)
+    session.set_state_delta(0x8001, "+m")
+    session.refresh_analysis()
+    analyser = session.current_analysis
+    session.undo()
+    assert session.current_analysis is not analyser
+    assert session.project.database.get_state_delta(0x8001) is None
+
+    # Undoing a comment only rebuilds the listing.
+    session.set_inline_comment(0x8000, "Hi")
+    session.refresh_analysis()
+    analyser = session.current_analysis
+    session.undo()
+    assert session.current_analysis is analyser
+
+def test_undo_conflict(make_project, tmp_path):
+    session = open_session(make_project, tmp_path)
+    session.apply_new_label(0x8000, "start")
+    # Changed behind the history's back.
+    session.project.database.remove_label(0x8000, "start")
+    with pytest.raises(ValueError):
+        session.undo()
+    assert session.can_undo()
+
+def test_history_limit():
+    history = undo.UndoHistory(max_edits=3)
+    for n in range(5):
+        history.record([undo.Edit(changes.PRE_COMMENT, 0x8000 + n, None, "x")])
+    assert len(history.undo_steps) == 3
+    assert history.undo_steps[0][0].addr == 0x8002
+    history.record([undo.Edit(changes.PRE_COMMENT, 0x8000, None, "x")] * 4)
+    assert not history.can_undo()
+    assert history.size == 0
@@ -0,0 +1,89 @@
+# Copyright 2017 Adrian Chan
+# Licensed under GPLv3
+
+import random
+
+import dsnes
+from dsnes.analyser import xref
+from dsnes.interactive import Session
+
+def test_lookup():
+    index = xref.XrefIndex()
+    index.update([0x8000, 0x8010], [
+        (0x8000, 0x9000, xref.CALL),
+        (0x8010, 0x9000, xref.BRANCH),
+        (0x8010, 0x9001, xref.JUMP),
+    ])
+    assert index.get_references_to(0x9000) == [
+        (0x8000, xref.CALL), (0x8010, xref.BRANCH)]
+    assert index.get_references_to(0x9001) == [(0x8010, xref.JUMP)]
+    assert index.get_references_to(0x8fff) == []
+
+def test_update_replaces_sources():
+    index = xref.XrefIndex()
+    index.update([0x8000, 0x8010], [
+        (0x8000, 0x9000, xref.CALL),
+        (0x8010, 0x9000, xref.CALL),
+    ])
+    index.update([0x8000], [(0x8000, 0x9100, xref.JUMP)])
+    assert index.get_references_to(0x9000) == [(0x8010, xref.CALL)]
+    assert index.get_references_to(0x9100) == [(0x8000, xref.JUMP)]
+    assert len(index) == 2
+
+def test_session_collects_references(make_project, tmp_path):
+    # jsr $8010; bra $8000 (to itself); at $8010 beq $8014; rts.
+    make_project({
+        0x8000: b"\x20\x10\x80\x80\xfb",
+        0x8010: b"\xf0\x02\x60",
+    })
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e")
+    assert session.get_references_to(0x8010) == [(0x8000, "call")]
+    assert session.get_references_to(0x8000) == [(0x8003, "jump")]
+
+    session.follow_call(0x8010, None)
+    assert session.get_references_to(0x8014) == [(0x8010, "branch")]
+    assert session.get_references_to(0x8010) == [(0x8000, "call")]
+
+def test_data_accesses_across_mirrors(make_project, tmp_path):
+    # lda $0010; sta $2100; inc $4302; jsr $8010 (not data); rts
+    # With b=7e so absolute addresses land in WRAM bank 7e, except the
+    # registers which are only in bank 00.
+    make_project({
+        0x8000: b"\xad\x10\x00\x8d\x00\x21\xee\x02\x43\x20\x10\x80\x60",
+        0x8010: b"\x8d\x10\x00\x60",
+    })
+    session = Session()
+    session.load_project(str(tmp_path))
+    session.new_analysis(0x8000, "p=e b=0")
+    session.line_number = 3
+    session.follow_call(0x8010, dsnes.State.parse("p=e b=7e"))
+
+    assert session.get_data_accesses(0x7e0010) == [
+        (0x8000, 0x000010, "read"), (0x8010, 0x000010, "write")]
+    assert session.get_data_accesses(0x2100) == [(0x8003, 0x2100, "write")]
+    assert session.get_data_accesses(0x4300, 0x437f) == [
+        (0x8006, 0x4302, "modify")]
+    assert session.get_data_accesses(0x8010) == []
+
+def test_update_matches_rebuild():
+    rng = random.Random(1)
+    index = xref.XrefIndex()
+    expected = set()
+    for _ in range(200):
+        sources = {rng.randrange(0x8000, 0x8100) for _ in range(8)}
+        refs = [(rng.choice(sorted(sources)), rng.randrange(0x8000, 0x8100),
+                 rng.choice((xref.CALL, xref.JUMP, xref.BRANCH)))
+                for _ in range(rng.randrange(6))]
+        # From a source that isn't replaced, and already there after the
+        # first time.
+        refs.append((0x9000, 0x8000, xref.CALL))
+        index.update(sources, refs)
+        expected = {ref for ref in expected if ref[0] not in sources}
+        expected.update(refs)
+        assert len(index) == len(expected)
+    for target in range(0x8000, 0x8100):
+        assert index.get_references_to(target) == sorted(
+            (source, kind) for source, ref_target, kind in expected
+            if ref_target == target)